@@ -0,0 +1,219 @@
+import asyncio
+from datetime import datetime, date, timedelta, time as day_time
+from functools import partial
+from pathlib import Path
+from typing import Callable
+
+import docker
+from dotenv import dotenv_values
+import pytz
+
+from docker_controller import (is_workflow_time, start_dependency_containers, wait_for_dependencies_ready,
+                               run_daily_management, check_container_running, start_report_publisher)
+from move_backups import get_smb_pool, SmbConnectionPool
+from readiness import get_ib_gateway_probe
+from controller_logging import get_logger
+
+config = dotenv_values(".env")
+
+logger = get_logger(name=__name__)
+
+TIMEZONE = pytz.timezone('Europe/London')
+
+# upper bound of a single asyncio.sleep, so that clock changes and suspend are picked up while waiting for a boundary
+MAX_SLEEP_SECONDS = 600
+
+
+async def run_blocking(function: Callable, *args, **kwargs):
+    """Runs a blocking call, docker, samba or git, in the default executor so that the event loop keeps running"""
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(function, *args, **kwargs))
+
+
+def get_next_workflow_start(now: datetime, weekday_start: int, weekday_end: int, stop_hour: int,
+                            last_run_date: date = None) -> datetime:
+    """Returns now if the daily flow should run now, otherwise the start of the next day, at midnight London time,
+       that is inside the workflow window. Raises ValueError if the window never opens
+    """
+
+    if is_workflow_time(now=now, weekday_start=weekday_start, weekday_end=weekday_end, stop_hour=stop_hour) and \
+            now.date() != last_run_date:
+        return now
+
+    for days_ahead in range(1, 8):
+        candidate = TIMEZONE.localize(datetime.combine(now.date() + timedelta(days=days_ahead), day_time()))
+
+        if is_workflow_time(now=candidate, weekday_start=weekday_start, weekday_end=weekday_end,
+                            stop_hour=stop_hour):
+            return candidate
+
+    raise ValueError(f'Workflow window {weekday_start}-{weekday_end}, stop hour {stop_hour}, is never open')
+
+
+async def sleep_until(moment: datetime):
+    """Sleeps until moment, in steps of at most MAX_SLEEP_SECONDS"""
+
+    while True:
+        remaining = (moment - datetime.now(TIMEZONE)).total_seconds()
+
+        if remaining <= 0:
+            return
+
+        await asyncio.sleep(min(remaining, MAX_SLEEP_SECONDS))
+
+
+async def run_daily_schedule(docker_client: docker.client, name_suffix: str, weekday_start: int, weekday_end: int,
+                             stop_hour: int, smb_pool: SmbConnectionPool, db_backup_mode: str = 'cold',
+                             readiness_deadline: float = 180, **daily_management_arguments):
+    """Wakes up at the start of every workflow day and runs the daily flow, in the executor"""
+
+    last_run_date = None
+
+    while True:
+        next_start = get_next_workflow_start(now=datetime.now(TIMEZONE), weekday_start=weekday_start,
+                                             weekday_end=weekday_end, stop_hour=stop_hour,
+                                             last_run_date=last_run_date)
+
+        if next_start > datetime.now(TIMEZONE):
+            logger.info(f'Next daily run at {next_start.isoformat()}')
+            await sleep_until(next_start)
+            continue
+
+        last_run_date = next_start.date()
+
+        await run_blocking(start_dependency_containers, docker_client=docker_client, name_suffix=name_suffix,
+                           db_backup_mode=db_backup_mode)
+
+        await run_blocking(wait_for_dependencies_ready, deadline=float(readiness_deadline))
+
+        await run_blocking(run_daily_management, docker_client=docker_client, name_suffix=name_suffix,
+                           smb_pool=smb_pool, db_backup_mode=db_backup_mode, **daily_management_arguments)
+
+
+async def supervise_ib_gateway(docker_client: docker.client, name_suffix: str, check_interval: int = 300):
+    """Logs when ib_gateway stops running. It is not restarted, as login needs two factor authentication"""
+
+    was_running = True
+
+    while True:
+        try:
+            running = await run_blocking(check_container_running, container_name='ib_gateway',
+                                         docker_client=docker_client, name_suffix=name_suffix)
+
+        except Exception:
+            logger.warning('Could not check ib_gateway status', exc_info=True)
+            running = was_running
+
+        if was_running and not running:
+            logger.critical('ib_gateway is not running. It has to be started manually')
+
+        elif running and not was_running:
+            logger.info('ib_gateway is running again')
+
+        was_running = running
+        await asyncio.sleep(check_interval)
+
+
+async def close_idle_smb_connections(smb_pool: SmbConnectionPool, check_interval: int = 60):
+    """Closes pooled samba connections that have idled past the pool's idle_timeout. The pool only does this itself
+       when a connection is acquired, so without this connections would linger until the next daily run
+    """
+
+    while True:
+        await asyncio.sleep(check_interval)
+        await run_blocking(smb_pool.close_idle_connections, older_than=smb_pool.idle_timeout)
+
+
+async def run_daily_container_management_async(docker_client: docker.client,
+                                               name_suffix: str,
+                                               weekday_start: int,
+                                               weekday_end: int,
+                                               stop_hour: int,
+                                               samba_user: str,
+                                               samba_password: str,
+                                               samba_share: str,
+                                               samba_server_ip: str,
+                                               samba_remote_name: str,
+                                               path_local_csv_backup_folder: Path = Path('csv_backup'),
+                                               path_local_db_backup_folder: Path = Path('db_backup'),
+                                               stream_csv_backup: bool = False,
+                                               csv_backup_mode: str = 'full',
+                                               csv_backup_full_interval_days: int = 7,
+                                               db_backup_mode: str = 'cold',
+                                               db_backup_full_interval_days: int = 7,
+                                               readiness_deadline: float = 180,
+                                               ib_gateway_deadline: float = 3600,
+                                               harvest_logs: bool = False,
+                                               csv_backup_retention: str = 'daily:7,weekly:4,monthly:6',
+                                               db_backup_retention: str = '',
+                                               retention_dry_run: bool = False,
+                                               backup_verify_sample_size: int = 0,
+                                               db_backup_dedup: bool = False,
+                                               publish_reports_in_background: bool = False):
+    """asyncio version of docker_controller.run_daily_container_management, taking the same parameters.
+       The daily flow starts at the exact schedule boundary instead of up to 10 minutes late, and ib_gateway and
+       the samba connection pool are supervised concurrently with it. Blocking docker, samba and git calls run in
+       the default executor. If any of the tasks fails, the others are cancelled and the exception is re-raised
+    """
+
+    smb_pool = get_smb_pool(samba_user=samba_user,
+                            samba_password=samba_password,
+                            samba_share=samba_share,
+                            samba_server_ip=samba_server_ip,
+                            samba_remote_name=samba_remote_name)
+
+    # kept across days, like the pool, so that a recent handshake with ib_gateway is not repeated
+    ib_gateway_probe = get_ib_gateway_probe(ipv4_network_part=config['IPV4_NETWORK_PART']).check
+
+    report_publisher = start_report_publisher() if publish_reports_in_background else None
+
+    tasks = [asyncio.create_task(run_daily_schedule(docker_client=docker_client,
+                                                    name_suffix=name_suffix,
+                                                    weekday_start=weekday_start,
+                                                    weekday_end=weekday_end,
+                                                    stop_hour=stop_hour,
+                                                    smb_pool=smb_pool,
+                                                    db_backup_mode=db_backup_mode,
+                                                    readiness_deadline=readiness_deadline,
+                                                    ib_gateway_probe=ib_gateway_probe,
+                                                    ib_gateway_deadline=ib_gateway_deadline,
+                                                    harvest_logs=harvest_logs,
+                                                    csv_backup_retention=csv_backup_retention,
+                                                    db_backup_retention=db_backup_retention,
+                                                    retention_dry_run=retention_dry_run,
+                                                    backup_verify_sample_size=backup_verify_sample_size,
+                                                    db_backup_dedup=db_backup_dedup,
+                                                    report_publisher=report_publisher,
+                                                    samba_user=samba_user,
+                                                    samba_password=samba_password,
+                                                    samba_share=samba_share,
+                                                    samba_server_ip=samba_server_ip,
+                                                    samba_remote_name=samba_remote_name,
+                                                    path_local_csv_backup_folder=path_local_csv_backup_folder,
+                                                    path_local_db_backup_folder=path_local_db_backup_folder,
+                                                    stream_csv_backup=stream_csv_backup,
+                                                    csv_backup_mode=csv_backup_mode,
+                                                    csv_backup_full_interval_days=csv_backup_full_interval_days,
+                                                    db_backup_full_interval_days=db_backup_full_interval_days),
+                                 name='daily_schedule'),
+             asyncio.create_task(supervise_ib_gateway(docker_client=docker_client, name_suffix=name_suffix),
+                                 name='supervise_ib_gateway'),
+             asyncio.create_task(close_idle_smb_connections(smb_pool=smb_pool), name='close_idle_smb_connections')]
+
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+
+        for task in done:
+            if task.exception() is not None:
+                logger.critical(f'Task {task.get_name()} failed, terminating', exc_info=task.exception())
+                raise task.exception()
+
+    finally:
+        for task in tasks:
+            task.cancel()
+
+        smb_pool.close_idle_connections()
+
+        if report_publisher is not None:
+            report_publisher.stop()
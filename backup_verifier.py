@@ -0,0 +1,123 @@
+import argparse
+import random
+from typing import Dict, List
+
+from dotenv import dotenv_values
+from smb.base import NotConnectedError
+from smb.smb_structs import OperationFailure
+
+from controller_logging import get_logger
+from metrics import timed
+from move_backups import SmbClient, SmbConnectionPool
+
+config = dotenv_values(".env")
+
+logger = get_logger(name=__name__)
+
+# folders on the share holding backups with .sha256 sidecars
+VERIFIED_FOLDERS = ['csv_backup', 'db_backup']
+
+
+def get_verifiable_backups(smb: SmbClient, folder: str) -> Dict[str, str]:
+    """Expected sha256 by name of the backups in folder that have a .sha256 sidecar. None where the checksum is not
+       in the listing cache yet, it is then read from the sidecar on verification
+    """
+
+    cached_files = {cached_file.filename: cached_file for cached_file in smb.get_cached_list_of_files(subfolder=folder)}
+
+    return {name: cached_file.checksum for name, cached_file in cached_files.items()
+            if name + '.sha256' in cached_files}
+
+
+def verify_backup(smb: SmbClient, folder: str, name: str, expected: str = None) -> bool:
+    """Re-hashes the backup on the share, streamed, and compares with its sidecar. True if they match"""
+
+    remote_path_str = f'{folder}/{name}'
+
+    if expected is None:
+        expected = smb.read_remote_file(remote_path_str + '.sha256').decode().split()[0]
+        smb.listing_cache.set_checksum(remote_path_str=remote_path_str, checksum=expected)
+
+    with timed('verify_backup', folder=folder) as measurement:
+        actual = smb.hash_remote_file(remote_path_str)
+        measurement.succeeded = actual == expected
+
+    if actual != expected:
+        logger.error(f'Backup {remote_path_str} on samba share is corrupt. sha256 is {actual}, expected {expected}')
+        return False
+
+    logger.info(f'Verified backup {remote_path_str} on samba share in {measurement.wall_time:.1f} seconds')
+
+    return True
+
+
+def verify_sample_of_backups(smb: SmbClient, folders: List[str] = VERIFIED_FOLDERS,
+                             sample_size: int = 1) -> Dict[str, bool]:
+    """Verifies sample_size randomly chosen backups of each folder, so that over the days every backup on the share
+       is read back now and then, without reading all of them every day. Returns verified by remote path
+    """
+
+    results = {}
+
+    for folder in folders:
+        try:
+            backups = get_verifiable_backups(smb=smb, folder=folder)
+
+        except OperationFailure:
+            logger.warning(f'Could not list {folder} on samba share, not verified', exc_info=True)
+            continue
+
+        for name in random.sample(sorted(backups), min(sample_size, len(backups))):
+            try:
+                results[f'{folder}/{name}'] = verify_backup(smb=smb, folder=folder, name=name, expected=backups[name])
+
+            except OperationFailure:
+                logger.warning(f'Could not read {folder}/{name} from samba share, not verified', exc_info=True)
+
+    return results
+
+
+def verify_backups_on_share(smb_pool: SmbConnectionPool, folders: List[str] = VERIFIED_FOLDERS,
+                            sample_size: int = 1) -> Dict[str, bool]:
+    """verify_sample_of_backups on a connection of smb_pool. Raises ValueError if any backup was found corrupt"""
+
+    try:
+        with smb_pool.connection() as smb:
+            results = verify_sample_of_backups(smb=smb, folders=folders, sample_size=sample_size)
+
+    except NotConnectedError:
+        logger.warning('Failed to connect to samba share, backups not verified', exc_info=True)
+        return {}
+
+    corrupt = [remote_path for remote_path, verified in results.items() if not verified]
+
+    if len(corrupt) != 0:
+        raise ValueError(f'Corrupt backups on samba share; {corrupt}')
+
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Re-hashes backups on the samba share and compares them with their '
+                                                 '.sha256 sidecars')
+    parser.add_argument('folders', nargs='*', default=VERIFIED_FOLDERS, help='folders on the share')
+    parser.add_argument('--sample', type=int, default=1, help='backups to verify per folder')
+    parser.add_argument('--all', action='store_true', help='verify every backup that has a sidecar')
+    arguments = parser.parse_args()
+
+    smb_client = SmbClient(ip=config['SAMBA_SERVER_IP'],
+                           username=config['SAMBA_USER'],
+                           password=config['SAMBA_PASSWORD'],
+                           remote_name=config['SAMBA_REMOTE_NAME'],
+                           sharename=config['SAMBA_SHARE'])
+
+    if not smb_client.connect():
+        raise ConnectionError('Could not connect to samba share')
+
+    verified_backups = verify_sample_of_backups(smb=smb_client, folders=arguments.folders,
+                                                sample_size=1 << 30 if arguments.all else arguments.sample)
+    smb_client.close()
+
+    for verified_path, is_verified in sorted(verified_backups.items()):
+        print(('ok       ' if is_verified else 'CORRUPT  ') + verified_path)
@@ -0,0 +1,95 @@
+"""Compares the throughput of the make_csv_tarfile compression backends on a synthetic arctic csv dump.
+   Run from the repo root, so that the .env file is found;
+   python3 benchmarks/benchmark_make_csv_tarfile.py --size-mb 500 --workers 4
+"""
+import argparse
+import gzip
+import random
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from move_backups import make_csv_tarfile, COMPRESSION_FILE_SUFFIXES
+
+
+def make_synthetic_csv_backup(path_to_backup_dir: Path, size_mb: int, number_of_instruments: int = 50):
+    """Writes price like csv files into one folder per data type, like backup_arctic_to_csv does"""
+
+    random_generator = random.Random(1)
+    bytes_per_file = size_mb * 1024 * 1024 // number_of_instruments
+
+    for folder_name in ['adjusted_prices', 'multiple_prices']:
+        folder_path = path_to_backup_dir / folder_name
+        folder_path.mkdir(parents=True)
+
+        for instrument_number in range(number_of_instruments // 2):
+            price = 100.0
+            lines = ['index,price\n']
+            written = 0
+            day = 0
+
+            while written < bytes_per_file:
+                price += random_generator.gauss(0, 1)
+                line = f'2000-01-01 {day % 24:02d}:00:00+{day},{price:.6f}\n'
+                lines.append(line)
+                written += len(line)
+                day += 1
+
+            (folder_path / f'INSTRUMENT{instrument_number}.csv').write_text(''.join(lines))
+
+
+def check_readable_by_standard_tools(tar_path: Path):
+
+    if tar_path.name.endswith('.tar.gz'):
+        with gzip.open(str(tar_path), 'rb') as gzip_file:
+            while gzip_file.read(1 << 20):
+                pass
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size-mb', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--compression', nargs='*', default=list(COMPRESSION_FILE_SUFFIXES))
+    arguments = parser.parse_args()
+
+    path_to_temp_dir = Path(tempfile.mkdtemp(prefix='csv_tar_benchmark_'))
+
+    try:
+        make_synthetic_csv_backup(path_to_backup_dir=path_to_temp_dir, size_mb=arguments.size_mb)
+        input_bytes = sum(file.stat().st_size for file in path_to_temp_dir.glob('**/*.csv'))
+
+        print(f'{"compression":<12}{"seconds":>10}{"MB/s":>10}{"ratio":>10}')
+
+        for compression in arguments.compression:
+            start = time.perf_counter()
+
+            try:
+                tar_path = make_csv_tarfile(path_to_local_backup_dir=path_to_temp_dir,
+                                            compression=compression,
+                                            workers=arguments.workers)
+
+            except ImportError:
+                print(f'{compression:<12}{"skipped, backend not installed":>30}')
+                continue
+
+            seconds = time.perf_counter() - start
+            output_bytes = tar_path.stat().st_size
+
+            check_readable_by_standard_tools(tar_path=tar_path)
+            tar_path.unlink()
+
+            print(f'{compression:<12}{seconds:>10.2f}{input_bytes / seconds / 1e6:>10.1f}'
+                  f'{input_bytes / output_bytes:>10.2f}')
+
+    finally:
+        shutil.rmtree(str(path_to_temp_dir))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Measures the startup of the monitor entry points, from interpreter start to done, and the time they spend
+importing, lazy imports included, with python's -X importtime. Runs the scripts in the pysystemtrade container given
+with --container, or locally with --local. The scripts update process control in mongo_db, so only
+run_monitor_fast.py is run unless others are given with --scripts;
+python3 benchmarks/benchmark_monitor_startup.py --container cleaner_dev --runs 5
+python3 benchmarks/benchmark_monitor_startup.py --container cleaner_dev --max-import-ms 300
+python3 benchmarks/benchmark_monitor_startup.py --local --scripts run_monitor_fast.py run_monitor_once.py
+Exits with 1 if the import time of run_monitor_fast.py is above --max-import-ms, so that a heavy import slipping in
+is noticed
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+PYSYSTEMTRADE_DIR = '/opt/projects/pysystemtrade'
+SCRIPTS = ['run_monitor_fast.py']
+
+
+def get_command(container: str, arguments: List[str]) -> List[str]:
+
+    if container is None:
+        return [sys.executable] + arguments
+
+    return ['docker', 'exec', '-w', PYSYSTEMTRADE_DIR, container, 'python3'] + arguments
+
+
+def parse_importtime(stderr: str) -> Tuple[float, Dict[str, float]]:
+    """Total import time in milliseconds, the sum of the cumulative times of the top level imports, and the
+       cumulative time by module
+    """
+
+    total = 0.0
+    cumulative_by_module = {}
+
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative_time, name = line.split('|', 2)
+        cumulative = int(cumulative_time) / 1000
+        cumulative_by_module[name.strip()] = cumulative
+
+        # nested imports are indented by two spaces per level, after the single space following the bar
+        if not name[1:].startswith(' '):
+            total += cumulative
+
+    return total, cumulative_by_module
+
+
+def time_script(container: str, script: str, runs: int) -> List[float]:
+    """Wall times of running the script, in seconds, including starting the interpreter"""
+
+    wall_times = []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(get_command(container, [script]), check=True, stdout=subprocess.DEVNULL)
+        wall_times.append(time.perf_counter() - start)
+
+    return wall_times
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--container', help='pysystemtrade container to run the scripts in, required unless --local')
+    parser.add_argument('--local', action='store_true', help='run with this interpreter, from the current directory')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--top', type=int, default=10, help='slowest imports to show')
+    parser.add_argument('--max-import-ms', type=float, default=None)
+    parser.add_argument('--scripts', nargs='*', default=SCRIPTS)
+    arguments = parser.parse_args()
+
+    if arguments.container is None and not arguments.local:
+        parser.error('--container or --local is required')
+
+    container = None if arguments.local else arguments.container
+    import_times = {}
+
+    for script in arguments.scripts:
+        completed = subprocess.run(get_command(container, ['-X', 'importtime', script]),
+                                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        import_times[script], cumulative_by_module = parse_importtime(completed.stderr)
+
+        print(f'{script}: imports {import_times[script]:.0f} ms, {len(cumulative_by_module)} modules')
+
+        for name, cumulative in sorted(cumulative_by_module.items(), key=lambda item: -item[1])[:arguments.top]:
+            print(f'    {cumulative:8.1f} ms  {name}')
+
+    for script in arguments.scripts:
+        wall_times = time_script(container=container, script=script, runs=arguments.runs)
+        print(f'{script}: start to done median {statistics.median(wall_times):.2f} s, '
+              f'min {min(wall_times):.2f} s over {len(wall_times)} runs')
+
+    fast_import_time = import_times.get('run_monitor_fast.py')
+
+    if arguments.max_import_ms is not None and fast_import_time is not None and \
+            fast_import_time > arguments.max_import_ms:
+        print(f'run_monitor_fast.py imports in {fast_import_time:.0f} ms, above {arguments.max_import_ms:.0f} ms')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
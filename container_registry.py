@@ -0,0 +1,278 @@
+import threading
+import time
+from typing import Dict, Iterable, Set
+
+import docker
+
+from controller_logging import get_logger
+
+logger = get_logger(name=__name__)
+
+# status a container has after each event, events not listed do not change it
+STATUS_BY_ACTION = {'create': 'created', 'start': 'running', 'restart': 'running', 'unpause': 'running',
+                    'pause': 'paused', 'die': 'exited', 'stop': 'exited'}
+
+# seconds without a state change, while waiting for containers, after which their state is listed again
+RESYNC_INTERVAL = 300
+# seconds before the events stream is opened again after it failed
+RECONNECT_DELAY = 10
+
+
+class ContainerState(object):
+    """Last known status of a container. container is the docker Container object, fetched when first needed.
+       updated_ns is the time of the listing or event the status is from, older events are not applied
+    """
+
+    def __init__(self, status: str, updated_ns: int, container=None, container_id: str = None):
+        self.status = status
+        self.updated_ns = updated_ns
+        self.container = container
+        self.container_id = container_id if container_id is not None else getattr(container, 'id', None)
+
+
+class ContainerRegistry(object):
+    """Status of the containers whose names end with name_suffix, kept up to date by following the docker events
+       stream in a background thread. The containers are listed, with a name filter, when the registry is started and
+       whenever the events stream has to be opened again. Statuses are then read from memory, instead of fetching
+       the container from the docker daemon for every check. Changes made through the registry are written through,
+       so they are visible before their event arrives
+    """
+
+    def __init__(self, docker_client: docker.client, name_suffix: str):
+        self.docker_client = docker_client
+        self.name_suffix = name_suffix
+        self.states = {}
+        self.condition = threading.Condition()
+        self.stop_event = threading.Event()
+        self.event_stream = None
+        self.thread = None
+
+    def start(self):
+
+        since = int(time.time())
+        self.refresh()
+
+        self.thread = threading.Thread(target=self.follow_events, args=(since,), name='container_registry',
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+
+        self.stop_event.set()
+
+        if self.event_stream is not None:
+            self.event_stream.close()
+
+    def get_full_name(self, container_name: str) -> str:
+        return container_name + self.name_suffix
+
+    def refresh(self, container_names: Iterable[str] = None):
+        """Lists the containers, all of the name suffix or only container_names, and replaces their cached state"""
+
+        listed_ns = time.time_ns()
+        full_names = None if container_names is None else {self.get_full_name(name) for name in container_names}
+
+        if full_names is not None:
+            filters = {'name': sorted(full_names)}
+
+        else:
+            filters = {'name': self.name_suffix} if self.name_suffix != '' else {}
+
+        # sparse, so that docker is not asked to inspect every container listed
+        containers = self.docker_client.containers.list(all=True, sparse=True, filters=filters)
+        listed = {}
+
+        for container in containers:
+            full_name = container.attrs['Names'][0].lstrip('/')
+
+            if full_name.endswith(self.name_suffix) and (full_names is None or full_name in full_names):
+                listed[full_name] = container
+
+        with self.condition:
+            for full_name in (full_names if full_names is not None else set(self.states) | set(listed)):
+                state = self.states.get(full_name)
+
+                if state is not None and state.updated_ns > listed_ns:
+                    continue
+
+                if full_name in listed:
+                    self.states[full_name] = ContainerState(status=listed[full_name].status, updated_ns=listed_ns,
+                                                            container=listed[full_name])
+
+                else:
+                    self.states.pop(full_name, None)
+
+            self.condition.notify_all()
+
+    def follow_events(self, since: int):
+
+        while not self.stop_event.is_set():
+            try:
+                self.event_stream = self.docker_client.events(since=since, filters={'type': 'container'}, decode=True)
+
+                for event in self.event_stream:
+                    since = event.get('time', since)
+                    self.handle_event(event)
+
+            except Exception:
+                if self.stop_event.is_set():
+                    break
+
+                logger.warning('Docker events stream failed, listing containers and opening it again',
+                               exc_info=True)
+
+            if self.stop_event.wait(RECONNECT_DELAY):
+                break
+
+            try:
+                self.refresh()
+
+            except Exception:
+                logger.warning('Could not list containers', exc_info=True)
+
+    def handle_event(self, event: dict):
+
+        actor = event.get('Actor', {})
+        full_name = actor.get('Attributes', {}).get('name', '')
+        action = event.get('Action', event.get('status', ''))
+        event_ns = event.get('timeNano', event.get('time', 0) * 1_000_000_000)
+
+        if not full_name.endswith(self.name_suffix) or (action not in STATUS_BY_ACTION and action != 'destroy'):
+            return
+
+        with self.condition:
+            state = self.states.get(full_name)
+
+            if state is not None and state.updated_ns > event_ns:
+                return
+
+            if action == 'destroy':
+                self.states.pop(full_name, None)
+
+            elif state is None or state.container_id != actor.get('ID'):
+                # a container not seen before, or recreated with the same name
+                self.states[full_name] = ContainerState(status=STATUS_BY_ACTION[action], updated_ns=event_ns,
+                                                        container_id=actor.get('ID'))
+
+            else:
+                state.status = STATUS_BY_ACTION[action]
+                state.updated_ns = event_ns
+
+            logger.debug('Container %s %s', full_name, action, extra={'container': full_name})
+            self.condition.notify_all()
+
+    def get(self, container_name: str):
+        """The Container object. Fetched from docker only if not known yet. Raises NotFound if there is no such
+           container
+        """
+
+        full_name = self.get_full_name(container_name)
+
+        with self.condition:
+            state = self.states.get(full_name)
+
+            if state is not None and state.container is not None:
+                return state.container
+
+        fetched_ns = time.time_ns()
+        container = self.docker_client.containers.get(container_id=full_name)
+
+        with self.condition:
+            state = self.states.get(full_name)
+
+            if state is None or state.updated_ns <= fetched_ns:
+                self.states[full_name] = ContainerState(status=container.status, updated_ns=fetched_ns,
+                                                        container=container)
+
+            elif state.container_id in (None, container.id):
+                state.container = container
+                state.container_id = container.id
+
+        return container
+
+    def get_status(self, container_name: str) -> str:
+        """Last known status, like 'running' or 'exited'. Raises NotFound if there is no such container"""
+
+        full_name = self.get_full_name(container_name)
+
+        with self.condition:
+            state = self.states.get(full_name)
+
+        if state is None:
+            self.get(container_name)
+
+            with self.condition:
+                state = self.states[full_name]
+
+        return state.status
+
+    def is_running(self, container_name: str) -> bool:
+        return self.get_status(container_name) == 'running'
+
+    def record_status(self, container_name: str, status: str, as_of_ns: int):
+        """Writes through the status after an action started at as_of_ns, unless an event since then has arrived"""
+
+        with self.condition:
+            state = self.states.get(self.get_full_name(container_name))
+
+            if state is not None and state.updated_ns <= as_of_ns:
+                state.status = status
+                state.updated_ns = as_of_ns
+                self.condition.notify_all()
+
+    def get_running(self, full_names: Set[str]) -> Set[str]:
+        return {name for name in full_names if name in self.states and self.states[name].status == 'running'}
+
+    def wait_until_stopped(self, container_names: Iterable[str], resync_interval: float = RESYNC_INTERVAL):
+        """Blocks until none of the containers are running. Returns as soon as the event of the last one stopping
+           arrives. If nothing changes for resync_interval seconds, the containers are listed again, in case the
+           events stream missed something
+        """
+
+        container_names = list(container_names)
+        full_names = {self.get_full_name(name) for name in container_names}
+        logged = False
+
+        while True:
+            with self.condition:
+                running = self.get_running(full_names)
+
+                if len(running) == 0:
+                    return
+
+                if not logged:
+                    logger.info(f'Waiting for {running} to stop running')
+                    logged = True
+
+                changed = self.condition.wait_for(lambda: self.get_running(full_names) != running,
+                                                  timeout=resync_interval)
+
+            if not changed:
+                self.refresh(container_names=container_names)
+
+    def get_statuses(self) -> Dict[str, str]:
+        """Last known status by full container name"""
+
+        with self.condition:
+            return {full_name: state.status for full_name, state in self.states.items()}
+
+
+container_registries = {}
+container_registries_lock = threading.Lock()
+
+
+def get_container_registry(docker_client: docker.client, name_suffix: str) -> ContainerRegistry:
+    """The started ContainerRegistry of the name_suffix containers, shared by all functions of the controller that
+       are passed the same docker_client. Created and started on first use
+    """
+
+    with container_registries_lock:
+        key = (id(docker_client), name_suffix)
+
+        if key not in container_registries:
+            registry = ContainerRegistry(docker_client=docker_client, name_suffix=name_suffix)
+            registry.start()
+            container_registries[key] = registry
+
+        return container_registries[key]
+
@@ -0,0 +1,133 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Callable
+
+from dotenv import dotenv_values
+
+config = dotenv_values(".env")
+logging_level = config['LOGGING_LEVEL']
+
+LOG_FILE = 'container_management.log'
+LOG_FILE_MAX_BYTES = int(config.get('LOG_FILE_MAX_BYTES') or 10 << 20)
+LOG_FILE_BACKUP_COUNT = int(config.get('LOG_FILE_BACKUP_COUNT') or 5)
+LOG_FILE_FORMAT = config.get('LOG_FILE_FORMAT') or 'json'
+
+# passed with extra={...}, and written as fields of their own in the json records
+STRUCTURED_FIELDS = ('stage', 'container', 'bytes', 'duration')
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(funcName)s - %(message)s'
+
+
+class LazyPayload(object):
+    """Wraps a function building an expensive log payload. Passed as a %s argument, the function is only called if
+       the record is actually emitted, e.g. logger.debug('Files on share; %s', lazy(lambda: [...]))
+    """
+
+    def __init__(self, function: Callable):
+        self.function = function
+
+    def __str__(self):
+        return str(self.function())
+
+
+def lazy(function: Callable) -> LazyPayload:
+    return LazyPayload(function)
+
+
+class JsonFormatter(logging.Formatter):
+    """One json object per line, with the structured fields of the record if it has any"""
+
+    def format(self, record: logging.LogRecord) -> str:
+
+        entry = {'time': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec='milliseconds'),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'function': record.funcName,
+                 'thread': record.threadName,
+                 'message': record.getMessage()}
+
+        for field in STRUCTURED_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+
+        return json.dumps(entry, default=str)
+
+
+class PreparingQueueHandler(QueueHandler):
+    """Puts records on the queue with message and traceback rendered in the logging thread, where arguments are
+       still valid, but leaves the formatting to the handlers of the listener. Lazy payloads are evaluated here, so
+       only for records that passed the level of the logger
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        return record
+
+
+queue_handler = None
+queue_handler_lock = threading.Lock()
+
+
+def get_queue_handler() -> QueueHandler:
+    """The handler shared by all loggers. On first use, starts the listener thread writing records to the
+       rotating log file and to the console, and registers it to be flushed and stopped at exit
+    """
+
+    global queue_handler
+
+    with queue_handler_lock:
+        if queue_handler is not None:
+            return queue_handler
+
+        file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUP_COUNT)
+        file_handler.setLevel(logging_level)
+        file_handler.setFormatter(JsonFormatter() if LOG_FILE_FORMAT == 'json' else logging.Formatter(TEXT_FORMAT))
+
+        console_handler = logging.StreamHandler()
+        console_handler.setLevel('INFO')
+        console_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+        log_queue = queue.Queue()
+        listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+
+        queue_handler = PreparingQueueHandler(log_queue)
+
+        return queue_handler
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Logger at LOGGING_LEVEL whose records are written by the shared listener thread, so that logging never
+       blocks on file or console io
+    """
+
+    logger = logging.getLogger(name=name)
+    logger.setLevel(logging_level)
+
+    handler = get_queue_handler()
+
+    if handler not in logger.handlers:
+        logger.addHandler(handler)
+
+    return logger
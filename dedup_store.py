@@ -0,0 +1,559 @@
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import threading
+import zlib
+from datetime import datetime
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List
+
+from dotenv import dotenv_values
+
+from smb.base import NotConnectedError
+from smb.smb_structs import OperationFailure
+
+from move_backups import (SmbClient, SmbConnectionPool, get_smb_pool, generate_tar_gz_filename_with_timestamp_suffix,
+                          get_db_backup_file_suffix, is_not_found)
+from retention import RetentionPolicy, plan_retention
+from metrics import timed
+from controller_logging import get_logger, lazy
+
+config = dotenv_values(".env")
+
+logger = get_logger(name=__name__)
+
+# on the share; chunks/<sha256> holds zlib compressed chunks, manifests/<backup name>.json describes a backup
+DEDUP_STORE_FOLDER = config.get('DEDUP_STORE_FOLDER') or 'dedup_store'
+INDEX_FILE_NAME = 'index.json.gz'
+MANIFEST_SUFFIX = '.json'
+
+# manifests never change once uploaded, so they are kept locally for listing and garbage collection
+LOCAL_MANIFEST_CACHE = Path(config.get('DEDUP_STORE_MANIFEST_CACHE') or 'dedup_manifests')
+
+MIN_CHUNK_SIZE = 256 << 10
+AVERAGE_CHUNK_SIZE = 1 << 20
+MAX_CHUNK_SIZE = 4 << 20
+READ_SIZE = 8 << 20
+
+# the csv and db uploads run in parallel, and share the chunk index. A backup or garbage collection reads the index
+# and saves it under this lock, so neither overwrites the chunks of the other, and garbage collection never deletes a
+# chunk that a backup in progress found in the index and did not upload again
+store_lock = threading.Lock()
+
+
+def iterate_chunks(file_obj: BinaryIO, min_size: int = MIN_CHUNK_SIZE, average_size: int = AVERAGE_CHUNK_SIZE,
+                   max_size: int = MAX_CHUNK_SIZE) -> Iterator[bytes]:
+    """Splits what can be read from file_obj into content defined chunks. Boundaries are placed after a newline byte
+       when the crc32 of the line it ends, up to 4 KiB of it, is below a threshold proportional to the line length,
+       so that a boundary follows on average average_size bytes past min_size. As a boundary only depends on the
+       line before it, an insertion or deletion only changes the chunks around it, and the other chunks of a backup
+       are the same as the day before. Finding newlines and hashing lines runs in C, one python step per line instead
+       of a rolling hash step per byte. Data without newlines, like long binary runs, is cut at max_size
+    """
+
+    threshold_per_byte = (1 << 32) / average_size
+    buffer = b''
+    chunk_start = 0
+    search_offset = min_size - 1     # relative to chunk_start, a newline before it would give a chunk below min_size
+
+    for block in iter(lambda: file_obj.read(READ_SIZE), b''):
+        buffer = buffer[chunk_start:] + block
+        chunk_start = 0
+
+        while True:
+            newline = buffer.find(b'\n', chunk_start + search_offset)
+
+            if newline == -1 or newline + 1 - chunk_start > max_size:
+                if len(buffer) - chunk_start < max_size:
+                    search_offset = max(search_offset, len(buffer) - chunk_start)
+                    break
+
+                chunk_end = chunk_start + max_size
+
+            else:
+                line_start = buffer.rfind(b'\n', max(chunk_start, newline - 4096), newline) + 1 or \
+                    max(chunk_start, newline - 4096)
+
+                if zlib.crc32(buffer[line_start:newline + 1]) >= threshold_per_byte * (newline + 1 - line_start):
+                    search_offset = newline + 1 - chunk_start
+                    continue
+
+                chunk_end = newline + 1
+
+            yield buffer[chunk_start:chunk_end]
+            chunk_start = chunk_end
+            search_offset = min_size - 1
+
+    if chunk_start < len(buffer):
+        yield buffer[chunk_start:]
+
+
+class HashingReader(object):
+    """Read-only file object passing on what is read from file_obj, while computing its sha256"""
+
+    def __init__(self, file_obj: BinaryIO):
+        self.file_obj = file_obj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+
+        data = self.file_obj.read(size)
+        self.sha256.update(data)
+
+        return data
+
+
+class DedupStore(object):
+    """Deduplicating backup store on the samba share. Backups are split into content defined chunks, and a chunk is
+       only uploaded if the store does not have it yet. The index of chunks in the store, by sha256, and a manifest
+       per backup listing its chunks, are kept on the share next to the chunks, so the store is self contained.
+       smb is a connected SmbClient
+    """
+
+    def __init__(self, smb: SmbClient, folder: str = DEDUP_STORE_FOLDER,
+                 local_manifest_cache: Path = LOCAL_MANIFEST_CACHE):
+        self.smb = smb
+        self.folder = folder
+        self.local_manifest_cache = local_manifest_cache
+        self.chunks = None      # sha256: [stored size, size]
+
+    def load_index(self, reload: bool = False) -> Dict[str, list]:
+        """Reads the chunk index from the share, once, or again with reload. Creates the folders of the store if it
+           has no index. Raises OperationFailure if the index exists but could not be read
+        """
+
+        if self.chunks is not None and not reload:
+            return self.chunks
+
+        try:
+            self.chunks = json.loads(gzip.decompress(self.smb.read_remote_file(f'{self.folder}/{INDEX_FILE_NAME}')))
+
+        except OperationFailure as failure:
+            if not is_not_found(failure):
+                raise
+
+            logger.info(f'No chunk index in {self.folder} on samba share, creating a new store')
+            self.smb.create_directory(directory_name=self.folder, relative_path=Path(''))
+            self.smb.create_directory(directory_name='chunks', relative_path=Path(self.folder))
+            self.smb.create_directory(directory_name='manifests', relative_path=Path(self.folder))
+            self.chunks = {}
+
+        return self.chunks
+
+    def save_index(self) -> bool:
+
+        data = gzip.compress(json.dumps(self.chunks, separators=(',', ':')).encode(), 6)
+
+        return self.smb.upload_file_object(file_obj=io.BytesIO(data),
+                                           remote_path_str=f'{self.folder}/{INDEX_FILE_NAME}') is not None
+
+    def put_chunks(self, file_obj: BinaryIO, totals: dict) -> List[str]:
+        """Chunks file_obj, uploads the chunks the store does not have, and returns the sha256 of every chunk in
+           order. totals counts bytes read, new chunks and bytes uploaded. If the backup fails part way, the index is
+           saved with the chunks uploaded so far, so the next backup reuses them, and garbage collection can delete
+           them if none does
+        """
+
+        chunks = self.load_index()
+        hashes = []
+
+        try:
+            for chunk in iterate_chunks(file_obj):
+                chunk_hash = hashlib.sha256(chunk).hexdigest()
+                hashes.append(chunk_hash)
+                totals['bytes'] += len(chunk)
+                totals['number_of_chunks'] += 1
+
+                if chunk_hash in chunks:
+                    continue
+
+                stored = zlib.compress(chunk, 6)
+
+                if self.smb.upload_file_object(file_obj=io.BytesIO(stored),
+                                               remote_path_str=f'{self.folder}/chunks/{chunk_hash}') is None:
+                    raise IOError(f'Upload of chunk {chunk_hash} to samba share failed')
+
+                chunks[chunk_hash] = [len(stored), len(chunk)]
+                totals['new_chunks'] += 1
+                totals['bytes_uploaded'] += len(stored)
+
+        except BaseException:
+            if totals['new_chunks'] != 0 and not self.save_index():
+                logger.warning(f'Could not save the chunk index of {self.folder} after a failed backup, its new '
+                               f'chunks are deleted by the next garbage collection')
+
+            raise
+
+        return hashes
+
+    def put_manifest(self, manifest: dict) -> bool:
+        """Saves the index, then uploads the manifest. A manifest on the share therefore means a complete backup"""
+
+        if not self.save_index():
+            return False
+
+        data = json.dumps(manifest, separators=(',', ':')).encode()
+
+        if self.smb.upload_file_object(file_obj=io.BytesIO(data),
+                                       remote_path_str=f'{self.folder}/manifests/{manifest["name"]}'
+                                                       f'{MANIFEST_SUFFIX}') is None:
+            return False
+
+        self.cache_manifest(manifest)
+
+        return True
+
+    def backup_folder(self, name: str, path_to_folder: Path, pattern: str = '**/*.csv') -> dict:
+        """Stores the files in path_to_folder matching pattern as backup name. Returns the manifest"""
+
+        totals = {'bytes': 0, 'number_of_chunks': 0, 'new_chunks': 0, 'bytes_uploaded': 0}
+        files = []
+
+        with store_lock, timed('dedup_backup', kind='folder') as measurement:
+            self.load_index(reload=True)
+
+            for file_path in sorted(path_to_folder.glob(pattern)):
+                with open(str(file_path), 'rb') as file_obj:
+                    files.append({'path': file_path.relative_to(path_to_folder).as_posix(),
+                                  'mtime': file_path.stat().st_mtime,
+                                  'chunks': self.put_chunks(file_obj=file_obj, totals=totals)})
+
+            manifest = {'name': name, 'kind': 'folder', 'created': datetime.now().isoformat(), 'files': files,
+                        **totals}
+            measurement.succeeded = self.put_manifest(manifest)
+            measurement.bytes_processed = totals['bytes']
+
+        self.log_totals(name=name, totals=totals)
+
+        return manifest if measurement.succeeded else None
+
+    def backup_stream(self, name: str, file_obj: BinaryIO, gzip_compressed: bool = False) -> dict:
+        """Stores what can be read from file_obj as backup name. With gzip_compressed the data is decompressed
+           before it is chunked, compressed data does not deduplicate, and compressed again when restored.
+           Returns the manifest
+        """
+
+        totals = {'bytes': 0, 'number_of_chunks': 0, 'new_chunks': 0, 'bytes_uploaded': 0}
+        reader = HashingReader(file_obj=gzip.GzipFile(fileobj=file_obj, mode='rb') if gzip_compressed else file_obj)
+
+        with store_lock, timed('dedup_backup', kind='stream') as measurement:
+            self.load_index(reload=True)
+            manifest = {'name': name, 'kind': 'stream', 'created': datetime.now().isoformat(),
+                        'gzip': gzip_compressed, 'chunks': self.put_chunks(file_obj=reader, totals=totals),
+                        'sha256': reader.sha256.hexdigest(), **totals}
+            measurement.succeeded = self.put_manifest(manifest)
+            measurement.bytes_processed = totals['bytes']
+
+        self.log_totals(name=name, totals=totals)
+
+        return manifest if measurement.succeeded else None
+
+    def log_totals(self, name: str, totals: dict):
+
+        logger.info(f'Backup {name}: {totals["bytes"]} bytes in {totals["number_of_chunks"]} chunks, '
+                    f'{totals["new_chunks"]} new chunks, {totals["bytes_uploaded"]} bytes uploaded',
+                    extra={'bytes': totals['bytes_uploaded']})
+
+    def cache_manifest(self, manifest: dict):
+
+        self.local_manifest_cache.mkdir(parents=True, exist_ok=True)
+        (self.local_manifest_cache / (manifest['name'] + MANIFEST_SUFFIX)).write_text(json.dumps(manifest))
+
+    def list_backups(self) -> List[str]:
+        """Names of the backups in the store, oldest first"""
+
+        return sorted(cached_file.filename[:-len(MANIFEST_SUFFIX)]
+                      for cached_file in self.smb.get_cached_list_of_files(subfolder=f'{self.folder}/manifests')
+                      if cached_file.filename.endswith(MANIFEST_SUFFIX))
+
+    def get_manifest(self, name: str) -> dict:
+
+        local_path = self.local_manifest_cache / (name + MANIFEST_SUFFIX)
+
+        if local_path.exists():
+            return json.loads(local_path.read_text())
+
+        manifest = json.loads(self.smb.read_remote_file(f'{self.folder}/manifests/{name}{MANIFEST_SUFFIX}'))
+        self.cache_manifest(manifest)
+
+        return manifest
+
+    def read_chunk(self, chunk_hash: str) -> bytes:
+
+        chunk = zlib.decompress(self.smb.read_remote_file(f'{self.folder}/chunks/{chunk_hash}'))
+
+        if hashlib.sha256(chunk).hexdigest() != chunk_hash:
+            raise ValueError(f'Chunk {chunk_hash} in {self.folder} on samba share is corrupt')
+
+        return chunk
+
+    def restore(self, name: str, target: Path) -> Path:
+        """Restores backup name. A folder backup is restored into the folder target, a stream backup to the file
+           target. Every chunk is checked against its sha256, and a stream against the sha256 of the whole stream
+        """
+
+        manifest = self.get_manifest(name)
+
+        with timed('dedup_restore', kind=manifest['kind']) as measurement:
+            measurement.bytes_processed = manifest['bytes']
+
+            if manifest['kind'] == 'folder':
+                for file in manifest['files']:
+                    file_path = target / file['path']
+                    file_path.parent.mkdir(parents=True, exist_ok=True)
+
+                    with open(str(file_path), 'wb') as file_obj:
+                        for chunk_hash in file['chunks']:
+                            file_obj.write(self.read_chunk(chunk_hash))
+
+            else:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                sha256 = hashlib.sha256()
+
+                with open(str(target), 'wb') as raw_file_obj:
+                    file_obj = gzip.GzipFile(fileobj=raw_file_obj, mode='wb', compresslevel=6) \
+                        if manifest['gzip'] else raw_file_obj
+
+                    try:
+                        for chunk_hash in manifest['chunks']:
+                            chunk = self.read_chunk(chunk_hash)
+                            sha256.update(chunk)
+                            file_obj.write(chunk)
+
+                    finally:
+                        if manifest['gzip']:
+                            file_obj.close()
+
+                if sha256.hexdigest() != manifest['sha256']:
+                    raise ValueError(f'Restored {name} does not match its sha256 {manifest["sha256"]}')
+
+        logger.info(f'Restored {name} to {target}')
+
+        return target
+
+    def collect_garbage(self, policy: RetentionPolicy, prefix: str, dry_run: bool = False) -> dict:
+        """Deletes the backups starting with prefix that policy does not keep, then the chunks no backup refers to.
+           Backups with other prefixes are kept, and their chunks too. Chunks on the share that are not in the index,
+           left by a backup that failed before it could save the index, are deleted as well. Returns what was, or
+           would be, deleted
+        """
+
+        with store_lock:
+            backups = self.list_backups()
+            backups_to_delete, _ = plan_retention(files={name: 0 for name in backups}, policy=policy,
+                                                  is_backup=lambda name: name.startswith(prefix))
+            backups_to_keep = [name for name in backups if name not in set(backups_to_delete)]
+
+            referenced = set()
+
+            for name in backups_to_keep:
+                manifest = self.get_manifest(name)
+
+                for chunk_list in ([manifest['chunks']] if manifest['kind'] == 'stream' else
+                                   [file['chunks'] for file in manifest['files']]):
+                    referenced.update(chunk_list)
+
+            chunks = self.load_index(reload=True)
+            chunks_to_delete = [chunk_hash for chunk_hash in chunks if chunk_hash not in referenced]
+            freed = sum(chunks[chunk_hash][0] for chunk_hash in chunks_to_delete)
+
+            # the listing cache has the chunks uploaded through it, so this does not list the share every time
+            for cached_file in self.smb.get_cached_list_of_files(subfolder=f'{self.folder}/chunks'):
+                if cached_file.filename not in chunks and cached_file.filename not in referenced:
+                    chunks_to_delete.append(cached_file.filename)
+                    freed += cached_file.file_size
+
+            logger.info(f'Garbage collection of {self.folder}: {len(backups_to_delete)} backups and '
+                        f'{len(chunks_to_delete)} chunks, {freed} bytes, to delete')
+            logger.debug('Backups to delete; %s', lazy(lambda: backups_to_delete))
+
+            if not dry_run:
+                # manifests first, so a backup is never left with missing chunks
+                self.smb.delete_many([f'/{self.folder}/manifests/{name}{MANIFEST_SUFFIX}'
+                                      for name in backups_to_delete])
+
+                for name in backups_to_delete:
+                    (self.local_manifest_cache / (name + MANIFEST_SUFFIX)).unlink(missing_ok=True)
+
+                deleted = self.smb.delete_many([f'/{self.folder}/chunks/{chunk_hash}'
+                                                for chunk_hash in chunks_to_delete])
+
+                for path in deleted:
+                    chunks.pop(Path(path).name, None)
+
+                self.save_index()
+
+            return {'backups': backups_to_delete, 'chunks': len(chunks_to_delete), 'bytes': freed}
+
+    def get_statistics(self) -> dict:
+
+        chunks = self.load_index()
+        backups = self.list_backups()
+
+        return {'backups': len(backups),
+                'logical_bytes': sum(self.get_manifest(name)['bytes'] for name in backups),
+                'chunks': len(chunks),
+                'stored_bytes': sum(stored_size for stored_size, _ in chunks.values())}
+
+
+def move_dedup_csv_backup_files(samba_user: str,
+                                samba_password: str,
+                                samba_share: str,
+                                samba_server_ip: str,
+                                samba_remote_name: str,
+                                path_local_backup_folder: Path = Path('csv_backup'),
+                                retention_policy: RetentionPolicy = RetentionPolicy(daily=7, weekly=4, monthly=6),
+                                retention_dry_run: bool = False,
+                                smb_pool: SmbConnectionPool = None):
+    """Deduplicating alternative to move_backup_csv_files. Stores the csv files in the dedup store, where only the
+       chunks that changed since earlier backups are uploaded, then garbage collects csv backups retention_policy does
+       not keep. The csv files are deleted once stored, so that folder is ready for new backup files
+    """
+
+    pool = smb_pool if smb_pool is not None else get_smb_pool(samba_user=samba_user,
+                                                              samba_password=samba_password,
+                                                              samba_share=samba_share,
+                                                              samba_server_ip=samba_server_ip,
+                                                              samba_remote_name=samba_remote_name)
+    manifest = None
+
+    try:
+        with pool.connection() as smb:
+            store = DedupStore(smb=smb)
+            manifest = store.backup_folder(name=generate_tar_gz_filename_with_timestamp_suffix(prefix='csv_backup',
+                                                                                               file_suffix=''),
+                                           path_to_folder=path_local_backup_folder)
+
+            if manifest is not None and retention_policy is not None:
+                store.collect_garbage(policy=retention_policy, prefix='csv_backup_', dry_run=retention_dry_run)
+
+    except (NotConnectedError, OperationFailure, IOError):
+        logger.critical('failed to store csv backup in dedup store on samba share', exc_info=True)
+
+    finally:
+        if smb_pool is None:
+            pool.close_idle_connections()
+
+    if manifest is not None:
+        for file in path_local_backup_folder.glob('**/*.csv'):
+            file.unlink()
+
+    else:
+        logger.warning(f'csv backup was not stored anywhere. Keeping csv files in {path_local_backup_folder}')
+
+
+def move_dedup_db_backup_files(samba_user: str,
+                               samba_password: str,
+                               samba_share: str,
+                               samba_server_ip: str,
+                               samba_remote_name: str,
+                               path_local_backup_folder: Path = Path('db_backup'),
+                               retention_policy: RetentionPolicy = None,
+                               retention_dry_run: bool = False,
+                               smb_pool: SmbConnectionPool = None):
+    """Deduplicating alternative to move_db_backup_files, for cold and hot backups. The gzip compressed tar or
+       mongodump archive is decompressed and stored in the dedup store, and deleted locally once stored. A restore
+       gives back a gzip file of the same content. Backups retention_policy does not keep are garbage collected, None
+       keeps all
+    """
+
+    pool = smb_pool if smb_pool is not None else get_smb_pool(samba_user=samba_user,
+                                                              samba_password=samba_password,
+                                                              samba_share=samba_share,
+                                                              samba_server_ip=samba_server_ip,
+                                                              samba_remote_name=samba_remote_name)
+
+    backup_files = sorted(file_path for file_path in path_local_backup_folder.iterdir()
+                          if get_db_backup_file_suffix(file_path) is not None)
+
+    if len(backup_files) == 0:
+        logger.error(f'No db backup files found in {path_local_backup_folder}. Therefore no db backup moved')
+        return
+
+    try:
+        with pool.connection() as smb:
+            store = DedupStore(smb=smb)
+
+            for file_path in backup_files:
+                name = generate_tar_gz_filename_with_timestamp_suffix(prefix='db_backup',
+                                                                      file_suffix=get_db_backup_file_suffix(file_path))
+
+                with open(str(file_path), 'rb') as file_obj:
+                    manifest = store.backup_stream(name=name, file_obj=file_obj, gzip_compressed=True)
+
+                if manifest is not None:
+                    file_path.unlink()
+
+                else:
+                    logger.warning(f'Storing {file_path} in dedup store failed. Kept, retried on next run')
+
+            if retention_policy is not None:
+                store.collect_garbage(policy=retention_policy, prefix='db_backup_', dry_run=retention_dry_run)
+
+    except (NotConnectedError, OperationFailure, IOError):
+        logger.critical('failed to store db backup in dedup store on samba share', exc_info=True)
+
+    finally:
+        if smb_pool is None:
+            pool.close_idle_connections()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Lists, restores and garbage collects backups in the deduplicating '
+                                                 'backup store on the samba share')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('list', help='backups in the store, oldest first')
+
+    restore_parser = subparsers.add_parser('restore', help='restore a backup')
+    restore_parser.add_argument('name', help='backup name, from list, or latest_csv or latest_db')
+    restore_parser.add_argument('target', type=Path, help='folder for csv backups, file for db backups')
+
+    gc_parser = subparsers.add_parser('gc', help='delete backups and unreferenced chunks')
+    gc_parser.add_argument('--prefix', required=True, help='csv_backup_ or db_backup_')
+    gc_parser.add_argument('--policy', default='daily:7,weekly:4,monthly:6')
+    gc_parser.add_argument('--dry-run', action='store_true')
+
+    subparsers.add_parser('stats', help='logical and stored size of the store')
+
+    arguments = parser.parse_args()
+
+    smb_client = SmbClient(ip=config['SAMBA_SERVER_IP'],
+                           username=config['SAMBA_USER'],
+                           password=config['SAMBA_PASSWORD'],
+                           remote_name=config['SAMBA_REMOTE_NAME'],
+                           sharename=config['SAMBA_SHARE'])
+
+    if not smb_client.connect():
+        raise ConnectionError('Could not connect to samba share')
+
+    dedup_store = DedupStore(smb=smb_client)
+
+    if arguments.command == 'list':
+        for backup_name in dedup_store.list_backups():
+            backup_manifest = dedup_store.get_manifest(backup_name)
+            print(f'{backup_name}  {backup_manifest["bytes"] / 1e6:.1f} MB, '
+                  f'{backup_manifest["bytes_uploaded"] / 1e6:.1f} MB uploaded')
+
+    elif arguments.command == 'restore':
+        backup_name = arguments.name
+
+        if backup_name in ('latest_csv', 'latest_db'):
+            backup_name = [name for name in dedup_store.list_backups()
+                           if name.startswith(backup_name[len('latest_'):] + '_backup_')][-1]
+
+        dedup_store.restore(name=backup_name, target=arguments.target)
+
+    elif arguments.command == 'gc':
+        print(dedup_store.collect_garbage(policy=RetentionPolicy.from_string(arguments.policy),
+                                          prefix=arguments.prefix, dry_run=arguments.dry_run))
+
+    else:
+        statistics = dedup_store.get_statistics()
+        print(f'{statistics["backups"]} backups, {statistics["logical_bytes"] / 1e6:.1f} MB logical, '
+              f'{statistics["chunks"]} chunks, {statistics["stored_bytes"] / 1e6:.1f} MB stored')
+
+    smb_client.close()
@@ -1,7 +1,8 @@
 import time
 from datetime import datetime
+from functools import partial
 from pathlib import Path
-import logging
+from typing import Callable, List
 
 import docker
 from docker.errors import APIError, NotFound
@@ -9,75 +10,107 @@ from dotenv import dotenv_values
 import git
 import pytz
 
-from move_backups import move_backup_csv_files, move_db_backup_files
+from move_backups import move_backup_csv_files, move_db_backup_files, get_smb_pool
+from incremental_csv_backup import move_incremental_csv_backup_files
+from incremental_db_backup import (make_incremental_db_backup, move_incremental_db_backup_files,
+                                   ensure_replica_set_initiated)
+from stage_scheduler import Stage, run_stage_graph
+from readiness import wait_until_ready, get_dependency_probes, get_ib_gateway_probe
+from metrics import timed, record_stage_result, publish_metrics
+from retention import RetentionPolicy
+from log_harvester import LogHarvester
+from backup_verifier import verify_backups_on_share
+from dedup_store import move_dedup_csv_backup_files, move_dedup_db_backup_files
+from container_registry import get_container_registry
+from report_publisher import ReportPublisher
+from controller_logging import get_logger
 
 config = dotenv_values(".env")
-logging_level = config['LOGGING_LEVEL']
 
-logger = logging.getLogger(name=__name__)
-logger.setLevel(logging_level)
+logger = get_logger(name=__name__)
 
-f_handler = logging.FileHandler('container_management.log')
-f_handler.setLevel(logging_level)
 
-c_handler = logging.StreamHandler()
-c_handler.setLevel('INFO')
+def get_names_of_running_containers(docker_client: docker.client, container_names: set = None) -> set:
+    """Returns the names of the running containers on the host, only of container_names if passed"""
 
-f_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(funcName)s - %(message)s')
+    filters = {'name': sorted(container_names)} if container_names is not None else {}
 
-f_handler.setFormatter(f_format)
-c_handler.setFormatter(f_format)
+    try:
+        list_of_container_objects = docker_client.containers.list(sparse=True, filters=filters)
 
-logger.addHandler(f_handler)
-logger.addHandler(c_handler)
+    except APIError as e:
+        logger.critical(f'APIError - Failed to retrieve list containers. Exiting function',
+                        exc_info=True)
+        raise e
 
+    return set([container_object.attrs['Names'][0].lstrip('/') for container_object in list_of_container_objects])
 
-def wait_until_containers_has_finished(list_of_containers_to_finish: list,
-                                       docker_client: docker.client,
-                                       name_suffix: str):
 
-    container_names_with_suffix = [name + name_suffix for name in list_of_containers_to_finish]
-    set_of_containers_to_finish = set(container_names_with_suffix)
+def poll_until_containers_has_finished(set_of_containers_to_finish: set,
+                                       docker_client: docker.client,
+                                       poll_interval: int = 60):
+    """Lists running containers every poll_interval seconds, until none of the passed containers are running"""
 
     one_debug_statement = False
 
     while True:
 
-        # get running containers
-        try:
-            list_of_container_objects = docker_client.containers.list()
+        set_of_running_containers = get_names_of_running_containers(docker_client=docker_client,
+                                                                    container_names=set_of_containers_to_finish)
+        running_containers_waiting_for = set_of_running_containers.intersection(set_of_containers_to_finish)
 
-        except APIError as e:
-            logger.critical(f'APIError - Failed to retrieve list containers. Exiting function',
-                            exc_info=True)
-            raise e
+        if len(running_containers_waiting_for) == 0:
+            break
 
         else:
+            if not one_debug_statement:
+                logger.info(f'Still waiting for {running_containers_waiting_for} containers to stop running')
+                one_debug_statement = True
 
-            # get names of running containers
-            names_of_running_containers = []
+            time.sleep(poll_interval)
 
-            for container_object in list_of_container_objects:
-                names_of_running_containers.append(container_object.name)
 
-            set_of_running_containers = set(names_of_running_containers)
-            running_containers_waiting_for = set_of_running_containers.intersection(set_of_containers_to_finish)
+def wait_until_containers_has_finished(list_of_containers_to_finish: list,
+                                       docker_client: docker.client,
+                                       name_suffix: str,
+                                       use_events: bool = True,
+                                       poll_interval: int = 60):
+    """Blocks until none of the passed containers are running. By default the state kept by the ContainerRegistry
+       from the docker events stream is used, so that the function returns right after the last container has
+       exited. Falls back on listing the running containers every poll_interval seconds if use_events is False, or
+       if the registry fails
+    """
 
-            if len(running_containers_waiting_for) == 0:
-                logger.info(f'All containers {list_of_containers_to_finish}, have now stopped, as intended')
-                break
+    container_names_with_suffix = [name + name_suffix for name in list_of_containers_to_finish]
+    set_of_containers_to_finish = set(container_names_with_suffix)
 
-            else:
-                time.sleep(60)
+    if use_events:
+        try:
+            get_container_registry(docker_client=docker_client, name_suffix=name_suffix).wait_until_stopped(
+                container_names=list_of_containers_to_finish)
 
-                if one_debug_statement:
-                    logger.info(f'Still waiting for {running_containers_waiting_for} containers to stop running')
-                    one_debug_statement = True
+        except Exception:
+            logger.warning(f'Container registry failed while waiting for {list_of_containers_to_finish}. '
+                           f'Falling back on polling', exc_info=True)
+
+            poll_until_containers_has_finished(set_of_containers_to_finish=set_of_containers_to_finish,
+                                               docker_client=docker_client,
+                                               poll_interval=poll_interval)
+
+    else:
+        poll_until_containers_has_finished(set_of_containers_to_finish=set_of_containers_to_finish,
+                                           docker_client=docker_client,
+                                           poll_interval=poll_interval)
+
+    logger.info(f'All containers {list_of_containers_to_finish}, have now stopped, as intended')
 
 
 def get_container_object(container_name: str, docker_client: docker.client, name_suffix: str):
+    """The container, from the ContainerRegistry. Only fetched from docker if the registry does not have it yet"""
+
     try:
-        container_object = docker_client.containers.get(container_id=container_name + name_suffix)
+        container_object = get_container_registry(docker_client=docker_client, name_suffix=name_suffix).get(
+            container_name=container_name)
 
     except NotFound as e:
         msg = f'Failed to retrieve {container_name} container - apparently does not exist'
@@ -91,15 +124,24 @@ def get_container_object(container_name: str, docker_client: docker.client, name
     return container_object
 
 
-def run_container(container_name: str, docker_client: docker.client, name_suffix: str):
-    """Starts a container, handles exception, but re-raises exception for handling further upstream"""
+def run_container(container_name: str, docker_client: docker.client, name_suffix: str,
+                  restart_if_running: bool = True):
+    """Starts a container, handles exception, but re-raises exception for handling further upstream.
+       A running container is restarted, as it is probably stale, unless restart_if_running is False
+    """
 
+    container_registry = get_container_registry(docker_client=docker_client, name_suffix=name_suffix)
     container_object = get_container_object(container_name=container_name, docker_client=docker_client,
                                             name_suffix=name_suffix)
+    action_started = time.time_ns()
 
-    if container_object.status != 'running':
+    if container_registry.get_status(container_name=container_name) != 'running':
         container_object.start()
-        logger.info(f'Container {container_name} was not running. Started it')
+        logger.info(f'Container {container_name} was not running. Started it', extra={'container': container_name})
+
+    elif not restart_if_running:
+        logger.info(f'Container {container_name} was already running. Left it running',
+                    extra={'container': container_name})
 
     else:
         container_object.restart()
@@ -107,18 +149,19 @@ def run_container(container_name: str, docker_client: docker.client, name_suffix
         msg += f'Need to restart processes'
         logger.warning(msg)
 
+    container_registry.record_status(container_name=container_name, status='running', as_of_ns=action_started)
+
 
 def check_container_running(container_name: str, docker_client: docker.client, name_suffix: str):
     '''Checks that the container name passed is a container and that is has status "running"'''
 
-    container_object = get_container_object(container_name=container_name, docker_client=docker_client,
-                                            name_suffix=name_suffix)
-
-    if container_object.status == 'running':
-        return True
+    try:
+        return get_container_registry(docker_client=docker_client, name_suffix=name_suffix).is_running(
+            container_name=container_name)
 
-    else:
-        return False
+    except NotFound as e:
+        logger.critical(f'Failed to retrieve {container_name} container - apparently does not exist', exc_info=True)
+        raise e
 
 
 def run_container_and_wait_to_finish(container_name: str, docker_client: docker.client, name_suffix: str):
@@ -137,7 +180,9 @@ def run_container_and_wait_to_finish(container_name: str, docker_client: docker.
 def stop_container(container_name: str, docker_client: docker.client, name_suffix: str):
 
     try:
-        container_object = docker_client.containers.get(container_id=container_name + name_suffix)
+        container_registry = get_container_registry(docker_client=docker_client, name_suffix=name_suffix)
+        container_object = container_registry.get(container_name=container_name)
+        action_started = time.time_ns()
 
     except NotFound:
         msg = f'Not able to stop {container_name}. Stopping program, as a missing container'
@@ -152,9 +197,11 @@ def stop_container(container_name: str, docker_client: docker.client, name_suffi
         exit()
 
     else:
-        if container_object.status == 'running':
+        if container_registry.is_running(container_name=container_name):
             container_object.stop()
-            logger.info(f'Container {container_name}, was running. Stopped it.')
+            container_registry.record_status(container_name=container_name, status='exited',
+                                             as_of_ns=action_started)
+            logger.info(f'Container {container_name}, was running. Stopped it.', extra={'container': container_name})
 
     wait_until_containers_has_finished([container_name],
                                        docker_client=docker_client,
@@ -187,60 +234,392 @@ def git_commit_and_push_reports(commit_untracked_files: bool = True):
         logger.debug(f'Repo was not "dirty" - no commit necessary')
 
 
+def run_containers_and_wait_to_finish(list_of_containers: list, docker_client: docker.client, name_suffix: str):
+    """Starts all the passed containers, then waits until every one of them has finished"""
+
+    for container_name in list_of_containers:
+        run_container(container_name=container_name,
+                      docker_client=docker_client,
+                      name_suffix=name_suffix)
+
+    wait_until_containers_has_finished(list_of_containers_to_finish=list_of_containers,
+                                       docker_client=docker_client, name_suffix=name_suffix)
+
+
+def get_daily_stage_graph(docker_client: docker.client,
+                          name_suffix: str,
+                          csv_backup_upload: Callable = None,
+                          db_backup_upload: Callable = None,
+                          db_backup_mode: str = 'cold',
+                          incremental_db_backup: Callable = None,
+                          ib_gateway_probe: Callable = None,
+                          ib_gateway_deadline: float = 3600,
+                          verify_backups: Callable = None,
+                          publish_reports: Callable = git_commit_and_push_reports) -> List[Stage]:
+    """Declares the stages of the daily flow, and what each stage depends on. Stages with all dependencies finished
+       are run in parallel by run_stage_graph. The upload callables, taking no arguments, are added as stages
+       right after the backup they move, so that they overlap with the rest of the flow.
+       db_backup_mode: 'cold' stops mongo_db and tars the volume with db_backup. 'hot' dumps the live database with
+                       mongodump in the db_backup_hot container, and leaves mongo_db running. 'incremental' calls
+                       incremental_db_backup, which takes no arguments, on the live database
+       ib_gateway_probe: callable returning True when the ib_gateway API is usable. If passed, the continuous
+                         containers are not started until it does, or until ib_gateway_deadline seconds have passed.
+                         They would otherwise fail and restart until the gateway is logged in
+       verify_backups: callable taking no arguments, re-reading backups on the share to check their checksums. Run
+                       after the uploads, alongside the rest of the flow
+       publish_reports: callable taking no arguments, committing and pushing the reports written by daily_processes
+    """
+
+    def container_stage_action(container_name: str) -> Callable:
+        return partial(run_container_and_wait_to_finish,
+                       container_name=container_name, docker_client=docker_client, name_suffix=name_suffix)
+
+    stages = [
+        Stage(name='cleaner',
+              action=container_stage_action('cleaner')),
+
+        Stage(name='continuous_containers',
+              action=partial(run_containers_and_wait_to_finish,
+                             list_of_containers=['stack_handler', 'capital_update', 'price_updates'],
+                             docker_client=docker_client, name_suffix=name_suffix),
+              depends_on=['cleaner'] + (['ib_gateway_healthy'] if ib_gateway_probe is not None else [])),
+
+        Stage(name='end_of_day_cleaner',
+              action=container_stage_action('cleaner'),
+              depends_on=['continuous_containers']),
+
+        Stage(name='daily_processes',
+              action=container_stage_action('daily_processes'),
+              depends_on=['end_of_day_cleaner']),
+
+        Stage(name='csv_backup',
+              action=container_stage_action('csv_backup'),
+              depends_on=['daily_processes'],
+              critical=False),
+
+        # reports are written by daily_processes, and does not need mongo_db
+        Stage(name='git_commit_and_push_reports',
+              action=publish_reports,
+              depends_on=['daily_processes'],
+              critical=False),
+
+    ]
+
+    if ib_gateway_probe is not None:
+        # not critical, after the deadline the continuous containers are started regardless, as before the probe
+        stages.append(Stage(name='ib_gateway_healthy',
+                            action=partial(wait_until_ready, name='ib_gateway', probe=ib_gateway_probe,
+                                           deadline=ib_gateway_deadline, max_delay=30),
+                            critical=False))
+
+    if db_backup_mode == 'incremental':
+        stages.append(Stage(name='db_backup',
+                            action=incremental_db_backup,
+                            depends_on=['daily_processes'],
+                            critical=False))
+
+    elif db_backup_mode == 'hot':
+        stages.append(Stage(name='db_backup',
+                            action=container_stage_action('db_backup_hot'),
+                            depends_on=['daily_processes'],
+                            critical=False))
+
+    else:
+        stages += [
+            # mongo_db is read by csv_backup, so it can not be stopped before csv_backup is done
+            Stage(name='stop_mongo_db',
+                  action=partial(stop_container,
+                                 container_name='mongo_db', docker_client=docker_client, name_suffix=name_suffix),
+                  depends_on=['csv_backup']),
+
+            Stage(name='db_backup',
+                  action=container_stage_action('db_backup'),
+                  depends_on=['stop_mongo_db'],
+                  critical=False),
+        ]
+
+    if csv_backup_upload is not None:
+        stages.append(Stage(name='csv_backup_upload', action=csv_backup_upload, depends_on=['csv_backup'],
+                            critical=False))
+
+    if db_backup_upload is not None:
+        stages.append(Stage(name='db_backup_upload', action=db_backup_upload, depends_on=['db_backup'],
+                            critical=False))
+
+    if verify_backups is not None:
+        stages.append(Stage(name='verify_backups', action=verify_backups,
+                            depends_on=[stage.name for stage in stages if stage.name.endswith('_upload')],
+                            critical=False))
+
+    return stages
+
+
+# containers started by the daily flow. mongo_db and ib_gateway run across days, and are not harvested
+HARVESTED_CONTAINERS = ['cleaner', 'stack_handler', 'capital_update', 'price_updates', 'daily_processes', 'csv_backup',
+                        'db_backup', 'db_backup_hot']
+
+
 def daily_pysys_flow(docker_client: docker.client,
-                     name_suffix: str):
+                     name_suffix: str,
+                     csv_backup_upload: Callable = None,
+                     db_backup_upload: Callable = None,
+                     db_backup_mode: str = 'cold',
+                     incremental_db_backup: Callable = None,
+                     ib_gateway_probe: Callable = None,
+                     ib_gateway_deadline: float = 3600,
+                     harvest_logs: bool = False,
+                     verify_backups: Callable = None,
+                     publish_reports: Callable = git_commit_and_push_reports,
+                     max_workers: int = 4):
+
+    """Handles the daily start and stop of the containers housing different pysys processes. The stages are
+       declared in get_daily_stage_graph, and independent stages are run in parallel. The timing of every stage,
+       and of the whole flow, is recorded in the metrics store.
+       ib_gateway_probe: see get_daily_stage_graph. Made once by the management loop, so that the handshake it
+                         caches is kept across days. If None, one is made for this flow only
+       harvest_logs: stream the logs of the flow containers into the log_harvester store while they run
+       publish_reports: commits and pushes the reports, see get_daily_stage_graph
+    """
 
-    """Handles the daily start and stop of the containers housing different pysys processes"""
+    if ib_gateway_probe is None:
+        ib_gateway_probe = get_ib_gateway_probe(ipv4_network_part=config['IPV4_NETWORK_PART']).check
 
-    clean_slate_containers = ['cleaner']
+    stages = get_daily_stage_graph(docker_client=docker_client,
+                                   name_suffix=name_suffix,
+                                   csv_backup_upload=csv_backup_upload,
+                                   db_backup_upload=db_backup_upload,
+                                   db_backup_mode=db_backup_mode,
+                                   incremental_db_backup=incremental_db_backup,
+                                   ib_gateway_probe=ib_gateway_probe,
+                                   ib_gateway_deadline=ib_gateway_deadline,
+                                   verify_backups=verify_backups,
+                                   publish_reports=publish_reports)
 
-    for container_name in clean_slate_containers:
-        run_container_and_wait_to_finish(container_name=container_name,
-                                         docker_client=docker_client,
-                                         name_suffix=name_suffix)
+    log_harvester = None
 
-    continuous_containers = ['stack_handler', 'capital_update', 'price_updates']
+    if harvest_logs:
+        log_harvester = LogHarvester(docker_client=docker_client, name_suffix=name_suffix)
+        log_harvester.start(container_names=HARVESTED_CONTAINERS)
 
-    for container_name in continuous_containers:
-        run_container(container_name=container_name,
-                      docker_client=docker_client,
-                      name_suffix=name_suffix)
+    try:
+        with timed('daily_flow', db_backup_mode=db_backup_mode):
+            run_stage_graph(stages=stages, max_workers=max_workers, result_callback=record_stage_result)
 
-    wait_until_containers_has_finished(list_of_containers_to_finish=continuous_containers,
-                                       docker_client=docker_client, name_suffix=name_suffix)
+    finally:
+        publish_metrics()
+
+        if log_harvester is not None:
+            log_harvester.stop()
 
-    end_of_day_processes = ['cleaner', 'daily_processes']
 
-    for container_name in end_of_day_processes:
-        run_container_and_wait_to_finish(container_name=container_name,
-                                         docker_client=docker_client,
-                                         name_suffix=name_suffix)
+def is_workflow_time(now: datetime, weekday_start: int, weekday_end: int, stop_hour: int) -> bool:
+    """True if now is inside the weekly window in which the daily flow should run"""
+
+    return ((int(weekday_start) <= now.isoweekday() <= int(int(weekday_end) - 1)) or
+            (now.isoweekday() >= int(weekday_start) and (now.isoweekday() == int(weekday_end) and
+                                                         now.hour < int(stop_hour))))
+
+
+def start_dependency_containers(docker_client: docker.client, name_suffix: str, db_backup_mode: str = 'cold'):
+    """Starts mongo_db and checks ib_gateway before the daily flow. Terminates if either fails. Also starts the
+       monitor service, if not running. cleaner falls back to running the monitor once without it, so it is not fatal
+    """
+
+    try:
+        run_container(container_name='mongo_db', docker_client=docker_client, name_suffix=name_suffix,
+                      restart_if_running=(db_backup_mode == 'cold'))
+        # should be down either from daily_pysys_flow, or from startup. Unless db backup is not cold
+
+    except Exception:
+        logger.critical(f'Something happened when starting mongo_db, terminating', exc_info=True)
+        exit()
 
     try:
-        run_container_and_wait_to_finish(container_name='csv_backup',
-                                         docker_client=docker_client,
-                                         name_suffix=name_suffix)
+        # Has to be manually started because of two factor authentication.
+        if not check_container_running(container_name='ib_gateway', docker_client=docker_client,
+                                       name_suffix=name_suffix):
+            logger.warning('ib_gateway is not running. The continuous containers wait for it to be started')
 
     except Exception:
-        logger.warning(f'csv backup failed. Continuing program', exc_info=True)
+        logger.critical(f'Something happened when starting ib_gateway, terminating', exc_info=True)
+        exit()
 
     try:
-        git_commit_and_push_reports()
+        run_container(container_name='monitor', docker_client=docker_client, name_suffix=name_suffix,
+                      restart_if_running=False)
 
     except Exception:
-        logger.info(f'git handling failed. Continuing program', exc_info=True)
+        logger.warning('Could not start monitor. Process status is refreshed by run_monitor_fast.py instead',
+                       exc_info=True)
 
-    stop_container(container_name='mongo_db',
-                   docker_client=docker_client,
-                   name_suffix=name_suffix)
+
+def wait_for_dependencies_ready(deadline: float = 180) -> float:
+    """Probes mongo_db until it answers a ping, instead of sleeping a fixed time after starting it. Returns the time
+       to ready. Terminates if mongo_db is not ready within deadline seconds. ib_gateway is waited for by the
+       ib_gateway_healthy stage of the daily flow, so that cleaner can run in the meantime
+    """
 
     try:
-        run_container_and_wait_to_finish(container_name='db_backup',
-                                         docker_client=docker_client,
-                                         name_suffix=name_suffix)
+        return wait_until_ready(name='mongo_db', probe=get_dependency_probes(config['IPV4_NETWORK_PART'])['mongo_db'],
+                                deadline=deadline)
+
+    except TimeoutError:
+        logger.critical(f'mongo_db not ready after {deadline} seconds, terminating', exc_info=True)
+        exit()
+
+
+def run_daily_management(docker_client: docker.client,
+                         name_suffix: str,
+                         smb_pool,
+                         samba_user: str,
+                         samba_password: str,
+                         samba_share: str,
+                         samba_server_ip: str,
+                         samba_remote_name: str,
+                         path_local_csv_backup_folder: Path = Path('csv_backup'),
+                         path_local_db_backup_folder: Path = Path('db_backup'),
+                         stream_csv_backup: bool = False,
+                         csv_backup_mode: str = 'full',
+                         csv_backup_full_interval_days: int = 7,
+                         db_backup_mode: str = 'cold',
+                         db_backup_full_interval_days: int = 7,
+                         ib_gateway_probe: Callable = None,
+                         ib_gateway_deadline: float = 3600,
+                         harvest_logs: bool = False,
+                         csv_backup_retention: str = 'daily:7,weekly:4,monthly:6',
+                         db_backup_retention: str = '',
+                         retention_dry_run: bool = False,
+                         backup_verify_sample_size: int = 0,
+                         db_backup_dedup: bool = False,
+                         report_publisher: ReportPublisher = None):
+    """Sets up the backup jobs of the day and runs daily_pysys_flow. mongo_db must have been started. With a started
+       report_publisher the reports are committed and pushed by it in the background, otherwise inline.
+       ib_gateway_probe: see daily_pysys_flow
+    """
+
+    if db_backup_mode == 'incremental':
+        try:
+            ensure_replica_set_initiated(docker_client=docker_client, name_suffix=name_suffix)
+
+        except Exception:
+            logger.warning('mongo_db replica set not available, incremental db backup will fail',
+                           exc_info=True)
+
+    if csv_backup_mode == 'incremental':
+        csv_backup_upload = partial(move_incremental_csv_backup_files,
+                                    samba_user=samba_user,
+                                    samba_password=samba_password,
+                                    samba_share=samba_share,
+                                    samba_server_ip=samba_server_ip,
+                                    samba_remote_name=samba_remote_name,
+                                    path_local_backup_folder=path_local_csv_backup_folder,
+                                    full_interval_days=int(csv_backup_full_interval_days),
+                                    smb_pool=smb_pool)
+
+    elif csv_backup_mode == 'dedup':
+        csv_backup_upload = partial(move_dedup_csv_backup_files,
+                                    samba_user=samba_user,
+                                    samba_password=samba_password,
+                                    samba_share=samba_share,
+                                    samba_server_ip=samba_server_ip,
+                                    samba_remote_name=samba_remote_name,
+                                    path_local_backup_folder=path_local_csv_backup_folder,
+                                    retention_policy=RetentionPolicy.from_string(csv_backup_retention),
+                                    retention_dry_run=retention_dry_run,
+                                    smb_pool=smb_pool)
+
+    else:
+        csv_backup_upload = partial(move_backup_csv_files,
+                                    samba_user=samba_user,
+                                    samba_password=samba_password,
+                                    samba_share=samba_share,
+                                    samba_server_ip=samba_server_ip,
+                                    samba_remote_name=samba_remote_name,
+                                    path_local_backup_folder=path_local_csv_backup_folder,
+                                    streaming=stream_csv_backup,
+                                    smb_pool=smb_pool,
+                                    retention_policy=RetentionPolicy.from_string(csv_backup_retention),
+                                    retention_dry_run=retention_dry_run)
+
+    incremental_db_backup = partial(make_incremental_db_backup,
+                                    docker_client=docker_client,
+                                    name_suffix=name_suffix,
+                                    path_local_backup_folder=path_local_db_backup_folder,
+                                    full_interval_days=int(db_backup_full_interval_days))
+
+    if db_backup_mode == 'incremental':
+        db_backup_upload = partial(move_incremental_db_backup_files,
+                                   samba_user=samba_user,
+                                   samba_password=samba_password,
+                                   samba_share=samba_share,
+                                   samba_server_ip=samba_server_ip,
+                                   samba_remote_name=samba_remote_name,
+                                   path_local_backup_folder=path_local_db_backup_folder,
+                                   path_remote_backup_folder=Path('db_backup'),
+                                   smb_pool=smb_pool)
+
+    elif db_backup_dedup:
+        db_backup_upload = partial(move_dedup_db_backup_files,
+                                   samba_user=samba_user,
+                                   samba_password=samba_password,
+                                   samba_share=samba_share,
+                                   samba_server_ip=samba_server_ip,
+                                   samba_remote_name=samba_remote_name,
+                                   path_local_backup_folder=path_local_db_backup_folder,
+                                   retention_policy=RetentionPolicy.from_string(db_backup_retention),
+                                   retention_dry_run=retention_dry_run,
+                                   smb_pool=smb_pool)
+
+    else:
+        db_backup_upload = partial(move_db_backup_files,
+                                   samba_user=samba_user,
+                                   samba_password=samba_password,
+                                   samba_share=samba_share,
+                                   samba_server_ip=samba_server_ip,
+                                   samba_remote_name=samba_remote_name,
+                                   path_local_backup_folder=path_local_db_backup_folder,
+                                   path_remote_backup_folder=Path('db_backup'),
+                                   smb_pool=smb_pool,
+                                   retention_policy=RetentionPolicy.from_string(db_backup_retention),
+                                   retention_dry_run=retention_dry_run)
+
+    verify_backups = None
+
+    if int(backup_verify_sample_size) > 0:
+        verify_backups = partial(verify_backups_on_share, smb_pool=smb_pool,
+                                 sample_size=int(backup_verify_sample_size))
+
+    publish_reports = git_commit_and_push_reports
+
+    if report_publisher is not None:
+        publish_reports = report_publisher.flush
+
+    daily_pysys_flow(docker_client=docker_client,
+                     name_suffix=name_suffix,
+                     csv_backup_upload=csv_backup_upload,
+                     db_backup_upload=db_backup_upload,
+                     db_backup_mode=db_backup_mode,
+                     incremental_db_backup=incremental_db_backup,
+                     ib_gateway_probe=ib_gateway_probe,
+                     ib_gateway_deadline=float(ib_gateway_deadline),
+                     harvest_logs=harvest_logs,
+                     verify_backups=verify_backups,
+                     publish_reports=publish_reports)
+
+
+def start_report_publisher() -> ReportPublisher:
+    """Starts a ReportPublisher on the reports repo. None if it could not be started, the reports are then committed
+       and pushed inline
+    """
+
+    try:
+        report_publisher = ReportPublisher()
+        report_publisher.start()
+        return report_publisher
 
     except Exception:
-        logger.warning(f'db backup failed. Continuing program', exc_info=True)
+        logger.warning('Could not start report publisher, reports are committed and pushed inline', exc_info=True)
+        return None
 
 
 def run_daily_container_management(docker_client: docker.client,
@@ -254,70 +633,99 @@ def run_daily_container_management(docker_client: docker.client,
                                    samba_server_ip: str,
                                    samba_remote_name: str,
                                    path_local_csv_backup_folder: Path = Path('csv_backup'),
-                                   path_local_db_backup_folder: Path = Path('db_backup')):
+                                   path_local_db_backup_folder: Path = Path('db_backup'),
+                                   stream_csv_backup: bool = False,
+                                   csv_backup_mode: str = 'full',
+                                   csv_backup_full_interval_days: int = 7,
+                                   db_backup_mode: str = 'cold',
+                                   db_backup_full_interval_days: int = 7,
+                                   readiness_deadline: float = 180,
+                                   ib_gateway_deadline: float = 3600,
+                                   harvest_logs: bool = False,
+                                   csv_backup_retention: str = 'daily:7,weekly:4,monthly:6',
+                                   db_backup_retention: str = '',
+                                   retention_dry_run: bool = False,
+                                   backup_verify_sample_size: int = 0,
+                                   db_backup_dedup: bool = False,
+                                   publish_reports_in_background: bool = False):
     """Main function for managing the pysystemtrade ecosystem containers. Note that;
-       docker compose must create containers via docker compose create before script can run
+       docker compose must create containers via docker compose create before script can run.
+       stream_csv_backup: upload the csv tar archive while it is built, instead of writing it to local disk first
+       csv_backup_mode: 'full' uploads all csv files every day, 'incremental' uploads a full archive every
+                        csv_backup_full_interval_days and only new or changed csv files in between. 'dedup' stores
+                        them in the deduplicating store, see dedup_store
+       db_backup_mode: 'cold', 'hot' or 'incremental', see get_daily_stage_graph. Unless cold, mongo_db is kept
+                       running between days. incremental makes a full base every db_backup_full_interval_days, and
+                       oplog deltas in between, mongo_db must then run as a replica set
+       readiness_deadline: seconds to wait for mongo_db to answer a ping after it is started
+       ib_gateway_deadline: seconds the continuous containers wait for an ib_gateway API handshake to succeed
+       harvest_logs: store the logs of the flow containers in a searchable local database, see log_harvester
+       csv_backup_retention, db_backup_retention: grandfather-father-son retention of the full csv and the cold or
+                                                  hot db backups on the share, like 'daily:7,weekly:4,monthly:6'.
+                                                  Empty keeps all. Incremental backups keep whole chains instead
+       retention_dry_run: only log the backups retention would delete from the share
+       backup_verify_sample_size: backups of each folder on the share re-read every day to verify their checksum.
+                                  0, the default, disables verification
+       db_backup_dedup: store cold and hot db backups in the deduplicating store instead of uploading the archives
+       publish_reports_in_background: watch the reports repo, and commit and push changed reports in batches in the
+                                      background, see report_publisher. The daily flow then only commits what is
+                                      pending, and does not wait for the push
+       See async_controller.run_daily_container_management_async for the asyncio version of this loop.
     """
 
     management_run_on_this_day = datetime(1971, 1, 1)
 
+    # shared by all backup jobs, so that they run on warm connections
+    smb_pool = get_smb_pool(samba_user=samba_user,
+                            samba_password=samba_password,
+                            samba_share=samba_share,
+                            samba_server_ip=samba_server_ip,
+                            samba_remote_name=samba_remote_name)
+
+    # kept across days, like the pool, so that a recent handshake with ib_gateway is not repeated
+    ib_gateway_probe = get_ib_gateway_probe(ipv4_network_part=config['IPV4_NETWORK_PART']).check
+
+    report_publisher = start_report_publisher() if publish_reports_in_background else None
+
     while True:
 
         now = datetime.now(pytz.timezone('Europe/London'))
 
-        if ((int(weekday_start) <= now.isoweekday() <= int(int(weekday_end) - 1)) or
-            (now.isoweekday() >= int(weekday_start) and (now.isoweekday() == int(weekday_end) and
-                                                         now.hour < int(stop_hour)))):
+        if is_workflow_time(now=now, weekday_start=weekday_start, weekday_end=weekday_end, stop_hour=stop_hour):
 
             if management_run_on_this_day.date() != now.date():
 
                 management_run_on_this_day = now
 
-                try:
-                    run_container(container_name='mongo_db', docker_client=docker_client, name_suffix=name_suffix)
-                    # should be down either from daily_pysys_flow, or from startup
-
-                except Exception:
-                    logger.critical(f'Something happened when starting mongo_db, terminating', exc_info=True)
-                    exit()
-
-                try:
-                    check_container_running(container_name='ib_gateway', docker_client=docker_client,
-                                            name_suffix=name_suffix)
-                    # Has to be manually started because of two factor authentication.
-
-                except Exception:
-                    logger.critical(f'Something happened when starting ib_gateway, terminating', exc_info=True)
-                    exit()
-
-                logger.info('Giving mongo db some seconds to start')
-                time.sleep(30)
-
-                daily_pysys_flow(docker_client=docker_client,
-                                 name_suffix=name_suffix)
-
-                try:
-                    move_backup_csv_files(samba_user=samba_user,
-                                          samba_password=samba_password,
-                                          samba_share=samba_share,
-                                          samba_server_ip=samba_server_ip,
-                                          samba_remote_name=samba_remote_name,
-                                          path_local_backup_folder=path_local_csv_backup_folder)
-
-                except Exception:
-                    logger.warning('An excpetion occured when running move_backup_csv_files', exc_info=True)
-
-                try:
-                    move_db_backup_files(samba_user=samba_user,
-                                         samba_password=samba_password,
-                                         samba_share=samba_share,
-                                         samba_server_ip=samba_server_ip,
-                                         samba_remote_name=samba_remote_name,
-                                         path_local_backup_folder=path_local_db_backup_folder,
-                                         path_remote_backup_folder=Path('db_backup'))
-
-                except Exception:
-                    logger.warning('An excpetion occured when running move_db_backup_files', exc_info=True)
+                start_dependency_containers(docker_client=docker_client, name_suffix=name_suffix,
+                                            db_backup_mode=db_backup_mode)
+
+                wait_for_dependencies_ready(deadline=float(readiness_deadline))
+
+                run_daily_management(docker_client=docker_client,
+                                     name_suffix=name_suffix,
+                                     smb_pool=smb_pool,
+                                     samba_user=samba_user,
+                                     samba_password=samba_password,
+                                     samba_share=samba_share,
+                                     samba_server_ip=samba_server_ip,
+                                     samba_remote_name=samba_remote_name,
+                                     path_local_csv_backup_folder=path_local_csv_backup_folder,
+                                     path_local_db_backup_folder=path_local_db_backup_folder,
+                                     stream_csv_backup=stream_csv_backup,
+                                     csv_backup_mode=csv_backup_mode,
+                                     csv_backup_full_interval_days=csv_backup_full_interval_days,
+                                     db_backup_mode=db_backup_mode,
+                                     db_backup_full_interval_days=db_backup_full_interval_days,
+                                     ib_gateway_probe=ib_gateway_probe,
+                                     ib_gateway_deadline=ib_gateway_deadline,
+                                     harvest_logs=harvest_logs,
+                                     csv_backup_retention=csv_backup_retention,
+                                     db_backup_retention=db_backup_retention,
+                                     retention_dry_run=retention_dry_run,
+                                     backup_verify_sample_size=backup_verify_sample_size,
+                                     db_backup_dedup=db_backup_dedup,
+                                     report_publisher=report_publisher)
 
             else:
                 logger.debug('Daily run already done during this session. waiting until new day starts')
@@ -341,23 +749,59 @@ if __name__ == '__main__':
     samba_share = config['SAMBA_SHARE']         # share name of remote server
     samba_server_ip = config['SAMBA_SERVER_IP']
     samba_remote_name = config['SAMBA_REMOTE_NAME']
+    stream_csv_backup = config.get('CSV_BACKUP_STREAMING', 'False') == 'True'
+    csv_backup_mode = config.get('CSV_BACKUP_MODE', 'full')
+    csv_backup_full_interval_days = config.get('CSV_BACKUP_FULL_INTERVAL_DAYS', 7)
+    db_backup_mode = config.get('DB_BACKUP_MODE', 'cold')
+    db_backup_full_interval_days = config.get('DB_BACKUP_FULL_INTERVAL_DAYS', 7)
+    controller_mode = config.get('CONTROLLER_MODE', 'sync')
+    readiness_deadline = config.get('READINESS_DEADLINE_SECONDS', 180)
+    ib_gateway_deadline = config.get('IB_GATEWAY_DEADLINE_SECONDS', 3600)
+    harvest_logs = config.get('LOG_HARVESTING', 'False') == 'True'
+    csv_backup_retention = config.get('CSV_BACKUP_RETENTION', 'daily:7,weekly:4,monthly:6')
+    db_backup_retention = config.get('DB_BACKUP_RETENTION', '')
+    retention_dry_run = config.get('RETENTION_DRY_RUN', 'False') == 'True'
+    backup_verify_sample_size = config.get('BACKUP_VERIFY_SAMPLE_SIZE', 0)
+    db_backup_dedup = config.get('DB_BACKUP_DEDUP', 'False') == 'True'
+    publish_reports_in_background = config.get('REPORT_PUBLISHER', 'False') == 'True'
 
     path_local_csv_backup_folder = Path('csv_backup')
     path_local_db_backup_folder = Path('db_backup')
 
     docker_client = docker.DockerClient(base_url='unix://var/run/docker.sock')
 
-    run_daily_container_management(docker_client=docker_client,
-                                   name_suffix=NAME_SUFFIX,
-                                   weekday_start=WORKFLOW_WEEKDAY_START,
-                                   weekday_end=WORKFLOW_WEEKDAY_END,
-                                   stop_hour=HOUR_TO_STOP_WORKFLOW_ON_END_WEEKDAY,
-                                   samba_user=samba_user,
-                                   samba_password=samba_password,
-                                   samba_share=samba_share,
-                                   samba_server_ip=samba_server_ip,
-                                   samba_remote_name=samba_remote_name,
-                                   path_local_csv_backup_folder=path_local_csv_backup_folder,
-                                   path_local_db_backup_folder=path_local_db_backup_folder)
-
+    management_arguments = dict(docker_client=docker_client,
+                                name_suffix=NAME_SUFFIX,
+                                weekday_start=WORKFLOW_WEEKDAY_START,
+                                weekday_end=WORKFLOW_WEEKDAY_END,
+                                stop_hour=HOUR_TO_STOP_WORKFLOW_ON_END_WEEKDAY,
+                                samba_user=samba_user,
+                                samba_password=samba_password,
+                                samba_share=samba_share,
+                                samba_server_ip=samba_server_ip,
+                                samba_remote_name=samba_remote_name,
+                                path_local_csv_backup_folder=path_local_csv_backup_folder,
+                                path_local_db_backup_folder=path_local_db_backup_folder,
+                                stream_csv_backup=stream_csv_backup,
+                                csv_backup_mode=csv_backup_mode,
+                                csv_backup_full_interval_days=csv_backup_full_interval_days,
+                                db_backup_mode=db_backup_mode,
+                                db_backup_full_interval_days=db_backup_full_interval_days,
+                                readiness_deadline=readiness_deadline,
+                                ib_gateway_deadline=ib_gateway_deadline,
+                                harvest_logs=harvest_logs,
+                                csv_backup_retention=csv_backup_retention,
+                                db_backup_retention=db_backup_retention,
+                                retention_dry_run=retention_dry_run,
+                                backup_verify_sample_size=backup_verify_sample_size,
+                                db_backup_dedup=db_backup_dedup,
+                                publish_reports_in_background=publish_reports_in_background)
+
+    if controller_mode == 'async':
+        import asyncio
+        from async_controller import run_daily_container_management_async
+
+        asyncio.run(run_daily_container_management_async(**management_arguments))
 
+    else:
+        run_daily_container_management(**management_arguments)
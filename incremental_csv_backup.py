@@ -0,0 +1,435 @@
+import argparse
+import hashlib
+import io
+import json
+import tarfile
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+
+from dotenv import dotenv_values
+
+from smb.base import NotConnectedError
+
+from move_backups import (SmbClient, SmbConnectionPool, ParallelGzipWriter, HashingWriter, delete_old_tar_files,
+                          get_smb_pool, write_sha256_sidecar)
+from metrics import timed
+from controller_logging import get_logger
+
+config = dotenv_values(".env")
+
+logger = get_logger(name=__name__)
+
+# Kept in the local backup folder. Describes the files of the last backup that was successfully uploaded
+LOCAL_MANIFEST_FILE_NAME = '.csv_backup_manifest.json'
+
+# Added to every archive, so that a chain can be restored without the local manifest
+ARCHIVE_MANIFEST_MEMBER_NAME = 'csv_backup_manifest.json'
+
+FULL_PREFIX = 'csv_full'
+DELTA_PREFIX = 'csv_delta'
+ARCHIVE_SUFFIX = '.tar.gz'
+TIMESTAMP_FORMAT = "%Y_%m_%d_%H_%M_%S"
+
+
+def hash_file(file_path: Path, block_size: int = 1 << 20) -> str:
+
+    sha256 = hashlib.sha256()
+
+    with open(str(file_path), 'rb') as file_obj:
+        for block in iter(lambda: file_obj.read(block_size), b''):
+            sha256.update(block)
+
+    return sha256.hexdigest()
+
+
+def build_file_manifest(path_to_local_backup_dir: Path) -> Dict[str, dict]:
+    """Returns dict of sha256, size and mtime by csv path relative to the backup folder"""
+
+    files = {}
+
+    for file_path in sorted(path_to_local_backup_dir.glob('**/*.csv')):
+        stat = file_path.stat()
+        relative_path = file_path.relative_to(path_to_local_backup_dir).as_posix()
+
+        files[relative_path] = {'sha256': hash_file(file_path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    logger.debug('Hashed %d csv files in %s', len(files), path_to_local_backup_dir)
+
+    return files
+
+
+def get_changed_files(files: Dict[str, dict], previous_files: Dict[str, dict]) -> List[str]:
+    """Returns relative paths of files that are new or have new content since previous manifest"""
+
+    changed_files = []
+
+    for relative_path, file_entry in files.items():
+        previous_entry = previous_files.get(relative_path)
+
+        if previous_entry is None or previous_entry['sha256'] != file_entry['sha256']:
+            changed_files.append(relative_path)
+
+    return changed_files
+
+
+def read_local_manifest(path_to_local_backup_dir: Path) -> dict:
+
+    manifest_path = path_to_local_backup_dir / LOCAL_MANIFEST_FILE_NAME
+
+    if not manifest_path.exists():
+        return None
+
+    try:
+        return json.loads(manifest_path.read_text())
+
+    except ValueError:
+        logger.warning(f'Local csv backup manifest {manifest_path} is corrupt, a full backup will be made')
+        return None
+
+
+def write_local_manifest(path_to_local_backup_dir: Path, manifest: dict):
+
+    manifest_path = path_to_local_backup_dir / LOCAL_MANIFEST_FILE_NAME
+    temporary_path = manifest_path.with_name(manifest_path.name + '.tmp')
+
+    temporary_path.write_text(json.dumps(manifest, indent=1, sort_keys=True))
+    temporary_path.replace(manifest_path)
+
+
+def parse_archive_name(file_name: str):
+    """Returns (prefix, datetime) for an incremental csv backup archive name, or None if it is not one"""
+
+    for prefix in (FULL_PREFIX, DELTA_PREFIX):
+        if file_name.startswith(prefix + '_') and file_name.endswith(ARCHIVE_SUFFIX):
+            timestamp = file_name[len(prefix) + 1:-len(ARCHIVE_SUFFIX)]
+
+            try:
+                return prefix, datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+
+            except ValueError:
+                return None
+
+    return None
+
+
+def get_complete_archives(file_names: List[str]) -> list:
+    """((prefix, datetime), name) of the archives among file_names whose .sha256 sidecar is among them too, oldest
+       first. The sidecar is uploaded after the archive, so an archive without one may be a partial upload
+    """
+
+    names = set(file_names)
+
+    return sorted([(parse_archive_name(name), name) for name in file_names
+                   if parse_archive_name(name) and name + '.sha256' in names], key=lambda item: item[0][1])
+
+
+def list_partial_archives(file_names: List[str]) -> List[str]:
+    """Names of the archives without a .sha256 sidecar, made after the oldest archive that has one. Their upload
+       failed part way, and as every archive gets a new name, it is never resumed. Older archives without a sidecar
+       were uploaded before sidecars were
+    """
+
+    complete_archives = get_complete_archives(file_names=file_names)
+
+    if len(complete_archives) == 0:
+        return []
+
+    oldest_complete_time = complete_archives[0][0][1]
+    complete_names = {name for parsed, name in complete_archives}
+
+    return sorted(name for name in file_names if parse_archive_name(name) and name not in complete_names and
+                  parse_archive_name(name)[1] > oldest_complete_time)
+
+
+def needs_full_backup(previous_manifest: dict, now: datetime, full_interval_days: int) -> bool:
+
+    if previous_manifest is None:
+        return True
+
+    chain_base_time = datetime.strptime(previous_manifest['chain_base_time'], TIMESTAMP_FORMAT)
+
+    return (now - chain_base_time).days >= full_interval_days
+
+
+def make_incremental_csv_tarfile(path_to_local_backup_dir: Path,
+                                 full_interval_days: int = 7,
+                                 now: datetime = None):
+    """Makes a full archive of all csv files if the chain is older than full_interval_days, or there is no local
+       manifest. Otherwise makes a delta archive with only the csv files that are new or changed since the last
+       uploaded backup. The sha256 of the archive is computed while it is written, and stored in a .sha256 sidecar
+       next to it. Returns path to archive, and the manifest to store locally once the archive is uploaded
+    """
+
+    now = now if now is not None else datetime.now()
+    previous_manifest = read_local_manifest(path_to_local_backup_dir=path_to_local_backup_dir)
+    files = build_file_manifest(path_to_local_backup_dir=path_to_local_backup_dir)
+
+    is_full = needs_full_backup(previous_manifest=previous_manifest, now=now, full_interval_days=full_interval_days)
+    timestamp = now.strftime(TIMESTAMP_FORMAT)
+
+    if is_full:
+        files_to_archive = list(files.keys())
+        archive_name = f'{FULL_PREFIX}_{timestamp}{ARCHIVE_SUFFIX}'
+        chain_base_time = timestamp
+
+    else:
+        files_to_archive = get_changed_files(files=files, previous_files=previous_manifest['files'])
+        archive_name = f'{DELTA_PREFIX}_{timestamp}{ARCHIVE_SUFFIX}'
+        chain_base_time = previous_manifest['chain_base_time']
+
+    manifest = {'archive': archive_name,
+                'type': 'full' if is_full else 'delta',
+                'created_time': timestamp,
+                'chain_base_time': chain_base_time,
+                'previous_archive': None if previous_manifest is None else previous_manifest['archive'],
+                'files': files}
+
+    archive_path = path_to_local_backup_dir / archive_name
+    manifest_bytes = json.dumps(manifest, indent=1, sort_keys=True).encode()
+
+    with timed('make_incremental_csv_tarfile', type=manifest['type']) as measurement:
+        with open(str(archive_path), 'wb') as archive_file:
+            hashing_writer = HashingWriter(file_obj=archive_file)
+            gzip_writer = ParallelGzipWriter(file_obj=hashing_writer)
+
+            try:
+                with tarfile.open(fileobj=gzip_writer, mode='w|') as tar:
+                    manifest_info = tarfile.TarInfo(name=ARCHIVE_MANIFEST_MEMBER_NAME)
+                    manifest_info.size = len(manifest_bytes)
+                    manifest_info.mtime = int(now.timestamp())
+                    tar.addfile(manifest_info, io.BytesIO(manifest_bytes))
+
+                    for relative_path in files_to_archive:
+                        tar.add(str(path_to_local_backup_dir / relative_path), arcname=relative_path)
+
+            finally:
+                gzip_writer.close()
+
+        measurement.bytes_processed = hashing_writer.bytes_written
+
+    write_sha256_sidecar(file_path=archive_path, hexdigest=hashing_writer.hexdigest())
+
+    logger.info(f'Made {manifest["type"]} csv backup {archive_path} with {len(files_to_archive)} '
+                f'of {len(files)} csv files')
+
+    return archive_path, manifest
+
+
+def list_archives_to_delete(file_names: List[str], number_of_chains_to_keep: int) -> List[str]:
+    """A delta is useless without the full archive it builds on, so retention works on whole chains. Returns names of
+       archives older than the number_of_chains_to_keep most recent full archives
+    """
+
+    archives = sorted([(parse_archive_name(name), name) for name in file_names if parse_archive_name(name)],
+                      key=lambda item: item[0][1])
+
+    full_archive_times = [parsed[1] for parsed, name in archives if parsed[0] == FULL_PREFIX]
+
+    if len(full_archive_times) <= number_of_chains_to_keep:
+        return []
+
+    oldest_time_to_keep = full_archive_times[-number_of_chains_to_keep]
+
+    return [name for parsed, name in archives if parsed[1] < oldest_time_to_keep]
+
+
+def move_incremental_csv_backup_files(samba_user: str,
+                                      samba_password: str,
+                                      samba_share: str,
+                                      samba_server_ip: str,
+                                      samba_remote_name: str,
+                                      path_local_backup_folder: Path = Path('csv_backup'),
+                                      path_remote_backup_folder: Path = Path('csv_backup'),
+                                      full_interval_days: int = 7,
+                                      number_of_chains_to_keep: int = 2,
+                                      smb_pool: SmbConnectionPool = None):
+    """Incremental alternative to move_backup_csv_files. Uploads a full archive every full_interval_days, and in
+       between only the csv files that changed. The local manifest is only updated after a successful upload,
+       so a failed day is included in the next delta. Keeps number_of_chains_to_keep chains on the share.
+       Deletes the csv files, so that folder is ready for new backup files, but only if the archive and its
+       .sha256 sidecar were uploaded. Otherwise they are kept, and are in the archive of the next day.
+       smb_pool: shared connection pool. If None, a connection is made for this call only
+    """
+
+    delete_old_tar_files(path_to_local_backup_dir=path_local_backup_folder)
+    archive_path, manifest = make_incremental_csv_tarfile(path_to_local_backup_dir=path_local_backup_folder,
+                                                          full_interval_days=full_interval_days)
+
+    pool = smb_pool if smb_pool is not None else get_smb_pool(samba_user=samba_user,
+                                                              samba_password=samba_password,
+                                                              samba_share=samba_share,
+                                                              samba_server_ip=samba_server_ip,
+                                                              samba_remote_name=samba_remote_name)
+
+    archive_stored = False
+
+    try:
+        with pool.connection() as smb:
+
+            # the sidecar after the archive, so a sidecar on the share means the archive is complete
+            if smb.upload_chunked(local_file_path=archive_path,
+                                  remote_folder_path=path_remote_backup_folder) is not None:
+                sidecar_path = archive_path.with_name(archive_path.name + '.sha256')
+                archive_stored = smb.upload_chunked(local_file_path=sidecar_path,
+                                                    remote_folder_path=path_remote_backup_folder) is not None
+
+            if archive_stored:
+                write_local_manifest(path_to_local_backup_dir=path_local_backup_folder, manifest=manifest)
+
+                remote_file_names = [file.filename for file in
+                                     smb.get_cached_list_of_files(subfolder=str(path_remote_backup_folder))]
+                partial_archive_names = list_partial_archives(file_names=remote_file_names)
+
+                for file_name in partial_archive_names:
+                    smb.delete(f'/{path_remote_backup_folder}/{file_name}')
+                    logger.warning(f'deleted partially uploaded {file_name} from samba share, subfolder '
+                                   f'{path_remote_backup_folder}')
+
+                remote_file_names = [name for name in remote_file_names if name not in partial_archive_names]
+
+                for file_name in list_archives_to_delete(file_names=remote_file_names,
+                                                         number_of_chains_to_keep=number_of_chains_to_keep):
+                    smb.delete(f'/{path_remote_backup_folder}/{file_name}')
+
+                    # archives uploaded before sidecars were added have none
+                    if f'{file_name}.sha256' in remote_file_names:
+                        smb.delete(f'/{path_remote_backup_folder}/{file_name}.sha256')
+
+                    logger.info(f'deleted {file_name} from samba share, subfolder {path_remote_backup_folder}')
+
+    except NotConnectedError:
+        logger.critical('failed to connect to samba share, could not move to external storage', exc_info=True)
+
+    finally:
+        if smb_pool is None:
+            pool.close_idle_connections()
+
+    if archive_stored:
+        for file in path_local_backup_folder.glob('**/*.csv'):
+            file.unlink()
+
+    else:
+        logger.warning(f'csv backup {archive_path.name} was not uploaded. Keeping csv files in '
+                       f'{path_local_backup_folder}')
+
+
+def get_archive_chain(file_names: List[str], until: datetime = None) -> List[str]:
+    """Returns the names of the most recent full archive made at or before until, followed by the deltas made after
+       it, in order. until defaults to now. Only archives with a .sha256 sidecar among file_names are used, so a
+       partially uploaded archive is never applied
+    """
+
+    archives = get_complete_archives(file_names=file_names)
+
+    if until is not None:
+        archives = [(parsed, name) for parsed, name in archives if parsed[1] <= until]
+
+    full_indices = [index for index, (parsed, name) in enumerate(archives) if parsed[0] == FULL_PREFIX]
+
+    if len(full_indices) == 0:
+        raise FileNotFoundError(f'No full csv backup archive found, made before {until}')
+
+    return [name for parsed, name in archives[full_indices[-1]:]]
+
+
+def restore_csv_backup(path_archive_folder: Path, path_restore_folder: Path, until: datetime = None) -> dict:
+    """Rebuilds the csv files as they were at the time of the last archive made at or before until, by extracting
+       the full archive and applying the deltas that follow it. Files deleted along the chain are removed.
+       Returns the manifest of the last archive applied
+    """
+
+    chain = get_archive_chain(file_names=[path.name for path in path_archive_folder.iterdir()], until=until)
+    path_restore_folder.mkdir(parents=True, exist_ok=True)
+    manifest = None
+
+    for archive_name in chain:
+        with tarfile.open(str(path_archive_folder / archive_name), 'r:gz') as tar:
+            manifest = json.load(tar.extractfile(ARCHIVE_MANIFEST_MEMBER_NAME))
+            members = [member for member in tar.getmembers() if member.name != ARCHIVE_MANIFEST_MEMBER_NAME]
+            tar.extractall(path=str(path_restore_folder), members=members)
+
+        logger.info(f'Applied {archive_name} with {len(members)} files')
+
+    for file_path in path_restore_folder.glob('**/*.csv'):
+        if file_path.relative_to(path_restore_folder).as_posix() not in manifest['files']:
+            file_path.unlink()
+
+    for relative_path, file_entry in manifest['files'].items():
+        if hash_file(path_restore_folder / relative_path) != file_entry['sha256']:
+            raise ValueError(f'Restored {relative_path} does not match the sha256 of the backup manifest')
+
+    logger.info(f'Restored {len(manifest["files"])} csv files to {path_restore_folder}, '
+                f'as of {manifest["created_time"]}')
+
+    return manifest
+
+
+def download_archive_chain(smb: SmbClient, path_remote_backup_folder: Path, path_archive_folder: Path,
+                           until: datetime = None):
+    """Downloads the archives needed to restore until from the samba share, with their .sha256 sidecars, skipping
+       archives already downloaded. Each archive is hashed as it is downloaded, or read if it was downloaded before,
+       and checked against its sidecar. Raises FileNotFoundError if a download fails, and ValueError if an archive
+       does not match its sidecar
+    """
+
+    remote_file_names = [file.filename for file in
+                         smb.get_cached_list_of_files(subfolder=str(path_remote_backup_folder))]
+    path_archive_folder.mkdir(parents=True, exist_ok=True)
+
+    for archive_name in get_archive_chain(file_names=remote_file_names, until=until):
+        archive_path = path_archive_folder / archive_name
+        sidecar = smb.read_remote_file(str(path_remote_backup_folder / (archive_name + '.sha256')))
+        expected_hexdigest = sidecar.decode().split()[0]
+
+        if archive_path.exists():
+            hexdigest = hash_file(archive_path)
+
+        else:
+            sha256 = hashlib.sha256()
+
+            if not smb.download(remote_path_str=str(path_remote_backup_folder / archive_name),
+                                local_file_path=archive_path, sha256=sha256):
+                raise FileNotFoundError(f'Could not download {archive_name} from samba share')
+
+            hexdigest = sha256.hexdigest()
+
+        if hexdigest != expected_hexdigest:
+            archive_path.unlink()
+            raise ValueError(f'{archive_name} does not match its sha256 {expected_hexdigest} on the samba share')
+
+        (path_archive_folder / (archive_name + '.sha256')).write_bytes(sidecar)
+        logger.info(f'Downloaded and verified {archive_name}')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Restores incremental csv backups')
+    parser.add_argument('restore_folder', type=Path, help='folder the csv files are restored into')
+    parser.add_argument('--archive-folder', type=Path, default=Path('csv_backup'),
+                        help='local folder with the archives. Downloaded archives are stored here')
+    parser.add_argument('--until', default=None,
+                        help=f'restore the state as of this time, format {TIMESTAMP_FORMAT}. Default latest')
+    parser.add_argument('--from-share', action='store_true',
+                        help='download the needed archives from the samba share first')
+    arguments = parser.parse_args()
+
+    until = datetime.strptime(arguments.until, TIMESTAMP_FORMAT) if arguments.until else None
+
+    if arguments.from_share:
+        smb = SmbClient(ip=config['SAMBA_SERVER_IP'],
+                        username=config['SAMBA_USER'],
+                        password=config['SAMBA_PASSWORD'],
+                        remote_name=config['SAMBA_REMOTE_NAME'],
+                        sharename=config['SAMBA_SHARE'])
+
+        if not smb.connect():
+            raise ConnectionError('Could not connect to samba share')
+
+        download_archive_chain(smb=smb, path_remote_backup_folder=Path('csv_backup'),
+                               path_archive_folder=arguments.archive_folder, until=until)
+        smb.close()
+
+    restore_csv_backup(path_archive_folder=arguments.archive_folder,
+                       path_restore_folder=arguments.restore_folder,
+                       until=until)
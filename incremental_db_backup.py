@@ -0,0 +1,479 @@
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import tarfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import List, Tuple
+
+import docker
+from dotenv import dotenv_values
+from smb.base import NotConnectedError
+
+from move_backups import SmbClient, SmbConnectionPool, HashingWriter, get_smb_pool, write_sha256_sidecar
+from metrics import timed
+from controller_logging import get_logger
+
+config = dotenv_values(".env")
+
+logger = get_logger(name=__name__)
+
+# Incremental db backups need mongo_db to run as a (single node) replica set, as only then does it keep an oplog.
+# Set MONGO_REPLSET_ARGS='--replSet rs0' in the .env file, recreate the mongo_db container, and the controller will
+# initiate the replica set.
+#
+# A backup set is either a full base, a gzip mongodump archive taken with --oplog, or a delta, the oplog entries
+# since the previous backup set as gzip bson. A chain of base plus deltas is restored by mongorestore of the base
+# with --oplogReplay, and then replaying each delta in order. Replaying an oplog entry twice is harmless, so the
+# overlap between sets, from taking the oplog head before each dump, is on purpose.
+
+CATALOGUE_FILE_NAME = 'backup_catalogue.json'
+FULL_PREFIX = 'db_full'
+DELTA_PREFIX = 'db_delta'
+FULL_SUFFIX = '.archive.gz'
+DELTA_SUFFIX = '.bson.gz'
+TIMESTAMP_FORMAT = "%Y_%m_%d_%H_%M_%S"
+
+
+def exec_in_container(docker_client: docker.client, container_name: str, command: List[str]):
+    """Runs command in container, and yields its stdout in chunks. Raises RuntimeError if command fails"""
+
+    container_object = docker_client.containers.get(container_id=container_name)
+
+    exec_id = docker_client.api.exec_create(container_object.id, command)['Id']
+    output = docker_client.api.exec_start(exec_id, stream=True, demux=True)
+    stderr = []
+
+    for stdout_chunk, stderr_chunk in output:
+        if stdout_chunk:
+            yield stdout_chunk
+
+        if stderr_chunk:
+            stderr.append(stderr_chunk)
+
+    exit_code = docker_client.api.exec_inspect(exec_id)['ExitCode']
+
+    if exit_code != 0:
+        raise RuntimeError(f'{command[0]} in {container_name} failed with exit code {exit_code}; '
+                           f'{b"".join(stderr).decode(errors="replace")[-2000:]}')
+
+
+def run_mongosh(docker_client: docker.client, name_suffix: str, javascript: str) -> str:
+    """Evaluates javascript with mongosh in mongo_db, returns the last line printed"""
+
+    output = b''.join(exec_in_container(docker_client=docker_client,
+                                        container_name='mongo_db' + name_suffix,
+                                        command=['mongosh', '--quiet', '--eval', javascript]))
+
+    return output.decode().strip().split('\n')[-1]
+
+
+def ensure_replica_set_initiated(docker_client: docker.client, name_suffix: str,
+                                 attempts: int = 10, seconds_between_attempts: int = 3):
+    """Initiates the single node replica set if that has not been done. mongo_db must run with --replSet"""
+
+    javascript = 'try { print(rs.status().ok) } catch (e) { print(rs.initiate().ok) }'
+
+    for attempt in range(attempts):
+        try:
+            result = run_mongosh(docker_client=docker_client, name_suffix=name_suffix, javascript=javascript)
+
+        except RuntimeError:
+            logger.debug('mongo_db not ready for replica set check, attempt %d', attempt + 1, exc_info=True)
+            time.sleep(seconds_between_attempts)
+
+        else:
+            logger.info(f'Replica set of mongo_db checked, result {result}')
+            return
+
+    raise RuntimeError('Could not check or initiate the mongo_db replica set. Is MONGO_REPLSET_ARGS set?')
+
+
+def get_oplog_timestamp(docker_client: docker.client, name_suffix: str, newest: bool = True) -> dict:
+    """Returns the newest, or oldest, oplog entry timestamp as {'t': seconds, 'i': increment}"""
+
+    javascript = (f'const e = db.getSiblingDB("local").oplog.rs.find().sort({{$natural: {-1 if newest else 1}}})'
+                  f'.limit(1).next(); print(JSON.stringify({{t: e.ts.t, i: e.ts.i}}))')
+
+    return json.loads(run_mongosh(docker_client=docker_client, name_suffix=name_suffix, javascript=javascript))
+
+
+def is_before(timestamp: dict, other_timestamp: dict) -> bool:
+    return (timestamp['t'], timestamp['i']) < (other_timestamp['t'], other_timestamp['i'])
+
+
+def read_catalogue(path_local_backup_folder: Path) -> list:
+
+    catalogue_path = path_local_backup_folder / CATALOGUE_FILE_NAME
+
+    if not catalogue_path.exists():
+        return []
+
+    return json.loads(catalogue_path.read_text())
+
+
+def write_catalogue(path_local_backup_folder: Path, catalogue: list):
+
+    catalogue_path = path_local_backup_folder / CATALOGUE_FILE_NAME
+    temporary_path = catalogue_path.with_name(catalogue_path.name + '.tmp')
+
+    temporary_path.write_text(json.dumps(catalogue, indent=1))
+    temporary_path.replace(catalogue_path)
+
+
+def needs_full_backup(catalogue: list, now: datetime, full_interval_days: int, oldest_oplog_timestamp: dict) -> bool:
+
+    full_sets = [backup_set for backup_set in catalogue if backup_set['type'] == 'full']
+
+    if len(full_sets) == 0:
+        return True
+
+    last_full_time = datetime.strptime(full_sets[-1]['created_time'], TIMESTAMP_FORMAT)
+
+    if (now - last_full_time).days >= full_interval_days:
+        return True
+
+    if is_before(catalogue[-1]['oplog_end'], oldest_oplog_timestamp):
+        logger.warning('Oplog has rolled over since last backup set, a delta would have a gap. Making a full backup')
+        return True
+
+    return False
+
+
+def dump_to_file(chunks, path_to_file: Path, compress: bool) -> Tuple[int, str]:
+    """Writes chunks to file, through a .partial file. The file is hashed as it is written, and its sha256 written to
+       a .sha256 sidecar next to it. Returns number of bytes dumped, and the sha256 of the file
+    """
+
+    temporary_path = path_to_file.with_name(path_to_file.name + '.partial')
+    bytes_written = 0
+
+    with timed('db_dump', compressed=compress) as measurement:
+        try:
+            with open(str(temporary_path), 'wb') as raw_file:
+                hashing_writer = HashingWriter(file_obj=raw_file)
+                file_obj = gzip.GzipFile(fileobj=hashing_writer, mode='wb') if compress else hashing_writer
+
+                for chunk in chunks:
+                    file_obj.write(chunk)
+                    bytes_written += len(chunk)
+
+                if compress:
+                    file_obj.close()
+
+        except BaseException:
+            temporary_path.unlink()
+            raise
+
+        measurement.bytes_processed = bytes_written
+
+    temporary_path.replace(path_to_file)
+    write_sha256_sidecar(file_path=path_to_file, hexdigest=hashing_writer.hexdigest())
+
+    return bytes_written, hashing_writer.hexdigest()
+
+
+def make_incremental_db_backup(docker_client: docker.client,
+                               name_suffix: str,
+                               path_local_backup_folder: Path = Path('db_backup'),
+                               full_interval_days: int = 7) -> dict:
+    """Makes a full base backup every full_interval_days, or if the oplog no longer covers the time since the last
+       backup set. Otherwise dumps the oplog entries since the last backup set. The dump is streamed out of the
+       mongo_db container, while the database is live. Adds the backup set to the catalogue, and returns it
+    """
+
+    now = datetime.now()
+    timestamp = now.strftime(TIMESTAMP_FORMAT)
+    catalogue = read_catalogue(path_local_backup_folder=path_local_backup_folder)
+
+    oplog_end = get_oplog_timestamp(docker_client=docker_client, name_suffix=name_suffix, newest=True)
+    oldest_oplog_timestamp = get_oplog_timestamp(docker_client=docker_client, name_suffix=name_suffix, newest=False)
+
+    if needs_full_backup(catalogue=catalogue, now=now, full_interval_days=full_interval_days,
+                         oldest_oplog_timestamp=oldest_oplog_timestamp):
+        backup_set = {'type': 'full', 'file': f'{FULL_PREFIX}_{timestamp}{FULL_SUFFIX}', 'oplog_start': None}
+        command = ['mongodump', '--oplog', '--gzip', '--archive', '--numParallelCollections=4', '--quiet']
+        compress = False
+
+    else:
+        oplog_start = catalogue[-1]['oplog_end']
+        query = json.dumps({'ts': {'$gt': {'$timestamp': oplog_start}}})
+
+        backup_set = {'type': 'delta', 'file': f'{DELTA_PREFIX}_{timestamp}{DELTA_SUFFIX}', 'oplog_start': oplog_start}
+        command = ['mongodump', '--db=local', '--collection=oplog.rs', f'--query={query}', '--out=-', '--quiet']
+        compress = True
+
+    bytes_dumped, sha256 = dump_to_file(chunks=exec_in_container(docker_client=docker_client,
+                                                                 container_name='mongo_db' + name_suffix,
+                                                                 command=command),
+                                        path_to_file=path_local_backup_folder / backup_set['file'],
+                                        compress=compress)
+
+    backup_set.update({'created_time': timestamp, 'oplog_end': oplog_end, 'sha256': sha256, 'uploaded': False})
+    catalogue.append(backup_set)
+    write_catalogue(path_local_backup_folder=path_local_backup_folder, catalogue=catalogue)
+
+    logger.info(f'Made {backup_set["type"]} db backup {backup_set["file"]}, {bytes_dumped} bytes dumped')
+
+    return backup_set
+
+
+def get_sets_to_delete(catalogue: list, number_of_chains_to_keep: int) -> list:
+    """Returns backup sets older than the number_of_chains_to_keep most recent full sets"""
+
+    full_indices = [index for index, backup_set in enumerate(catalogue) if backup_set['type'] == 'full']
+
+    if len(full_indices) <= number_of_chains_to_keep:
+        return []
+
+    return catalogue[:full_indices[-number_of_chains_to_keep]]
+
+
+def move_incremental_db_backup_files(samba_user: str,
+                                     samba_password: str,
+                                     samba_share: str,
+                                     samba_server_ip: str,
+                                     samba_remote_name: str,
+                                     path_local_backup_folder: Path = Path('db_backup'),
+                                     path_remote_backup_folder: Path = Path('db_backup'),
+                                     number_of_chains_to_keep: int = 2,
+                                     smb_pool: SmbConnectionPool = None):
+    """Uploads the backup sets of the catalogue that have not been uploaded yet, usually only the latest delta, each
+       followed by its .sha256 sidecar, and a copy of the catalogue. A set counts as uploaded once both are on the
+       share. Local files of uploaded sets are deleted, except the catalogue. Sets of chains older than the
+       number_of_chains_to_keep most recent chains are deleted from the share and the catalogue
+    """
+
+    pool = smb_pool if smb_pool is not None else get_smb_pool(samba_user=samba_user,
+                                                              samba_password=samba_password,
+                                                              samba_share=samba_share,
+                                                              samba_server_ip=samba_server_ip,
+                                                              samba_remote_name=samba_remote_name)
+
+    catalogue = read_catalogue(path_local_backup_folder=path_local_backup_folder)
+
+    try:
+        with pool.connection() as smb:
+
+            for backup_set in catalogue:
+                if backup_set['uploaded']:
+                    continue
+
+                local_file_path = path_local_backup_folder / backup_set['file']
+
+                if not local_file_path.exists():
+                    logger.error(f'Backup set file {local_file_path} is missing, chain from here is incomplete')
+                    continue
+
+                sidecar_path = local_file_path.with_name(local_file_path.name + '.sha256')
+
+                # sets dumped before sidecars were written are hashed here
+                if not sidecar_path.exists():
+                    write_sha256_sidecar(file_path=local_file_path, hexdigest=backup_set.get('sha256'))
+
+                backup_set['sha256'] = sidecar_path.read_text().split()[0]
+
+                # the sidecar after the set, so a sidecar on the share means the set is complete
+                if smb.upload_chunked(local_file_path=local_file_path,
+                                      remote_folder_path=path_remote_backup_folder) is not None and \
+                        smb.upload_chunked(local_file_path=sidecar_path,
+                                           remote_folder_path=path_remote_backup_folder) is not None:
+                    backup_set['uploaded'] = True
+                    write_catalogue(path_local_backup_folder=path_local_backup_folder, catalogue=catalogue)
+                    local_file_path.unlink()
+                    sidecar_path.unlink()
+
+                else:
+                    logger.warning(f'Upload of backup set {backup_set["file"]} failed. Kept, retried on next run')
+
+            remote_file_names = [file.filename for file in
+                                 smb.get_cached_list_of_files(subfolder=str(path_remote_backup_folder))]
+
+            for backup_set in get_sets_to_delete(catalogue=catalogue,
+                                                 number_of_chains_to_keep=number_of_chains_to_keep):
+                smb.delete(f'/{path_remote_backup_folder}/{backup_set["file"]}')
+
+                # sets uploaded before sidecars were added have none
+                if f'{backup_set["file"]}.sha256' in remote_file_names:
+                    smb.delete(f'/{path_remote_backup_folder}/{backup_set["file"]}.sha256')
+
+                catalogue.remove(backup_set)
+                logger.info(f'deleted {backup_set["file"]} from samba share, subfolder {path_remote_backup_folder}')
+
+            write_catalogue(path_local_backup_folder=path_local_backup_folder, catalogue=catalogue)
+            smb.upload(local_file_path=path_local_backup_folder / CATALOGUE_FILE_NAME,
+                       remote_folder_path=path_remote_backup_folder)
+
+    except NotConnectedError:
+        logger.critical('failed to connect to samba share, could not move to external storage', exc_info=True)
+
+    finally:
+        if smb_pool is None:
+            pool.close_idle_connections()
+
+
+def get_chain(catalogue: list, until: datetime = None) -> list:
+    """Returns the most recent full set created at or before until, followed by the deltas made after it"""
+
+    sets = [backup_set for backup_set in catalogue
+            if until is None or datetime.strptime(backup_set['created_time'], TIMESTAMP_FORMAT) <= until]
+    full_indices = [index for index, backup_set in enumerate(sets) if backup_set['type'] == 'full']
+
+    if len(full_indices) == 0:
+        raise FileNotFoundError(f'No full db backup set found, made before {until}')
+
+    return sets[full_indices[-1]:]
+
+
+def verify_backup_set(backup_set: dict, path_backup_files_folder: Path, data: bytes = None):
+    """Checks the file of backup_set against the sha256 in the catalogue, or in its .sha256 sidecar for sets made
+       before the catalogue had it. data: the content of the file if it was read already. Raises ValueError if it does
+       not match, so a truncated or corrupt set is never applied
+    """
+
+    file_path = path_backup_files_folder / backup_set['file']
+    sidecar_path = file_path.with_name(file_path.name + '.sha256')
+    expected = backup_set.get('sha256')
+
+    if expected is None and sidecar_path.exists():
+        expected = sidecar_path.read_text().split()[0]
+
+    if expected is None:
+        logger.warning(f'No stored checksum for {file_path}, integrity can not be verified')
+        return
+
+    sha256 = hashlib.sha256()
+
+    if data is not None:
+        sha256.update(data)
+
+    else:
+        with open(str(file_path), 'rb') as file_obj:
+            for block in iter(lambda: file_obj.read(1 << 20), b''):
+                sha256.update(block)
+
+    if sha256.hexdigest() != expected:
+        raise ValueError(f'Backup set {file_path} does not match its sha256 {expected}, chain can not be restored')
+
+
+def restore_chain_into_container(docker_client: docker.client,
+                                 container_name: str,
+                                 path_backup_files_folder: Path,
+                                 chain: list):
+    """Copies the chain into container, a running mongo container, and replays it; mongorestore of the base with
+       its oplog, then each delta's oplog entries in order. Every set is checked against its sha256 before anything
+       is copied
+    """
+
+    restore_folder = '/restore'
+    tar_buffer = io.BytesIO()
+
+    verify_backup_set(backup_set=chain[0], path_backup_files_folder=path_backup_files_folder)
+
+    with tarfile.open(fileobj=tar_buffer, mode='w') as tar:
+        tar.add(str(path_backup_files_folder / chain[0]['file']), arcname=f'restore/{chain[0]["file"]}')
+
+        for delta_number, backup_set in enumerate(chain[1:]):
+            delta_bytes = (path_backup_files_folder / backup_set['file']).read_bytes()
+            verify_backup_set(backup_set=backup_set, path_backup_files_folder=path_backup_files_folder,
+                              data=delta_bytes)
+            bson_bytes = gzip.decompress(delta_bytes)
+            info = tarfile.TarInfo(name=f'restore/delta_{delta_number:05d}/oplog.bson')
+            info.size = len(bson_bytes)
+            tar.addfile(info, io.BytesIO(bson_bytes))
+
+    docker_client.containers.get(container_id=container_name).put_archive('/', tar_buffer.getvalue())
+
+    list(exec_in_container(docker_client=docker_client, container_name=container_name,
+                           command=['mongorestore', '--gzip', f'--archive={restore_folder}/{chain[0]["file"]}',
+                                    '--oplogReplay', '--drop', '--quiet']))
+    logger.info(f'Restored base {chain[0]["file"]}')
+
+    for delta_number, backup_set in enumerate(chain[1:]):
+        list(exec_in_container(docker_client=docker_client, container_name=container_name,
+                               command=['mongorestore', '--oplogReplay', '--quiet',
+                                        f'{restore_folder}/delta_{delta_number:05d}']))
+        logger.info(f'Replayed delta {backup_set["file"]}')
+
+
+def restore_into_local_mongod(docker_client: docker.client,
+                              path_backup_files_folder: Path,
+                              until: datetime = None,
+                              container_name: str = 'db_restore_test') -> str:
+    """Starts a throwaway mongo container, not on the ecosystem network, and restores the chain as of until into it,
+       so that a backup chain can be tested without touching mongo_db. Returns the container name; remove it when done
+    """
+
+    catalogue = read_catalogue(path_local_backup_folder=path_backup_files_folder)
+    chain = get_chain(catalogue=catalogue, until=until)
+
+    docker_client.containers.run('mongo', name=container_name, detach=True)
+
+    for attempt in range(30):
+        try:
+            list(exec_in_container(docker_client=docker_client, container_name=container_name,
+                                   command=['mongosh', '--quiet', '--eval', 'db.runCommand({ping: 1})']))
+            break
+
+        except RuntimeError:
+            time.sleep(1)
+
+    restore_chain_into_container(docker_client=docker_client, container_name=container_name,
+                                 path_backup_files_folder=path_backup_files_folder, chain=chain)
+
+    logger.info(f'Restored {len(chain)} backup sets into {container_name}')
+
+    return container_name
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Restores an incremental db backup chain into a throwaway mongod')
+    parser.add_argument('--backup-folder', type=Path, default=Path('db_backup'),
+                        help='folder with the catalogue and backup set files. Downloaded sets are stored here')
+    parser.add_argument('--until', default=None,
+                        help=f'restore the state as of this time, format {TIMESTAMP_FORMAT}. Default latest')
+    parser.add_argument('--from-share', action='store_true',
+                        help='download the catalogue and needed backup sets from the samba share first')
+    parser.add_argument('--container-name', default='db_restore_test')
+    arguments = parser.parse_args()
+
+    until = datetime.strptime(arguments.until, TIMESTAMP_FORMAT) if arguments.until else None
+
+    if arguments.from_share:
+        smb = SmbClient(ip=config['SAMBA_SERVER_IP'],
+                        username=config['SAMBA_USER'],
+                        password=config['SAMBA_PASSWORD'],
+                        remote_name=config['SAMBA_REMOTE_NAME'],
+                        sharename=config['SAMBA_SHARE'])
+
+        if not smb.connect():
+            raise ConnectionError('Could not connect to samba share')
+
+        arguments.backup_folder.mkdir(parents=True, exist_ok=True)
+
+        if not smb.download(remote_path_str=f'db_backup/{CATALOGUE_FILE_NAME}',
+                            local_file_path=arguments.backup_folder / CATALOGUE_FILE_NAME):
+            raise FileNotFoundError(f'Could not download {CATALOGUE_FILE_NAME} from samba share')
+
+        for backup_set in get_chain(catalogue=read_catalogue(arguments.backup_folder), until=until):
+            set_path = arguments.backup_folder / backup_set['file']
+
+            if not set_path.exists() and not smb.download(remote_path_str=f'db_backup/{backup_set["file"]}',
+                                                          local_file_path=set_path):
+                raise FileNotFoundError(f'Could not download {backup_set["file"]} from samba share')
+
+            # sets are checked when restored, those made before the catalogue held their sha256 against the sidecar
+            if 'sha256' not in backup_set:
+                smb.download(remote_path_str=f'db_backup/{backup_set["file"]}.sha256',
+                             local_file_path=set_path.with_name(set_path.name + '.sha256'))
+
+        smb.close()
+
+    restore_into_local_mongod(docker_client=docker.DockerClient(base_url='unix://var/run/docker.sock'),
+                              path_backup_files_folder=arguments.backup_folder,
+                              until=until,
+                              container_name=arguments.container_name)
@@ -0,0 +1,392 @@
+import argparse
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+import docker
+from docker.errors import APIError, NotFound
+from dotenv import dotenv_values
+
+from container_registry import get_container_registry
+from controller_logging import get_logger
+
+config = dotenv_values(".env")
+
+logger = get_logger(name=__name__)
+
+LOG_HARVEST_DATABASE = Path(config.get('LOG_HARVEST_DATABASE') or 'container_logs.sqlite3')
+# logs of run dates older than this many days are deleted after each harvest, 0 keeps all
+LOG_HARVEST_RETENTION_DAYS = int(config.get('LOG_HARVEST_RETENTION_DAYS') or 90)
+
+# lines matching any of these are dropped before they are stored
+NOISE_PATTERNS = [re.compile(pattern) for pattern in ['because Previous process still running']]
+
+LEVEL_PATTERN = re.compile(r'\b(DEBUG|INFO|WARNING|WARN|ERROR|CRITICAL)\b')
+
+# lines of a container are stored in zlib compressed blocks of up to this many lines, or this many seconds of logs
+BLOCK_MAX_LINES = 1000
+BLOCK_MAX_SECONDS = 30
+
+
+def normalize_timestamp(timestamp: str) -> str:
+    """Pads the fraction of an RFC 3339 timestamp from docker to nanoseconds, so timestamps compare as strings"""
+
+    if not timestamp.endswith('Z'):
+        return timestamp
+
+    seconds, _, fraction = timestamp[:-1].partition('.')
+
+    return f'{seconds}.{fraction:0<9}Z'
+
+
+def parse_log_line(line: str) -> Tuple[str, str, str]:
+    """Splits a line of docker logs with timestamps into timestamp, level and message. Level is the first log level
+       word in the message, UNKNOWN if there is none
+    """
+
+    timestamp, _, message = line.partition(' ')
+    timestamp = normalize_timestamp(timestamp)
+    level_match = LEVEL_PATTERN.search(message)
+    level = level_match.group(1) if level_match else 'UNKNOWN'
+
+    return timestamp, 'WARNING' if level == 'WARN' else level, message
+
+
+def is_noise(message: str) -> bool:
+    return any(pattern.search(message) for pattern in NOISE_PATTERNS)
+
+
+def parse_new_lines(raw_lines: List[bytes], last_timestamp: str = None) -> Tuple[List[Tuple[str, str, str]], int]:
+    """Parses raw log lines with timestamps into (timestamp, level, message), leaving out noise and lines at or
+       before last_timestamp, which are already stored. Returns the lines kept, and the number of noise lines
+    """
+
+    parsed_lines = []
+    dropped_lines = 0
+
+    for line in raw_lines:
+        timestamp, level, message = parse_log_line(line.decode(errors='replace').rstrip('\r'))
+
+        # since has whole seconds, so lines of that second may already be stored
+        if last_timestamp is not None and timestamp <= last_timestamp:
+            continue
+
+        if is_noise(message):
+            dropped_lines += 1
+            continue
+
+        parsed_lines.append((timestamp, level, message))
+
+    return parsed_lines, dropped_lines
+
+
+class LogStore(object):
+    """Container log lines in a local SQLite database. The text is stored in zlib compressed blocks, and indexed
+       in a contentless FTS5 table, so that the text is only kept once, compressed. Each line has a row with its
+       container, run date, level and timestamp, and its block and position in the block
+    """
+
+    def __init__(self, path_to_database: Path = LOG_HARVEST_DATABASE):
+        self.path_to_database = path_to_database
+        self.lock = threading.Lock()
+
+        with self.lock, self.connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS blocks '
+                               '(id INTEGER PRIMARY KEY, container TEXT, run_date TEXT, data BLOB)')
+            connection.execute('CREATE TABLE IF NOT EXISTS lines (id INTEGER PRIMARY KEY, block_id INTEGER, '
+                               'position INTEGER, container TEXT, run_date TEXT, level TEXT, timestamp TEXT)')
+            connection.execute('CREATE INDEX IF NOT EXISTS lines_by_container ON lines (container, timestamp)')
+            connection.execute('CREATE INDEX IF NOT EXISTS lines_by_timestamp ON lines (timestamp)')
+            connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS line_text USING fts5(message, content='')")
+            connection.execute('CREATE TABLE IF NOT EXISTS harvest_state (container TEXT PRIMARY KEY, '
+                               'last_timestamp TEXT)')
+
+    @contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        """Connection for one transaction, committed unless the with block raises, and closed after it"""
+
+        connection = sqlite3.connect(str(self.path_to_database), timeout=30)
+
+        try:
+            with connection:
+                yield connection
+
+        finally:
+            connection.close()
+
+    def get_last_timestamp(self, container_name: str):
+        """Timestamp of the last stored line of container, None if nothing is stored"""
+
+        with self.lock, self.connect() as connection:
+            row = connection.execute('SELECT last_timestamp FROM harvest_state WHERE container = ?',
+                                     (container_name,)).fetchone()
+
+        return row[0] if row is not None else None
+
+    def store_block(self, container_name: str, run_date: str, parsed_lines: List[Tuple[str, str, str]]):
+        """Stores (timestamp, level, message) lines of container as one compressed block"""
+
+        if len(parsed_lines) == 0:
+            return
+
+        data = zlib.compress('\n'.join(message for _, _, message in parsed_lines).encode(), 6)
+
+        with self.lock, self.connect() as connection:
+            block_id = connection.execute('INSERT INTO blocks (container, run_date, data) VALUES (?, ?, ?)',
+                                          (container_name, run_date, data)).lastrowid
+
+            for position, (timestamp, level, message) in enumerate(parsed_lines):
+                line_id = connection.execute('INSERT INTO lines (block_id, position, container, run_date, level, '
+                                             'timestamp) VALUES (?, ?, ?, ?, ?, ?)',
+                                             (block_id, position, container_name, run_date, level,
+                                              timestamp)).lastrowid
+                connection.execute('INSERT INTO line_text (rowid, message) VALUES (?, ?)', (line_id, message))
+
+            connection.execute('INSERT OR REPLACE INTO harvest_state VALUES (?, ?)',
+                               (container_name, parsed_lines[-1][0]))
+
+    def search(self, query: str = None, container_name: str = None, level: str = None, since: str = None,
+               until: str = None, limit: int = 100) -> List[Tuple[str, str, str, str]]:
+        """Lines matching the FTS5 query, and the filters that are passed, newest first, as
+           (timestamp, container, level, message). since and until are run dates, YYYY-MM-DD, both inclusive
+        """
+
+        conditions = []
+        parameters = []
+
+        if query:
+            conditions.append('lines.id IN (SELECT rowid FROM line_text WHERE line_text MATCH ?)')
+            parameters.append(query)
+
+        for column, operator, value in [('container', '=', container_name), ('level', '=', level),
+                                        ('run_date', '>=', since), ('run_date', '<=', until)]:
+            if value is not None:
+                conditions.append(f'lines.{column} {operator} ?')
+                parameters.append(value)
+
+        where = ('WHERE ' + ' AND '.join(conditions)) if len(conditions) != 0 else ''
+
+        with self.lock, self.connect() as connection:
+            rows = connection.execute(f'SELECT block_id, position, timestamp, container, level FROM lines {where} '
+                                      f'ORDER BY timestamp DESC LIMIT ?', parameters + [limit]).fetchall()
+
+            block_ids = sorted(set(row[0] for row in rows))
+            blocks = {}
+
+            for block_id in block_ids:
+                data = connection.execute('SELECT data FROM blocks WHERE id = ?', (block_id,)).fetchone()[0]
+                blocks[block_id] = zlib.decompress(data).decode().split('\n')
+
+        return [(timestamp, container, level, blocks[block_id][position])
+                for block_id, position, timestamp, container, level in rows]
+
+    def prune(self, retention_days: int = LOG_HARVEST_RETENTION_DAYS, today: date = None) -> int:
+        """Deletes the logs of run dates more than retention_days before today, and compacts the database file if
+           anything was deleted. 0 keeps all. Returns the number of lines deleted
+        """
+
+        if int(retention_days) <= 0:
+            return 0
+
+        today = today if today is not None else date.today()
+        cutoff = (today - timedelta(days=int(retention_days))).isoformat()
+        deleted_lines = 0
+
+        with self.lock:
+            with self.connect() as connection:
+                blocks = connection.execute('SELECT id, data FROM blocks WHERE run_date < ?', (cutoff,)).fetchall()
+
+                for block_id, data in blocks:
+                    messages = zlib.decompress(data).decode().split('\n')
+
+                    # line_text is contentless, so its index entries are deleted by passing the indexed text again
+                    for line_id, position in connection.execute('SELECT id, position FROM lines WHERE block_id = ?',
+                                                                (block_id,)).fetchall():
+                        connection.execute("INSERT INTO line_text (line_text, rowid, message) "
+                                           "VALUES ('delete', ?, ?)", (line_id, messages[position]))
+                        deleted_lines += 1
+
+                    connection.execute('DELETE FROM lines WHERE block_id = ?', (block_id,))
+                    connection.execute('DELETE FROM blocks WHERE id = ?', (block_id,))
+
+            if len(blocks) != 0:
+                with self.connect() as connection:
+                    connection.execute("INSERT INTO line_text (line_text) VALUES ('optimize')")
+
+                connection = sqlite3.connect(str(self.path_to_database), timeout=30)
+
+                try:
+                    connection.execute('VACUUM')
+
+                finally:
+                    connection.close()
+
+        if deleted_lines != 0:
+            logger.info(f'Deleted {deleted_lines} harvested log lines of run dates before {cutoff}')
+
+        return deleted_lines
+
+    def get_statistics(self) -> List[Tuple[str, int, int, int]]:
+        """(container, number of lines, number of blocks, compressed bytes) per container"""
+
+        with self.lock, self.connect() as connection:
+            return connection.execute('SELECT container, (SELECT count(*) FROM lines l WHERE l.container = '
+                                      'b.container), count(*), sum(length(data)) FROM blocks b GROUP BY container '
+                                      'ORDER BY container').fetchall()
+
+
+class LogHarvester(object):
+    """Streams the logs of containers through the docker api while they run, drops noise, and stores them in a
+       LogStore. One thread per container waits for it to run, and follows its log until it stops, again and again
+       until stop is called. Harvesting resumes after the last stored line, so nothing is stored twice
+    """
+
+    def __init__(self, docker_client: docker.client, name_suffix: str, store: LogStore = None,
+                 run_date: str = None, poll_interval: float = 10,
+                 retention_days: int = LOG_HARVEST_RETENTION_DAYS):
+        self.docker_client = docker_client
+        self.name_suffix = name_suffix
+        self.store = store if store is not None else LogStore()
+        self.run_date = run_date if run_date is not None else date.today().isoformat()
+        self.poll_interval = poll_interval
+        self.retention_days = retention_days
+        self.stop_event = threading.Event()
+        self.threads = []
+
+    def start(self, container_names: List[str]):
+
+        for container_name in container_names:
+            thread = threading.Thread(target=self.harvest, args=(container_name,), name=f'harvest_{container_name}',
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout: float = 30):
+        """Stops waiting for containers to start. Logs of containers still running are harvested until they stop,
+           or timeout seconds have passed. Then the logs older than retention_days are deleted from the store
+        """
+
+        self.stop_event.set()
+
+        for thread in self.threads:
+            thread.join(timeout=timeout)
+
+        try:
+            self.store.prune(retention_days=self.retention_days)
+
+        except sqlite3.Error:
+            logger.warning('Could not delete old harvested logs', exc_info=True)
+
+    def harvest(self, container_name: str):
+
+        container_registry = get_container_registry(docker_client=self.docker_client, name_suffix=self.name_suffix)
+
+        while not self.stop_event.is_set():
+            try:
+                # the status is kept by the registry, so waiting for the container to run costs no docker calls
+                if container_registry.is_running(container_name=container_name):
+                    self.follow(container_name=container_name,
+                                container=container_registry.get(container_name=container_name))
+
+            except NotFound:
+                pass
+
+            except Exception:
+                logger.warning(f'Harvesting logs of {container_name} failed, retrying', exc_info=True,
+                               extra={'container': container_name})
+
+            self.stop_event.wait(self.poll_interval)
+
+        # lines written between the last poll and stop
+        try:
+            self.follow(container_name=container_name, container=container_registry.get(container_name=container_name),
+                        follow=False)
+
+        except (NotFound, APIError):
+            pass
+
+    def follow(self, container_name: str, container, follow: bool = True):
+        """Stores the log lines of container after the last stored one, until the container stops"""
+
+        last_timestamp = self.store.get_last_timestamp(container_name=container_name)
+        since = int(datetime.fromisoformat(last_timestamp[:19]).replace(tzinfo=timezone.utc).timestamp()) \
+            if last_timestamp is not None else None
+
+        stream = container.logs(stream=True, follow=follow, timestamps=True, since=since)
+        block = []
+        block_start = time.time()
+        partial_line = b''
+        stored_lines = 0
+        dropped_lines = 0
+
+        for chunk in stream:
+            lines = (partial_line + chunk).split(b'\n')
+            partial_line = lines.pop()
+
+            parsed_lines, dropped = parse_new_lines(raw_lines=lines, last_timestamp=last_timestamp)
+            block += parsed_lines
+            dropped_lines += dropped
+
+            if len(block) >= BLOCK_MAX_LINES or (len(block) != 0 and time.time() - block_start > BLOCK_MAX_SECONDS):
+                self.store.store_block(container_name=container_name, run_date=self.run_date, parsed_lines=block)
+                stored_lines += len(block)
+                block = []
+                block_start = time.time()
+
+        if partial_line:
+            parsed_lines, dropped = parse_new_lines(raw_lines=[partial_line], last_timestamp=last_timestamp)
+            block += parsed_lines
+            dropped_lines += dropped
+
+        self.store.store_block(container_name=container_name, run_date=self.run_date, parsed_lines=block)
+        stored_lines += len(block)
+
+        logger.info(f'Harvested {stored_lines} log lines of {container_name}, dropped {dropped_lines} noise lines',
+                    extra={'container': container_name})
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Searches container logs harvested by the controller')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    search_parser = subparsers.add_parser('search', help='search log lines, newest first')
+    search_parser.add_argument('query', nargs='?', help='FTS5 query, like \'error AND "price"\'. All lines if omitted')
+    search_parser.add_argument('--container', help='container name without suffix, like stack_handler')
+    search_parser.add_argument('--level', help='DEBUG, INFO, WARNING, ERROR, CRITICAL or UNKNOWN')
+    search_parser.add_argument('--since', help='first run date, YYYY-MM-DD')
+    search_parser.add_argument('--until', help='last run date, YYYY-MM-DD')
+    search_parser.add_argument('--limit', type=int, default=100)
+
+    subparsers.add_parser('stats', help='lines, blocks and compressed size per container')
+
+    prune_parser = subparsers.add_parser('prune', help='delete the logs of old run dates')
+    prune_parser.add_argument('--days', type=int, default=LOG_HARVEST_RETENTION_DAYS,
+                              help='run dates to keep, counted back from today')
+
+    arguments = parser.parse_args()
+    log_store = LogStore()
+
+    if arguments.command == 'search':
+        start = time.time()
+        found = log_store.search(query=arguments.query, container_name=arguments.container, level=arguments.level,
+                                 since=arguments.since, until=arguments.until, limit=arguments.limit)
+
+        for found_timestamp, found_container, found_level, found_message in reversed(found):
+            print(f'{found_timestamp} {found_container} {found_level} {found_message}')
+
+        print(f'{len(found)} lines in {(time.time() - start) * 1000:.0f} ms')
+
+    elif arguments.command == 'prune':
+        print(f'Deleted {log_store.prune(retention_days=arguments.days)} lines')
+
+    else:
+        for stats_container, number_of_lines, number_of_blocks, compressed_bytes in log_store.get_statistics():
+            print(f'{stats_container}: {number_of_lines} lines in {number_of_blocks} blocks, '
+                  f'{compressed_bytes / 1e6:.1f} MB compressed')
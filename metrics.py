@@ -0,0 +1,278 @@
+import argparse
+import json
+import re
+import sqlite3
+import statistics
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+from dotenv import dotenv_values
+
+from controller_logging import get_logger
+
+config = dotenv_values(".env")
+
+logger = get_logger(name=__name__)
+
+METRICS_DATABASE = Path(config.get('METRICS_DATABASE') or 'metrics.sqlite3')
+METRICS_TEXTFILE = Path(config['METRICS_TEXTFILE']) if config.get('METRICS_TEXTFILE') else None
+METRIC_NAME_PREFIX = 'pysys_'
+
+
+class Measurement(object):
+    """Timing, and optionally bytes processed, of one named operation. labels tell apart measurements of the same
+       name, like the stage of a stage graph or the compression of a tar archive
+    """
+
+    def __init__(self, name: str, labels: Dict[str, str] = None, start: float = None, end: float = None,
+                 bytes_processed: int = None, succeeded: bool = True):
+        self.name = name
+        self.labels = labels if labels is not None else {}
+        self.start = start
+        self.end = end
+        self.bytes_processed = bytes_processed
+        self.succeeded = succeeded
+
+    @property
+    def wall_time(self) -> float:
+        return self.end - self.start
+
+    @property
+    def throughput(self):
+        """Bytes per second, None if bytes processed is not known"""
+
+        if self.bytes_processed is None:
+            return None
+
+        return self.bytes_processed / max(self.wall_time, 1e-9)
+
+
+class MetricsStore(object):
+    """Time series of measurements in a local SQLite database, one row per measurement. Failing to record a
+       measurement is logged and otherwise ignored, metrics must never break the flow they measure
+    """
+
+    def __init__(self, path_to_database: Path = METRICS_DATABASE):
+        self.path_to_database = path_to_database
+        self.lock = threading.Lock()
+
+        with self.lock, self.connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS measurements '
+                               '(name TEXT, labels TEXT, start REAL, end REAL, wall_time REAL, bytes INTEGER, '
+                               'throughput REAL, succeeded INTEGER)')
+            connection.execute('CREATE INDEX IF NOT EXISTS measurements_by_name ON measurements (name, start)')
+
+    @contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        """Connection for one transaction, committed unless the with block raises, and closed after it. The
+           connection's own context manager only commits, it does not close
+        """
+
+        connection = sqlite3.connect(str(self.path_to_database), timeout=30)
+
+        try:
+            with connection:
+                yield connection
+
+        finally:
+            connection.close()
+
+    def record(self, measurement: Measurement):
+
+        try:
+            with self.lock, self.connect() as connection:
+                connection.execute('INSERT INTO measurements VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                   (measurement.name, json.dumps(measurement.labels, sort_keys=True),
+                                    measurement.start, measurement.end, measurement.wall_time,
+                                    measurement.bytes_processed, measurement.throughput, int(measurement.succeeded)))
+
+        except sqlite3.Error:
+            logger.warning(f'Could not record measurement {measurement.name} {measurement.labels}', exc_info=True)
+
+    def get_measurements(self, since: float = 0, name: str = None) -> List[Measurement]:
+        """Measurements started after since, a unix timestamp, oldest first. Only of name if passed"""
+
+        query = 'SELECT name, labels, start, end, bytes, succeeded FROM measurements WHERE start >= ?'
+        parameters = [since]
+
+        if name is not None:
+            query += ' AND name = ?'
+            parameters.append(name)
+
+        with self.lock, self.connect() as connection:
+            rows = connection.execute(query + ' ORDER BY start', parameters).fetchall()
+
+        return [Measurement(name=row[0], labels=json.loads(row[1]), start=row[2], end=row[3], bytes_processed=row[4],
+                            succeeded=bool(row[5])) for row in rows]
+
+    def get_latest_measurements(self) -> List[Measurement]:
+        """The most recent measurement of every name and labels combination"""
+
+        with self.lock, self.connect() as connection:
+            rows = connection.execute('SELECT name, labels, start, end, bytes, succeeded FROM measurements '
+                                      'WHERE rowid IN (SELECT max(rowid) FROM measurements GROUP BY name, labels) '
+                                      'ORDER BY name, labels').fetchall()
+
+        return [Measurement(name=row[0], labels=json.loads(row[1]), start=row[2], end=row[3], bytes_processed=row[4],
+                            succeeded=bool(row[5])) for row in rows]
+
+
+metrics_store = None
+metrics_store_lock = threading.Lock()
+
+
+def get_metrics_store() -> MetricsStore:
+    """The MetricsStore at METRICS_DATABASE, shared by all modules. Created on first use"""
+
+    global metrics_store
+
+    with metrics_store_lock:
+        if metrics_store is None:
+            metrics_store = MetricsStore()
+
+        return metrics_store
+
+
+@contextmanager
+def timed(name: str, **labels):
+    """Records the wall time of the with block as a measurement of name. Set bytes_processed on the yielded
+       Measurement to also record throughput, and succeeded to False if the operation failed without raising
+    """
+
+    measurement = Measurement(name=name, labels={key: str(value) for key, value in labels.items()},
+                              start=time.time())
+
+    try:
+        yield measurement
+
+    except BaseException:
+        measurement.succeeded = False
+        raise
+
+    finally:
+        measurement.end = time.time()
+        logger.debug('%s %s took %.2f seconds', name, measurement.labels, measurement.wall_time,
+                     extra={'duration': measurement.wall_time, 'bytes': measurement.bytes_processed})
+
+        try:
+            get_metrics_store().record(measurement)
+
+        except Exception:
+            logger.warning(f'Could not record measurement {name}', exc_info=True)
+
+
+def record_stage_result(result, graph: str = 'daily_flow'):
+    """Records a StageResult of run_stage_graph as a measurement named stage"""
+
+    get_metrics_store().record(Measurement(name='stage', labels={'graph': graph, 'stage': result.name},
+                                           start=result.start, end=result.end, succeeded=result.succeeded))
+
+
+def format_prometheus_labels(labels: Dict[str, str]) -> str:
+
+    if len(labels) == 0:
+        return ''
+
+    escaped = [key + '="' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+               for key, value in sorted(labels.items())]
+
+    return '{' + ','.join(escaped) + '}'
+
+
+def write_prometheus_textfile(path_to_textfile: Path, store: MetricsStore = None):
+    """Writes the latest measurement of every series as gauges in the Prometheus text format, for the node_exporter
+       textfile collector. Written to a temporary file first, so the collector never reads a partial file
+    """
+
+    store = store if store is not None else get_metrics_store()
+    lines = []
+
+    for measurement in store.get_latest_measurements():
+        metric_name = METRIC_NAME_PREFIX + re.sub('[^a-zA-Z0-9_]', '_', measurement.name)
+        labels = format_prometheus_labels(measurement.labels)
+
+        lines.append(f'{metric_name}_wall_seconds{labels} {measurement.wall_time:.3f}')
+        lines.append(f'{metric_name}_end_timestamp_seconds{labels} {measurement.end:.0f}')
+        lines.append(f'{metric_name}_succeeded{labels} {int(measurement.succeeded)}')
+
+        if measurement.bytes_processed is not None:
+            lines.append(f'{metric_name}_bytes{labels} {measurement.bytes_processed}')
+            lines.append(f'{metric_name}_throughput_bytes_per_second{labels} {measurement.throughput:.0f}')
+
+    temporary_path = path_to_textfile.with_name(path_to_textfile.name + '.tmp')
+    temporary_path.write_text('\n'.join(lines) + '\n')
+    temporary_path.replace(path_to_textfile)
+
+
+def publish_metrics():
+    """Writes the Prometheus textfile, if METRICS_TEXTFILE is set"""
+
+    if METRICS_TEXTFILE is None:
+        return
+
+    try:
+        write_prometheus_textfile(path_to_textfile=METRICS_TEXTFILE)
+
+    except (OSError, sqlite3.Error):
+        logger.warning(f'Could not write metrics textfile {METRICS_TEXTFILE}', exc_info=True)
+
+
+def get_regression_report(measurements: List[Measurement], threshold: float = 1.5) -> List[str]:
+    """One line per series, comparing the latest wall time and throughput with the median of the earlier ones.
+       Series where the latest wall time is more than threshold times the median are marked
+    """
+
+    series = {}
+
+    for measurement in measurements:
+        series.setdefault((measurement.name, json.dumps(measurement.labels, sort_keys=True)), []).append(measurement)
+
+    lines = []
+
+    for (name, labels), history in sorted(series.items()):
+        latest = history[-1]
+        line = f'{name} {labels}: {latest.wall_time:.1f}s'
+
+        if latest.throughput is not None:
+            line += f', {latest.throughput / 1e6:.1f} MB/s'
+
+        earlier_wall_times = [measurement.wall_time for measurement in history[:-1] if measurement.succeeded]
+
+        if len(earlier_wall_times) != 0:
+            median = statistics.median(earlier_wall_times)
+            line += f', median of {len(earlier_wall_times)} earlier {median:.1f}s'
+
+            if latest.wall_time > threshold * median:
+                line += '  <-- SLOWER'
+
+        if not latest.succeeded:
+            line += '  <-- FAILED'
+
+        lines.append(line)
+
+    return lines
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compares the latest timings of the daily flow with earlier days')
+    parser.add_argument('--days', type=int, default=14, help='days of history to compare with')
+    parser.add_argument('--name', help='only measurements of this name, like stage or make_csv_tarfile')
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help='mark series whose latest wall time is this many times the median')
+    parser.add_argument('--write-textfile', type=Path, metavar='PATH',
+                        help='also write the latest measurements as a Prometheus textfile')
+    arguments = parser.parse_args()
+
+    store = get_metrics_store()
+
+    for report_line in get_regression_report(store.get_measurements(since=time.time() - arguments.days * 86400,
+                                                                    name=arguments.name),
+                                             threshold=arguments.threshold):
+        print(report_line)
+
+    if arguments.write_textfile is not None:
+        write_prometheus_textfile(path_to_textfile=arguments.write_textfile, store=store)
@@ -1,36 +1,108 @@
+import hashlib
+import io
+import json
+import queue
 import tarfile
 import subprocess
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-import logging
+import os
 from pathlib import Path
-from typing import List
+from typing import BinaryIO, Callable, Dict, List
 
 from smb.SMBConnection import SMBConnection
 from smb.base import SharedFile, NotConnectedError
 from smb.smb_structs import OperationFailure
 from dotenv import dotenv_values
 
+from metrics import timed
+from retention import RetentionPolicy, apply_retention
+from smb_listing_cache import SMB_LISTING_CACHE_MAX_AGE, CachedFile, get_smb_listing_cache
+from controller_logging import get_logger, lazy
+
 config = dotenv_values(".env")
-logging_level = config['LOGGING_LEVEL']
 
-logger = logging.getLogger(name=__name__)
-logger.setLevel(logging_level)
+logger = get_logger(name=__name__)
 
-f_handler = logging.FileHandler('container_management.log')
-f_handler.setLevel(logging_level)
+#client = subprocess.Popen(['hostname'], stdout=subprocess.PIPE).communicate()[0].strip()
 
-c_handler = logging.StreamHandler()
-c_handler.setLevel('INFO')
+# [MS-ERREF] statuses of a file, or a folder on its path, that does not exist
+NOT_FOUND_STATUSES = {0xC000000F, 0xC0000034, 0xC000003A}
 
-f_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(funcName)s - %(message)s')
 
-f_handler.setFormatter(f_format)
-c_handler.setFormatter(f_format)
+def is_not_found(failure: OperationFailure) -> bool:
+    """Whether the operation failed because the file does not exist on the share, rather than for another reason like
+       access being denied. SMB1 messages hold the status as an SMBError, SMB2 messages as an int
+    """
 
-logger.addHandler(f_handler)
-logger.addHandler(c_handler)
+    return any(getattr(message.status, 'internal_value', message.status) in NOT_FOUND_STATUSES
+               for message in failure.smb_messages)
 
-#client = subprocess.Popen(['hostname'], stdout=subprocess.PIPE).communicate()[0].strip()
+
+class UploadJournal(object):
+    """Persists how far each chunked upload has got, keyed by remote path, so that an interrupted upload can be resumed
+       from the last confirmed offset - also by a later run of the program. An entry is only valid for the local file
+       it was made for, recognised by size and mtime. Thread safe, so parallel uploads can share one journal
+    """
+
+    def __init__(self, path_to_journal: Path = Path('smb_upload_journal.json')):
+        self.path_to_journal = path_to_journal
+        self.lock = threading.Lock()
+
+    def read_entries(self) -> dict:
+
+        if not self.path_to_journal.exists():
+            return {}
+
+        try:
+            return json.loads(self.path_to_journal.read_text())
+
+        except ValueError:
+            logger.warning(f'Upload journal {self.path_to_journal} is corrupt, uploads will start from the beginning')
+            return {}
+
+    def write_entries(self, entries: dict):
+
+        temporary_path = self.path_to_journal.with_name(self.path_to_journal.name + '.tmp')
+        temporary_path.write_text(json.dumps(entries, indent=1, sort_keys=True))
+        temporary_path.replace(self.path_to_journal)
+
+    def get_confirmed_offset(self, remote_path_str: str, local_file_path: Path) -> int:
+
+        with self.lock:
+            entry = self.read_entries().get(remote_path_str)
+
+        stat = local_file_path.stat()
+
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            return 0
+
+        return entry['confirmed_offset']
+
+    def set_confirmed_offset(self, remote_path_str: str, local_file_path: Path, confirmed_offset: int):
+
+        stat = local_file_path.stat()
+
+        with self.lock:
+            entries = self.read_entries()
+            entries[remote_path_str] = {'local_path': str(local_file_path),
+                                        'size': stat.st_size,
+                                        'mtime': stat.st_mtime,
+                                        'confirmed_offset': confirmed_offset}
+            self.write_entries(entries)
+
+    def remove(self, remote_path_str: str):
+
+        with self.lock:
+            entries = self.read_entries()
+
+            if entries.pop(remote_path_str, None) is not None:
+                self.write_entries(entries)
 
 
 class SmbClient(object):
@@ -41,10 +113,11 @@ class SmbClient(object):
         self.remote_name = remote_name
         self.sharename = sharename
         self.logger = logger
+        self.listing_cache = get_smb_listing_cache()
 
     def connect(self) -> bool:
 
-        logging.debug(f'user: {self.username}, pass: {self.password}, remote_name: {self.remote_name}, ip: {self.ip}')
+        self.logger.debug('user: %s, remote_name: %s, ip: %s', self.username, self.remote_name, self.ip)
 
         self.server = SMBConnection(username=self.username,
                                     password=self.password,
@@ -70,41 +143,313 @@ class SmbClient(object):
         self.server.close()
 
 
-    def upload(self, local_file_path: Path, remote_folder_path: Path):
-        """uploads local file_path to samba share.
-           remote_folder_path: relative path from sharename root folder, to upload folder.
-           local_file_path: file_path location on local machine.
+    def upload_file_object(self, file_obj: BinaryIO, remote_path_str: str):
+        """uploads what can be read from file_obj to remote_path_str, relative path from sharename root folder.
+           file_obj only has to support read. Returns number of bytes uploaded, or None if upload failed
         """
 
-        with open(str(local_file_path.resolve()), 'rb') as data:
-            remote_path_str = str(remote_folder_path / local_file_path.name)
-            msg = f"Opened file {remote_path_str} as step before uploading to samba server"
-            self.logger.debug(msg)
-
+        with timed('smb_upload', remote_folder=Path(remote_path_str).parent) as measurement:
             try:
                 bytes_uploaded = self.server.storeFile(service_name=self.sharename,
                                                        path=remote_path_str,
-                                                       file_obj=data)
+                                                       file_obj=file_obj)
 
             except (OperationFailure, NotConnectedError):
-                msg = f'Exception occured. File {str(local_file_path)} upload to samba share probably failed.'
+                msg = f'Exception occured. Upload to samba share probably failed.'
                 msg += f'Tried to upload to the following remote path; {remote_path_str}'
                 self.logger.exception(msg)
+                measurement.succeeded = False
+
+                return None
 
             else:
-                msg = f"{bytes_uploaded} bytes of {str(local_file_path)} uploaded to"
-                msg += f"samba share {self.sharename} in the subfolder {remote_path_str + '/' + local_file_path.name}"
-                self.logger.debug(msg)
+                self.logger.debug('%s bytes uploaded to samba share %s at %s', bytes_uploaded, self.sharename,
+                                  remote_path_str, extra={'bytes': bytes_uploaded,
+                                              'duration': time.time() - measurement.start})
+                measurement.bytes_processed = bytes_uploaded
+                self.listing_cache.record_upload(remote_path_str=remote_path_str, size=bytes_uploaded)
+
+                return bytes_uploaded
+
+    def upload(self, local_file_path: Path, remote_folder_path: Path):
+        """uploads local file_path to samba share.
+           remote_folder_path: relative path from sharename root folder, to upload folder.
+           local_file_path: file_path location on local machine.
+           Returns number of bytes uploaded, or None if upload failed
+        """
+
+        with open(str(local_file_path.resolve()), 'rb') as data:
+            remote_path_str = str(remote_folder_path / local_file_path.name)
+            self.logger.debug('Opened file %s as step before uploading to samba server', remote_path_str)
+
+            return self.upload_file_object(file_obj=data, remote_path_str=remote_path_str)
+
+    def get_remote_file_size(self, remote_path_str: str) -> int:
+        """Returns size of remote file, or 0 if it does not exist"""
+
+        try:
+            return self.server.getAttributes(self.sharename, remote_path_str).file_size
+
+        except OperationFailure:
+            return 0
+
+    def upload_chunked(self,
+                       local_file_path: Path,
+                       remote_folder_path: Path,
+                       journal: UploadJournal = None,
+                       chunk_size: int = 8 << 20,
+                       max_reconnects: int = 3,
+                       sha256=None):
+        """uploads local file_path to samba share in chunks written at offsets. After each chunk the offset is stored in
+           the journal, so an interrupted upload resumes from the last confirmed offset instead of from the start.
+           Reconnects up to max_reconnects times if the connection drops.
+           sha256: a hashlib.sha256 object, updated with the file as it is read for upload, so the file is only read
+                   once. Only when resuming, the part uploaded earlier is read locally to hash it
+           Returns number of bytes of the file on the share, or None if upload failed
+        """
+
+        with timed('smb_upload_chunked', remote_folder=remote_folder_path) as measurement:
+            measurement.bytes_processed = 0
+
+            journal = journal if journal is not None else UploadJournal()
+            remote_path_str = str(remote_folder_path / local_file_path.name)
+            file_size = local_file_path.stat().st_size
+            reconnects = 0
+            hashed_offset = 0
+
+            while True:
+                try:
+                    offset = journal.get_confirmed_offset(remote_path_str=remote_path_str,
+                                                          local_file_path=local_file_path)
+
+                    if offset != 0:
+                        # the share is the truth, the journal might be ahead if the remote file was removed
+                        offset = min(offset, self.get_remote_file_size(remote_path_str))
+                        self.logger.info(f'Resuming upload of {local_file_path} to {remote_path_str} '
+                                         f'at byte {offset}')
+
+                    with open(str(local_file_path.resolve()), 'rb') as data:
+                        if sha256 is not None:
+                            while hashed_offset < offset:
+                                block = data.read(min(chunk_size, offset - hashed_offset))
+
+                                if not block:
+                                    break
+
+                                sha256.update(block)
+                                hashed_offset += len(block)
+
+                        data.seek(offset)
+
+                        while offset < file_size or file_size == 0:
+                            chunk = data.read(chunk_size)
+
+                            # after a reconnect, chunks may be uploaded again, but are only hashed once
+                            if sha256 is not None and offset + len(chunk) > hashed_offset:
+                                sha256.update(chunk[hashed_offset - offset:])
+                                hashed_offset = offset + len(chunk)
+
+                            self.server.storeFileFromOffset(service_name=self.sharename,
+                                                            path=remote_path_str,
+                                                            file_obj=io.BytesIO(chunk),
+                                                            offset=offset,
+                                                            truncate=(offset == 0))
+                            offset += len(chunk)
+                            measurement.bytes_processed += len(chunk)
+
+                            journal.set_confirmed_offset(remote_path_str=remote_path_str,
+                                                         local_file_path=local_file_path,
+                                                         confirmed_offset=offset)
+
+                            if file_size == 0:
+                                break
+
+                except (NotConnectedError, OSError) as e:
+                    self.logger.warning(f'Connection lost uploading {local_file_path} ({e})')
+
+                    # a reconnect that fails counts too, the upload is only resumed over a connected server
+                    while True:
+                        if reconnects >= max_reconnects:
+                            self.logger.exception(f'Upload of {local_file_path} failed after {reconnects} '
+                                                  f'reconnects. Will resume from journal on next attempt')
+                            measurement.succeeded = False
+                            return None
+
+                        reconnects += 1
+                        self.logger.warning(f'Reconnect {reconnects} of {max_reconnects}')
+
+                        # the dropped connection still holds its socket
+                        try:
+                            self.server.close()
+
+                        except Exception:
+                            pass
+
+                        if self.connect():
+                            break
+
+                except OperationFailure:
+                    self.logger.exception(f'Exception occured. File {str(local_file_path)} upload to samba share '
+                                          f'failed. Tried to upload to the following remote path; {remote_path_str}')
+                    measurement.succeeded = False
+                    return None
+
+                else:
+                    journal.remove(remote_path_str)
+                    self.logger.debug('%d bytes of %s uploaded to samba share %s at %s', offset, local_file_path,
+                                      self.sharename, remote_path_str)
+                    self.listing_cache.record_upload(remote_path_str=remote_path_str, size=offset)
+
+                    if local_file_path.name.endswith('.sha256'):
+                        self.listing_cache.set_checksum(remote_path_str=remote_path_str[:-len('.sha256')],
+                                                        checksum=local_file_path.read_text().split()[0])
+
+                    return offset
+
+    def new_connection(self):
+        """Returns a new, connected, SmbClient with the same settings, or None if connecting failed"""
+
+        smb = SmbClient(ip=self.ip,
+                        username=self.username,
+                        password=self.password,
+                        remote_name=self.remote_name,
+                        sharename=self.sharename,
+                        logger=self.logger)
+
+        return smb if smb.connect() else None
+
+    def is_healthy(self) -> bool:
+        """Sends an SMB echo, to check that the connection is still usable"""
+
+        try:
+            self.server.echo(b'health check', timeout=5)
+
+        except Exception:
+            self.logger.debug('Health check of samba connection to %s failed', self.ip, exc_info=True)
+            return False
+
+        return True
+
+    def upload_many(self,
+                    local_file_paths: List[Path],
+                    remote_folder_path: Path,
+                    workers: int = 3,
+                    journal: UploadJournal = None,
+                    smb_pool=None,
+                    sha256s: Dict[Path, object] = None) -> Dict[Path, int]:
+        """Uploads the files with upload_chunked over up to workers SMB connections at the same time. This connection
+           is one of them. The other connections are borrowed from smb_pool, an SmbConnectionPool, if passed, else
+           they are opened for this call. sha256s: hashlib.sha256 objects by local file path, see upload_chunked.
+           Returns dict of bytes on share by local file path, None for failed uploads
+        """
+
+        sha256s = sha256s if sha256s is not None else {}
+
+        journal = journal if journal is not None else UploadJournal()
+        file_queue = queue.Queue()
+
+        for local_file_path in local_file_paths:
+            file_queue.put(local_file_path)
+
+        results = {}
+
+        def upload_from_queue(smb: SmbClient):
+            while True:
+                try:
+                    local_file_path = file_queue.get_nowait()
+
+                except queue.Empty:
+                    return
+
+                results[local_file_path] = smb.upload_chunked(local_file_path=local_file_path,
+                                                              remote_folder_path=remote_folder_path,
+                                                              journal=journal,
+                                                              sha256=sha256s.get(local_file_path))
+
+        connections = [self]
+        succeeded = False
+
+        try:
+            for _ in range(min(workers, len(local_file_paths)) - 1):
+                try:
+                    smb = self.new_connection() if smb_pool is None else smb_pool.acquire(block=False)
+
+                except NotConnectedError:
+                    self.logger.warning(f'Could not open another samba connection, uploading over '
+                                        f'{len(connections)}', exc_info=True)
+                    break
+
+                if smb is not None:
+                    connections.append(smb)
+
+            with ThreadPoolExecutor(max_workers=len(connections), thread_name_prefix='smb_upload') as executor:
+                list(executor.map(upload_from_queue, connections))
+
+            succeeded = True
 
-    def download(self, file: str):
+        finally:
+            # connections an upload raised on may be broken, so they are not returned to the pool as idle
+            for smb in connections[1:]:
+                if smb_pool is None:
+                    smb.close()
 
-        with open(file, 'wb') as fileobj:
-            self.server.retrieveFile(self.sharename, fileobj)
+                else:
+                    smb_pool.release(smb, healthy=succeeded)
 
-        self.logger.debug(f"file_path {file} has been downloaded in current dir")
+        return results
 
-    def delete(self, file_path: str):
-        """remove file_path from remote share.
+    def download(self, remote_path_str: str, local_file_path: Path, sha256=None) -> bool:
+        """downloads remote_path_str, relative path from sharename root folder, to local_file_path.
+           sha256: a hashlib.sha256 object, updated with the file as it is written, so that it is not read again to
+                   verify it
+           Returns True if download succeeded
+        """
+
+        try:
+            with open(str(local_file_path), 'wb') as fileobj:
+                self.server.retrieveFile(self.sharename, remote_path_str,
+                                         HashingWriter(file_obj=fileobj, sha256=sha256))
+
+        except (OperationFailure, NotConnectedError):
+            self.logger.exception(f'Failed to download {remote_path_str} from samba share')
+            local_file_path.unlink()
+
+            return False
+
+        self.logger.debug('file_path %s has been downloaded to %s', remote_path_str, local_file_path)
+
+        return True
+
+    def read_remote_file(self, remote_path_str: str) -> bytes:
+        """Contents of a small remote file, like a .sha256 sidecar, read into memory"""
+
+        file_obj = io.BytesIO()
+        self.server.retrieveFile(self.sharename, remote_path_str, file_obj)
+
+        return file_obj.getvalue()
+
+    def hash_remote_file(self, remote_path_str: str, chunk_size: int = 8 << 20) -> str:
+        """sha256 of a remote file, read in chunks at offsets and hashed as they arrive, so that neither memory nor
+           local disk is used for the file
+        """
+
+        hashing_writer = HashingWriter()
+
+        with timed('smb_hash_remote_file', remote_folder=Path(remote_path_str).parent) as measurement:
+            while True:
+                _, bytes_read = self.server.retrieveFileFromOffset(self.sharename, remote_path_str, hashing_writer,
+                                                                   offset=hashing_writer.bytes_written,
+                                                                   max_length=chunk_size)
+
+                if bytes_read < chunk_size:
+                    break
+
+            measurement.bytes_processed = hashing_writer.bytes_written
+
+        return hashing_writer.hexdigest()
+
+    def delete(self, file_path: str) -> bool:
+        """remove file_path from remote share. Returns True if deleted
            file_path: str
              File path relative to share name
         """
@@ -114,8 +459,24 @@ class SmbClient(object):
 
         except Exception:
             self.logger.exception(f'Tried to delete {file_path} but failed')
+            return False
+
+        self.logger.debug('should have deleted file_path %s', file_path)
+        self.listing_cache.record_delete(remote_path_str=file_path)
+
+        return True
+
+    def delete_many(self, file_paths: List[str]) -> List[str]:
+        """Deletes the files in one pass over this connection, without listing the folder again for each of them.
+           A failed delete is logged and does not stop the others. Returns the paths that were deleted
+        """
 
-        self.logger.debug(f'should have deleted file_path {str(file_path)}')
+        deleted = [file_path for file_path in file_paths if self.delete(file_path)]
+
+        if len(deleted) != len(file_paths):
+            self.logger.warning(f'{len(file_paths) - len(deleted)} of {len(file_paths)} deletes on samba share failed')
+
+        return deleted
 
     def create_directory(self, directory_name: str, relative_path: Path):
         """Creates new directory on relative path on samba share from share folder (sharename). Note that folders
@@ -123,7 +484,7 @@ class SmbClient(object):
         """
 
         try:
-            self.logger.debug(f'Will try to create {directory_name}, with path {str(relative_path / directory_name)}')
+            self.logger.debug('Will try to create %s, with path %s', directory_name, relative_path / directory_name)
             self.server.createDirectory(self.sharename, str(relative_path / directory_name))
 
         except OperationFailure:
@@ -131,85 +492,567 @@ class SmbClient(object):
             message += 'though - it might be created after all. Will therefore ignore and proceed'
             self.logger.warning(message)
 
-    def get_list_of_files_on_share(self, subfolder: str) -> List[SharedFile]:
-        """get list of files of remote share"""
+    def get_list_of_files_on_share(self, subfolder: str, pattern: str = '*') -> List[SharedFile]:
+        """get list of files of remote share, those with names matching pattern, like csv_full_*. The files, not
+           the directories, are stored in the listing cache
+        """
+
+        file_list = self.server.listPath(self.sharename, '/' + subfolder, pattern=pattern)
+        self.logger.debug('Retrieved list of %d entries in %s matching %s', len(file_list), subfolder, pattern)
+        self.logger.debug('Retrieved list %s', lazy(lambda: [file.filename for file in file_list]))
 
-        file_list = self.server.listPath(self.sharename, '/' + subfolder)
-        self.logger.debug(f'Retrieved list {[file.filename for file in file_list]}')
+        self.listing_cache.store_listing(folder=subfolder.strip('/'), pattern=pattern,
+                                         files=[(file.filename, file.file_size, file.create_time)
+                                                for file in file_list
+                                                if file.filename not in ('.', '..') and not file.isDirectory])
 
         return file_list
 
-    def list_files_not_x_most_recent(self, file_list: List[SharedFile], threshold: int) -> List[SharedFile]:
-        """Threshold up to and including. 5 gives all files but the 5 most recent"""
+    def get_cached_list_of_files(self, subfolder: str, pattern: str = '*',
+                                 max_age: float = SMB_LISTING_CACHE_MAX_AGE) -> List[CachedFile]:
+        """Files in subfolder with names matching pattern, from the listing cache. Only if they were not listed in
+           the last max_age seconds, they are listed on the share first. max_age 0 always lists
+        """
+
+        folder = subfolder.strip('/')
+        listed_at = self.listing_cache.get_listed_at(folder=folder, pattern=pattern)
 
-        file_creation_dict = {}
+        if listed_at is None or time.time() - listed_at >= max_age:
+            self.get_list_of_files_on_share(subfolder=folder, pattern=pattern)
 
-        for a_file in file_list:
-            file_creation_dict[a_file] = a_file.create_time
+        return self.listing_cache.get_files(folder=folder, pattern=pattern)
 
-        sorted_dict = dict(sorted(file_creation_dict.items(), key=lambda item: item[1], reverse=True))
+    def list_files_not_x_most_recent(self, file_list: List[SharedFile], threshold: int) -> List[SharedFile]:
+        """Threshold up to and including. 5 gives all files but the 5 most recent. Directories, and the . and ..
+           entries of the listing, are never included
+        """
 
-        sorted_file_name_list = list(sorted_dict.keys())
+        files = [a_file for a_file in file_list
+                 if a_file.filename not in ('.', '..') and not a_file.isDirectory]
 
-        self.logger.debug(f'all backup files on share; {[file.filename for file in sorted_file_name_list]}')
+        sorted_file_name_list = sorted(files, key=lambda a_file: a_file.create_time, reverse=True)
 
-        not_most_recent_files = sorted_file_name_list[threshold - 1:]
-        self.logger.debug(f'Files to be deleted from share; {[file.filename for file in not_most_recent_files]}')
+        self.logger.debug('all backup files on share; %s',
+                          lazy(lambda: [file.filename for file in sorted_file_name_list]))
+
+        not_most_recent_files = sorted_file_name_list[threshold:]
+        self.logger.debug('Files to be deleted from share; %s',
+                          lazy(lambda: [file.filename for file in not_most_recent_files]))
 
         return not_most_recent_files
 
     def delete_file_not_x_most_recent(self, subfolder: str, threshold: int, file_type_includes: str='tar'):
 
-        subfolder_files = self.get_list_of_files_on_share(subfolder=subfolder)
+        # only files of the type count towards the threshold
+        subfolder_files = [file for file in self.get_list_of_files_on_share(subfolder=subfolder)
+                           if file_type_includes in file.filename.split('.')[-2:]]
 
         list_of_files_to_delete = self.list_files_not_x_most_recent(file_list=subfolder_files,
                                                                     threshold=threshold)
 
         for file in list_of_files_to_delete:
-            if file_type_includes in file.filename.split('.')[-2:]:
-                self.delete(f'/{subfolder}/{file.filename}')
-                self.logger.info(f'deleted {file.filename} from samba share, subfolder {subfolder}')
+            self.delete(f'/{subfolder}/{file.filename}')
+            self.logger.info(f'deleted {file.filename} from samba share, subfolder {subfolder}')
 
-            else:
-                self.logger.debug(f'file_path {file.filename} not deleted as file_path name did not included in file_path ending')
 
+COMPRESSION_FILE_SUFFIXES = {'gz': '.tar.gz',     # tarfile's own single core gzip
+                             'pgz': '.tar.gz',    # gzip compressed in parallel blocks, read by any gzip/tar
+                             'zst': '.tar.zst'}   # multithreaded zstandard, requires the zstandard package
+
+DEFAULT_COMPRESSION_LEVELS = {'gz': 9, 'pgz': 6, 'zst': 3}
+
+
+class SmbConnectionPool(object):
+    """Keeps connected SmbClients for reuse, so that backup jobs running in the same process do not each pay for a new
+       NTLMv2 handshake. Connections are health checked with an SMB echo before being handed out, closed when idle
+       for more than idle_timeout seconds, and replaced when an operation fails with NotConnectedError.
+       At most max_connections are open at the same time. Thread safe
+    """
+
+    def __init__(self, ip, username, password, remote_name, sharename,
+                 max_connections: int = 3, idle_timeout: int = 300, logger=logger):
+        self.ip = ip
+        self.username = username
+        self.password = password
+        self.remote_name = remote_name
+        self.sharename = sharename
+        self.idle_timeout = idle_timeout
+        self.logger = logger
+
+        self.lock = threading.Lock()
+        self.available = threading.Semaphore(max_connections)
+        self.idle_connections = []      # (SmbClient, time released)
+
+    def close_idle_connections(self, older_than: float = None):
+        """Closes idle connections released more than older_than seconds ago, all idle connections if None"""
+
+        now = time.time()
+
+        with self.lock:
+            to_close = [smb for smb, released in self.idle_connections
+                        if older_than is None or now - released > older_than]
+            self.idle_connections = [(smb, released) for smb, released in self.idle_connections
+                                     if smb not in to_close]
+
+        for smb in to_close:
+            try:
+                smb.close()
+
+            except Exception:
+                self.logger.debug('Closing idle samba connection failed', exc_info=True)
+
+    def acquire(self, block: bool = True):
+        """Returns a connected SmbClient, reusing a healthy idle one if possible. Returns None if block is False and
+           max_connections are in use. Raises NotConnectedError if a new connection could not be made
+        """
+
+        if not self.available.acquire(blocking=block):
+            return None
+
+        self.close_idle_connections(older_than=self.idle_timeout)
+
+        while True:
+            with self.lock:
+                smb = self.idle_connections.pop()[0] if len(self.idle_connections) != 0 else None
+
+            if smb is None:
+                break
+
+            if smb.is_healthy():
+                self.logger.debug('Reusing pooled samba connection')
+                return smb
+
+            smb.close()
+
+        smb = SmbClient(ip=self.ip,
+                        username=self.username,
+                        password=self.password,
+                        remote_name=self.remote_name,
+                        sharename=self.sharename,
+                        logger=self.logger)
+
+        if not smb.connect():
+            self.available.release()
+            raise NotConnectedError(f'Could not connect to samba share on {self.ip}')
+
+        return smb
+
+    def release(self, smb: SmbClient, healthy: bool = True):
+        """Returns connection to the pool. Closes it instead if it is not healthy"""
+
+        if healthy:
+            with self.lock:
+                self.idle_connections.append((smb, time.time()))
+
+        else:
+            try:
+                smb.close()
+
+            except Exception:
+                self.logger.debug('Closing broken samba connection failed', exc_info=True)
+
+        self.available.release()
+
+    @contextmanager
+    def connection(self):
+        """Context manager handing out a pooled SmbClient. A connection raising NotConnectedError or OSError is
+           discarded instead of returned to the pool
+        """
+
+        smb = self.acquire()
 
-def generate_tar_gz_filename_with_timestamp_suffix(prefix: str):
+        try:
+            yield smb
+
+        except (NotConnectedError, OSError):
+            self.release(smb, healthy=False)
+            raise
+
+        except BaseException:
+            self.release(smb)
+            raise
+
+        else:
+            self.release(smb)
+
+    def run(self, operation: Callable, retries: int = 1):
+        """Calls operation with a pooled SmbClient, and returns the result. If the connection has dropped, the
+           operation is retried on a new connection up to retries times
+        """
+
+        for attempt in range(retries + 1):
+            try:
+                with self.connection() as smb:
+                    return operation(smb)
+
+            except NotConnectedError:
+                if attempt == retries:
+                    raise
+
+                self.logger.warning('Samba connection dropped, retrying on a new connection')
+
+
+def get_smb_pool(samba_user: str,
+                 samba_password: str,
+                 samba_share: str,
+                 samba_server_ip: str,
+                 samba_remote_name: str) -> SmbConnectionPool:
+
+    return SmbConnectionPool(ip=samba_server_ip,
+                             username=samba_user,
+                             password=samba_password,
+                             remote_name=samba_remote_name,
+                             sharename=samba_share)
+
+
+def generate_tar_gz_filename_with_timestamp_suffix(prefix: str, file_suffix: str = '.tar.gz'):
     """Generates timestamp suffix, appends to passed prefix"""
 
     backup_time = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
-    tar_file_name = f'{prefix}_{backup_time}.tar.gz'
+    tar_file_name = f'{prefix}_{backup_time}{file_suffix}'
 
     return tar_file_name
 
 
-def make_csv_tarfile(path_to_local_backup_dir: Path) -> Path:
+class ParallelGzipWriter(object):
+    """Write-only file object that gzip compresses what is written in blocks of block_size bytes, pigz style.
+       Every block is compressed as a separate gzip member by a pool of worker threads (zlib releases the GIL while
+       compressing, so the blocks are compressed on several cores), and written to file_obj in order.
+       Concatenated gzip members is a valid gzip file, so the output is readable by gzip, tar and the tarfile module.
+       At most 2 * workers blocks are held in memory.
+    """
+
+    def __init__(self, file_obj: BinaryIO, level: int = 6, workers: int = None, block_size: int = 1 << 20):
+        self.file_obj = file_obj
+        self.level = level
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.block_size = block_size
+
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='gzip')
+        self.closed = False
+
+    def compress_block(self, block: bytes) -> bytes:
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)    # wbits 31 gives gzip header and trailer
+        return compressor.compress(block) + compressor.flush()
+
+    def submit_block(self, block: bytes):
+
+        while len(self.pending) >= 2 * self.workers:
+            self.file_obj.write(self.pending.popleft().result())
+
+        self.pending.append(self.executor.submit(self.compress_block, block))
+
+    def write(self, data: bytes) -> int:
+
+        self.buffer += data
+
+        while len(self.buffer) >= self.block_size:
+            self.submit_block(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+
+        return len(data)
+
+    def close(self):
+
+        if self.closed:
+            return
+
+        try:
+            if len(self.buffer) != 0:
+                self.submit_block(bytes(self.buffer))
+                self.buffer = bytearray()
+
+            while len(self.pending) != 0:
+                self.file_obj.write(self.pending.popleft().result())
+
+        finally:
+            self.executor.shutdown(wait=True)
+            self.closed = True
+
+
+class HashingWriter(object):
+    """Write-only file object passing what is written on to file_obj, while computing its sha256 and counting its
+       bytes. Placed between an archive writer and the file or pipe it writes to, the checksum is computed in the
+       same pass as the archive is built, without reading it back. file_obj None only hashes. sha256: a
+       hashlib.sha256 object to update, a new one if None
+    """
+
+    def __init__(self, file_obj: BinaryIO = None, sha256=None):
+        self.file_obj = file_obj
+        self.sha256 = sha256 if sha256 is not None else hashlib.sha256()
+        self.bytes_written = 0
+
+    def write(self, data: bytes) -> int:
+
+        self.sha256.update(data)
+        self.bytes_written += len(data)
+
+        if self.file_obj is not None:
+            self.file_obj.write(data)
+
+        return len(data)
+
+    def flush(self):
+
+        if self.file_obj is not None and hasattr(self.file_obj, 'flush'):
+            self.file_obj.flush()
+
+    def hexdigest(self) -> str:
+        return self.sha256.hexdigest()
+
+
+def add_backup_folders_to_tar(tar: tarfile.TarFile, path_to_local_backup_dir: Path):
+    """Recursively adds all folders in passed folder to the tar archive"""
+
+    for folder_path in path_to_local_backup_dir.iterdir():
+        if folder_path.is_dir():
+            tar.add(str(folder_path), recursive=True)
+            logger.debug('added folder; %s to tar', folder_path)
+
+
+def write_csv_tar(file_obj: BinaryIO,
+                  path_to_local_backup_dir: Path,
+                  compression: str = 'pgz',
+                  level: int = None,
+                  workers: int = None):
+    """Writes a compressed tar archive of all folders in passed folder to file_obj, which only has to support write.
+       compression: one of COMPRESSION_FILE_SUFFIXES. level: compression level, backend default if None.
+       workers: number of compression threads for pgz and zst, number of cpus if None
+    """
+
+    if compression not in COMPRESSION_FILE_SUFFIXES:
+        raise ValueError(f'Unknown compression {compression}, must be one of {list(COMPRESSION_FILE_SUFFIXES)}')
+
+    if level is None:
+        level = DEFAULT_COMPRESSION_LEVELS[compression]
+
+    if compression == 'gz':
+        with tarfile.open(fileobj=file_obj, mode="w:gz", compresslevel=level) as tar:
+            add_backup_folders_to_tar(tar=tar, path_to_local_backup_dir=path_to_local_backup_dir)
+
+    elif compression == 'pgz':
+        gzip_writer = ParallelGzipWriter(file_obj=file_obj, level=level, workers=workers)
+
+        try:
+            with tarfile.open(fileobj=gzip_writer, mode="w|") as tar:
+                add_backup_folders_to_tar(tar=tar, path_to_local_backup_dir=path_to_local_backup_dir)
+
+        finally:
+            gzip_writer.close()
+
+    elif compression == 'zst':
+        try:
+            import zstandard
+
+        except ImportError as e:
+            logger.critical('zst compression requires the zstandard package, pip3 install zstandard')
+            raise e
+
+        compressor = zstandard.ZstdCompressor(level=level, threads=workers if workers is not None else -1)
+
+        with compressor.stream_writer(file_obj, closefd=False) as zstd_writer:
+            with tarfile.open(fileobj=zstd_writer, mode="w|") as tar:
+                add_backup_folders_to_tar(tar=tar, path_to_local_backup_dir=path_to_local_backup_dir)
+
+
+def make_csv_tarfile(path_to_local_backup_dir: Path,
+                     compression: str = 'pgz',
+                     level: int = None,
+                     workers: int = None) -> Path:
     """Recursively adds all files in passed folder to tar file_path. Returns path to created file_path,
-       tarfile is stored in the local backup directory. Will be deleted before new tar file_path is made
+       tarfile is stored in the local backup directory. Will be deleted before new tar file_path is made.
+       The sha256 of the archive is computed while it is written, and stored in a .sha256 sidecar next to it.
+       See write_csv_tar for compression, level and workers
     """
 
-    tar_file_name = generate_tar_gz_filename_with_timestamp_suffix(prefix="csv_backup")
+    tar_file_name = generate_tar_gz_filename_with_timestamp_suffix(prefix="csv_backup",
+                                                                   file_suffix=COMPRESSION_FILE_SUFFIXES[compression])
     tar_path = Path(path_to_local_backup_dir, tar_file_name)
 
-    with tarfile.open(str(tar_path), "w:gz") as tar:
+    with timed('make_csv_tarfile', compression=compression) as measurement:
+        with open(str(tar_path), 'wb') as tar_file:
+            hashing_writer = HashingWriter(file_obj=tar_file)
+            write_csv_tar(file_obj=hashing_writer,
+                          path_to_local_backup_dir=path_to_local_backup_dir,
+                          compression=compression,
+                          level=level,
+                          workers=workers)
+
+        measurement.bytes_processed = hashing_writer.bytes_written
 
-        for folder_path in path_to_local_backup_dir.iterdir():
-            if folder_path.is_dir():
-                tar.add(str(folder_path), recursive=True)
-                logger.debug(f'added folder; {folder_path} to tar')
+    write_sha256_sidecar(file_path=tar_path, hexdigest=hashing_writer.hexdigest())
 
     logger.info(f'added created tar archive and created file_path {tar_path}')
 
     return tar_path
 
 
+class StreamingPipe(object):
+    """Bounded in-memory pipe between a thread writing an archive and a thread reading it for upload.
+       The writer blocks when max_buffered_chunks written chunks have not been read yet, so memory use stays bounded
+       and the producer can not run ahead of the network. Exceptions in the writer thread are passed on to the
+       reader through close_writer. If the reader closes the pipe, further writes raise BrokenPipeError
+    """
+
+    end_of_stream = None
+
+    def __init__(self, max_buffered_chunks: int = 16):
+        self.chunks = queue.Queue(maxsize=max_buffered_chunks)
+        self.leftover = b''
+        self.writer_exception = None
+        self.reader_closed = threading.Event()
+        self.writer_finished = False
+
+    def write(self, data: bytes) -> int:
+
+        data = bytes(data)
+
+        while True:
+            if self.reader_closed.is_set():
+                raise BrokenPipeError('Reader of StreamingPipe has been closed')
+
+            try:
+                self.chunks.put(data, timeout=1)
+
+            except queue.Full:
+                continue
+
+            else:
+                return len(data)
+
+    def close_writer(self, exception: BaseException = None):
+        """Marks end of stream. exception, if passed, is raised on the reader side"""
+
+        self.writer_exception = exception
+
+        while not self.reader_closed.is_set():
+            try:
+                self.chunks.put(self.end_of_stream, timeout=1)
+
+            except queue.Full:
+                continue
+
+            else:
+                break
+
+    def read(self, size: int = -1) -> bytes:
+
+        while not self.writer_finished and (size < 0 or len(self.leftover) < size):
+            chunk = self.chunks.get()
+
+            if chunk is self.end_of_stream:
+                self.writer_finished = True
+
+                if self.writer_exception is not None:
+                    raise IOError('Writer of StreamingPipe failed') from self.writer_exception
+
+            else:
+                self.leftover += chunk
+
+        if size < 0:
+            size = len(self.leftover)
+
+        data, self.leftover = self.leftover[:size], self.leftover[size:]
+
+        return data
+
+    def close(self):
+        """Closes the reader side, and discards buffered chunks so that a blocked writer is released"""
+
+        self.reader_closed.set()
+
+        try:
+            while True:
+                self.chunks.get_nowait()
+
+        except queue.Empty:
+            pass
+
+
+def stream_csv_tar_to_share(smb: SmbClient,
+                            path_to_local_backup_dir: Path,
+                            path_remote_backup_folder: Path,
+                            compression: str = 'pgz',
+                            level: int = None,
+                            workers: int = None) -> bool:
+    """Builds the compressed csv tar archive in a producer thread and uploads it while it is being built, through a
+       StreamingPipe. Nothing is written to local disk. The sha256 of the archive is computed as it is built, and
+       uploaded as a .sha256 sidecar once the whole archive is on the share. Returns True if the whole archive was
+       uploaded. A partially uploaded archive is deleted from the share
+    """
+
+    tar_file_name = generate_tar_gz_filename_with_timestamp_suffix(prefix="csv_backup",
+                                                                   file_suffix=COMPRESSION_FILE_SUFFIXES[compression])
+    remote_path_str = str(path_remote_backup_folder / tar_file_name)
+    pipe = StreamingPipe()
+    hashing_writer = HashingWriter(file_obj=pipe)
+
+    def produce_tar():
+        try:
+            write_csv_tar(file_obj=hashing_writer,
+                          path_to_local_backup_dir=path_to_local_backup_dir,
+                          compression=compression,
+                          level=level,
+                          workers=workers)
+
+        except BaseException as e:
+            pipe.close_writer(exception=e)
+
+        else:
+            pipe.close_writer()
+
+    producer = threading.Thread(target=produce_tar, name='csv_tar_producer', daemon=True)
+
+    with timed('stream_csv_tar_to_share', compression=compression) as measurement:
+        producer.start()
+
+        try:
+            bytes_uploaded = smb.upload_file_object(file_obj=pipe, remote_path_str=remote_path_str)
+
+        except Exception:
+            logger.exception(f'Building csv tar archive failed while streaming it to {remote_path_str}')
+            bytes_uploaded = None
+
+        finally:
+            pipe.close()
+            producer.join()
+
+        if bytes_uploaded is not None and bytes_uploaded != hashing_writer.bytes_written:
+            logger.error(f'{hashing_writer.bytes_written} bytes of csv tar archive built, but {bytes_uploaded} '
+                         f'uploaded to {remote_path_str}')
+            bytes_uploaded = None
+
+        measurement.bytes_processed = bytes_uploaded
+        measurement.succeeded = bytes_uploaded is not None
+
+    if bytes_uploaded is None:
+        smb.delete(remote_path_str)
+        return False
+
+    sidecar = f'{hashing_writer.hexdigest()}  {tar_file_name}\n'.encode()
+
+    if smb.upload_file_object(file_obj=io.BytesIO(sidecar), remote_path_str=remote_path_str + '.sha256') is None:
+        logger.warning(f'Checksum of {remote_path_str} could not be uploaded, it can not be verified')
+
+    else:
+        smb.listing_cache.set_checksum(remote_path_str=remote_path_str, checksum=hashing_writer.hexdigest())
+
+    logger.info(f'Streamed {bytes_uploaded} bytes of csv tar archive to {remote_path_str}')
+
+    return True
+
+
 def delete_old_tar_files(path_to_local_backup_dir: Path):
 
     if len(list(path_to_local_backup_dir.glob('*'))) != 0:
 
-        for file_path in path_to_local_backup_dir.glob("*.tar.gz"):
-            file_path.unlink()
-            logger.info(f'Old file_path deleted {str(file_path)}')
+        for file_suffix in set(COMPRESSION_FILE_SUFFIXES.values()):
+            for file_path in list(path_to_local_backup_dir.glob(f"*{file_suffix}")) + \
+                    list(path_to_local_backup_dir.glob(f"*{file_suffix}.sha256")):
+                file_path.unlink()
+                logger.info(f'Old file_path deleted {str(file_path)}')
 
     else:
         logger.debug(f'There were no files to be deleted')
@@ -221,36 +1064,111 @@ def move_backup_csv_files(samba_user: str,
                           samba_server_ip: str,
                           samba_remote_name: str,
                           path_local_backup_folder: Path = Path('csv_backup'),
-                          path_remote_backup_folder: Path = Path('csv_backup')):
+                          path_remote_backup_folder: Path = Path('csv_backup'),
+                          compression: str = 'pgz',
+                          compression_level: int = None,
+                          compression_workers: int = None,
+                          streaming: bool = False,
+                          smb_pool: SmbConnectionPool = None,
+                          retention_policy: RetentionPolicy = RetentionPolicy(daily=7, weekly=4, monthly=6),
+                          retention_dry_run: bool = False):
     """Creates a tar file_path out of arctic csv backup files and moves it to a to samba share.
-       Removes old tar files
+       Removes old tar files, locally, and on the share those retention_policy does not keep. None keeps all.
+       With retention_dry_run, the tar files that would be removed from the share are only logged
        Deletes the csv files, so that folder is ready for new backup files.
-       Keeps current tar file_path in backup folder
+       Keeps current tar file_path in backup folder.
+       If streaming, the tar archive is uploaded while it is built, without writing it to local disk. As there is no
+       local copy, the csv files are then only deleted if the upload succeeded.
+       smb_pool: shared connection pool. If None, a connection is made for this call only
     """
 
     delete_old_tar_files(path_to_local_backup_dir=path_local_backup_folder)
-    path_to_tarfile = make_csv_tarfile(path_to_local_backup_dir=path_local_backup_folder)
 
-    smb = SmbClient(ip=samba_server_ip,
-                    username=samba_user,
-                    password=samba_password,
-                    remote_name=samba_remote_name,
-                    sharename=samba_share)
+    if not streaming:
+        path_to_tarfile = make_csv_tarfile(path_to_local_backup_dir=path_local_backup_folder,
+                                           compression=compression,
+                                           level=compression_level,
+                                           workers=compression_workers)
+
+    pool = smb_pool if smb_pool is not None else get_smb_pool(samba_user=samba_user,
+                                                              samba_password=samba_password,
+                                                              samba_share=samba_share,
+                                                              samba_server_ip=samba_server_ip,
+                                                              samba_remote_name=samba_remote_name)
+
+    archive_stored = not streaming
 
-    if smb.connect():
+    try:
+        with pool.connection() as smb:
 
-        smb.upload(local_file_path=path_to_tarfile,
-                   remote_folder_path=path_remote_backup_folder)
-        smb.delete_file_not_x_most_recent(subfolder=str(path_remote_backup_folder), threshold=5)
+            if streaming:
+                archive_stored = stream_csv_tar_to_share(smb=smb,
+                                                         path_to_local_backup_dir=path_local_backup_folder,
+                                                         path_remote_backup_folder=path_remote_backup_folder,
+                                                         compression=compression,
+                                                         level=compression_level,
+                                                         workers=compression_workers)
+
+            else:
+                # the sidecar after the archive, so a sidecar on the share means the archive is complete
+                if smb.upload_chunked(local_file_path=path_to_tarfile,
+                                      remote_folder_path=path_remote_backup_folder) is not None:
+                    smb.upload_chunked(local_file_path=path_to_tarfile.with_name(path_to_tarfile.name + '.sha256'),
+                                       remote_folder_path=path_remote_backup_folder)
 
-        smb.close()
+            if retention_policy is not None:
+                file_suffixes = tuple(set(COMPRESSION_FILE_SUFFIXES.values()))
+                apply_retention(smb=smb, folder=str(path_remote_backup_folder), policy=retention_policy,
+                                is_backup=lambda name: name.startswith('csv_backup_') and name.endswith(file_suffixes),
+                                dry_run=retention_dry_run)
+
+    except NotConnectedError:
+        logger.critical('failed to connect to samba share, could not move to external storage', exc_info=True)
+
+    finally:
+        if smb_pool is None:
+            pool.close_idle_connections()
+
+    if archive_stored:
+        for file in path_local_backup_folder.glob('**/*.csv'):
+            file.unlink()
 
     else:
-        logger.critical('failed to connect to samba share, could not move to external storage')
+        logger.warning(f'csv backup was not stored anywhere. Keeping csv files in {path_local_backup_folder}')
 
-    for file in path_local_backup_folder.glob('**/*.csv'):
-        file.unlink()
 
+def write_sha256_sidecar(file_path: Path, hexdigest: str = None) -> Path:
+    """Writes the sha256 of file to file_path.sha256, in the format of sha256sum. Returns path to the sidecar.
+       hexdigest: the sha256 if it was already computed while the file was written or uploaded, else the file is read
+    """
+
+    if hexdigest is None:
+        sha256 = hashlib.sha256()
+
+        with open(str(file_path), 'rb') as file_obj:
+            for block in iter(lambda: file_obj.read(1 << 20), b''):
+                sha256.update(block)
+
+        hexdigest = sha256.hexdigest()
+
+    sidecar_path = file_path.with_name(file_path.name + '.sha256')
+    sidecar_path.write_text(f'{hexdigest}  {file_path.name}\n')
+
+    return sidecar_path
+
+
+DB_BACKUP_FILE_SUFFIXES = ('.tar.gz',       # cold backup, tar of the stopped mongo_db volumes, by db_backup
+                           '.archive.gz')   # hot backup, mongodump archive of the live database, by db_backup_hot
+
+
+def get_db_backup_file_suffix(file_path: Path):
+    """Returns the db backup suffix the file name ends with, or None if it is not a db backup file"""
+
+    for file_suffix in DB_BACKUP_FILE_SUFFIXES:
+        if file_path.name.endswith(file_suffix):
+            return file_suffix
+
+    return None
 
 
 def move_db_backup_files(samba_user: str,
@@ -259,50 +1177,103 @@ def move_db_backup_files(samba_user: str,
                          samba_server_ip: str,
                          samba_remote_name: str,
                          path_local_backup_folder: Path = Path('db_backup'),
-                         path_remote_backup_folder: Path = Path('db_backup')):
-    """Moves generated tar files to samba share for external storage.
-       Does not remove any files. Files generated will be overwritten on next backup.
-       Therefore files in backup folder is always current.
+                         path_remote_backup_folder: Path = Path('db_backup'),
+                         upload_workers: int = 2,
+                         smb_pool: SmbConnectionPool = None,
+                         retention_policy: RetentionPolicy = None,
+                         retention_dry_run: bool = False):
+    """Moves generated db backup files, tar files or mongodump archives, to samba share for external storage.
        Renames the backup files when moving them onto external storage.
+       Local files are deleted once uploaded, so that we know if new backup files is generated next time.
+       Renamed files from earlier runs, whose upload failed, are uploaded again, resuming from the upload journal.
+       smb_pool: shared connection pool, also used for the parallel uploads. If None, connections are made for this call
+       retention_policy: backups on the share, with their sidecars, that the policy does not keep are deleted after
+                         the upload. None, the default, keeps all db backups
     """
 
-    smb = SmbClient(ip=samba_server_ip,
-                    username=samba_user,
-                    password=samba_password,
-                    remote_name=samba_remote_name,
-                    sharename=samba_share)
+    pool = smb_pool if smb_pool is not None else get_smb_pool(samba_user=samba_user,
+                                                              samba_password=samba_password,
+                                                              samba_share=samba_share,
+                                                              samba_server_ip=samba_server_ip,
+                                                              samba_remote_name=samba_remote_name)
 
-    if smb.connect():
+    try:
+        with pool.connection() as smb:
 
-        generator_compressed_files_in_folder = path_local_backup_folder.glob('*.tar.gz')
+            renamed_prefix = 'db_backup'
+            backup_files = sorted([file_path for file_path in path_local_backup_folder.iterdir()
+                                   if get_db_backup_file_suffix(file_path) is not None])
+            files_to_upload = [file_path for file_path in backup_files
+                               if file_path.name.startswith(f'{renamed_prefix}_')]
 
-        try:
-            file_path = next(generator_compressed_files_in_folder)
+            if len(files_to_upload) != 0:
+                logger.warning(f'Found db backups {files_to_upload} from earlier runs, not uploaded. Retrying')
 
-        except StopIteration:
-            msg = f"No tar.gz files found in {path_local_backup_folder}. Therefore no db backup moved"
-            logger.exception(msg)
-
-        else:
-            new_file_name = generate_tar_gz_filename_with_timestamp_suffix(prefix='db_backup')
-            path_with_new_file_name = file_path.with_name(new_file_name)
-            file_path.replace(path_with_new_file_name)
+            new_backup_files = [file_path for file_path in backup_files if file_path not in files_to_upload]
 
-            msg = f"{file_path} changed name to {path_with_new_file_name}, before upload"
-            logger.debug(msg)
+            if len(new_backup_files) == 0:
+                msg = f"No db backup files found in {path_local_backup_folder}. Therefore no db backup moved"
+                logger.error(msg)
 
-            smb.upload(local_file_path=path_with_new_file_name, remote_folder_path=path_remote_backup_folder)
-
-            if next(generator_compressed_files_in_folder, None) is not None:
-                msg = f"It appears that there was more than one tar.gz file in {path_local_backup_folder}"
-                msg += f" First item was treated as the correct backup file {file_path}, but might not be"
-                msg += " needs to be checked"
-                logger.warning(msg)
-
-            #Delete local backup file, so that we know if new backup files is generated next time
-            file_path.unlink()
-
-        smb.close()
+            else:
+                file_path = new_backup_files[0]
+                new_file_name = generate_tar_gz_filename_with_timestamp_suffix(
+                    prefix=renamed_prefix, file_suffix=get_db_backup_file_suffix(file_path))
+                path_with_new_file_name = file_path.with_name(new_file_name)
+                file_path.replace(path_with_new_file_name)
+
+                logger.debug('%s changed name to %s, before upload', file_path, path_with_new_file_name)
+
+                files_to_upload.append(path_with_new_file_name)
+
+                if len(new_backup_files) > 1:
+                    msg = f"It appears that there was more than one db backup file in {path_local_backup_folder}"
+                    msg += f" First item was treated as the correct backup file {file_path}, but might not be"
+                    msg += " needs to be checked"
+                    logger.warning(msg)
+
+            # hashed while read for upload, and stored next to the backup, so that restore_backups.py and
+            # backup_verifier.py can verify it. The sidecar is uploaded after the backup
+            sha256s = {local_file_path: hashlib.sha256() for local_file_path in files_to_upload}
+            upload_results = smb.upload_many(local_file_paths=files_to_upload,
+                                             remote_folder_path=path_remote_backup_folder,
+                                             workers=upload_workers,
+                                             smb_pool=pool,
+                                             sha256s=sha256s)
+
+            uploaded_files = [local_file_path for local_file_path in files_to_upload
+                              if upload_results[local_file_path] is not None]
+            sidecar_paths = [write_sha256_sidecar(file_path=local_file_path,
+                                                  hexdigest=sha256s[local_file_path].hexdigest())
+                             for local_file_path in uploaded_files]
+            upload_results.update(smb.upload_many(local_file_paths=sidecar_paths,
+                                                  remote_folder_path=path_remote_backup_folder,
+                                                  workers=upload_workers,
+                                                  smb_pool=pool))
+
+            for local_file_path in files_to_upload:
+                sidecar_path = local_file_path.with_name(local_file_path.name + '.sha256')
+
+                if upload_results[local_file_path] is not None and upload_results.get(sidecar_path) is not None:
+                    local_file_path.unlink()
+                    sidecar_path.unlink()
+
+                else:
+                    logger.warning(f'Upload of {local_file_path} or its checksum failed. Kept, upload will be '
+                                   f'resumed on next run')
+
+            if retention_policy is not None:
+                apply_retention(smb=smb, folder=str(path_remote_backup_folder), policy=retention_policy,
+                                is_backup=lambda name: name.startswith(f'{renamed_prefix}_') and
+                                get_db_backup_file_suffix(Path(name)) is not None,
+                                dry_run=retention_dry_run)
+
+    except NotConnectedError:
+        logger.critical('failed to connect to samba share, could not move to external storage', exc_info=True)
+
+    finally:
+        if smb_pool is None:
+            pool.close_idle_connections()
 
 
 if __name__ == '__main__':
@@ -1,7 +1,7 @@
 #!/bin/bash
 
-python3 run_monitor_once.py
+# asks the monitor service for a refresh, falls back to the fast monitor check if the service is not up
+curl -fsS --max-time 60 -X POST http://${IPV4_NETWORK_PART}0.13:8010/refresh > /dev/null || python3 run_monitor_fast.py
 
 cd sysproduction/linux/scripts
 . startup
-
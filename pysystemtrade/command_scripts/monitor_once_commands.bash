@@ -1,5 +1,5 @@
 #!/bin/bash
 
-python3 /opt/projects/pysystemtrade/run_monitor_once.py
-
-
+# asks the monitor service for a refresh, falls back to the fast monitor check if the service is not up
+curl -fsS --max-time 60 -X POST http://${IPV4_NETWORK_PART}0.13:8010/refresh > /dev/null ||
+    python3 /opt/projects/pysystemtrade/run_monitor_fast.py
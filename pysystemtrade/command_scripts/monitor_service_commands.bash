@@ -0,0 +1,3 @@
+#!/bin/bash
+
+python3 /opt/projects/pysystemtrade/monitor_service.py
@@ -0,0 +1,180 @@
+"""Long running replacement for run_monitor_once.py. Keeps one dataBlob open, refreshes the process status every
+MONITOR_REFRESH_SECONDS, and serves the cached result over http, so that the command scripts do not pay for the
+pysystemtrade imports and the mongo connection on every call;
+
+GET  /health   200 while the service runs
+GET  /status   the cached result of the last refresh, as json
+POST /refresh  refreshes now, unless the last refresh is younger than ?max_age= seconds, and returns the status
+
+The periodic refresh only updates the status with process control. The processes run in other containers, so their
+pids are not visible in this one, and checking them here would mark running processes as finished. Like
+run_monitor_once.py, the pid check is only run when a command script asks for it with POST /refresh
+"""
+
+import json
+import os
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from sysdata.data_blob import dataBlob
+from syscontrol.monitor import processMonitor, check_if_pid_running_and_if_not_finish
+
+MONITOR_PORT = int(os.environ.get('MONITOR_PORT', 8010))
+MONITOR_REFRESH_SECONDS = float(os.environ.get('MONITOR_REFRESH_SECONDS', 60))
+
+
+class MonitorState(object):
+    """The open dataBlob and processMonitor, and the result of the last refresh. pysystemtrade objects are only used
+       under the lock. If a refresh fails, for instance because mongo_db was stopped for a backup, the dataBlob is
+       closed and opened again on the next refresh
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = None
+        self.process_observatory = None
+        self.status = {'refreshed_at': None, 'pids_checked_at': None, 'refresh_seconds': None, 'refreshes': 0,
+                       'failed_refreshes': 0, 'last_error': None, 'processes': None}
+
+    def open(self):
+
+        self.data = dataBlob(log_name="system-monitor")
+        self.process_observatory = processMonitor(self.data)
+
+    def close(self):
+
+        try:
+            if self.data is not None:
+                self.data.close()
+
+        except Exception:
+            traceback.print_exc()
+
+        self.data = None
+        self.process_observatory = None
+
+    def get_process_table(self) -> str:
+
+        try:
+            from sysproduction.data.control_process import dataControlProcess
+            return str(dataControlProcess(self.data).get_dict_of_control_processes())
+
+        except Exception as e:
+            return f'not available: {e!r}'
+
+    def refresh(self, max_age: float = 0, check_pids: bool = False) -> dict:
+        """Updates the status with process control, and with check_pids first finishes the processes whose pid is not
+           running. Returns the cached status instead if the last refresh, with a pid check if check_pids, is younger
+           than max_age seconds
+        """
+
+        with self.lock:
+            last_refresh = self.status['pids_checked_at' if check_pids else 'refreshed_at']
+
+            if last_refresh is not None and time.time() - last_refresh < max_age:
+                return dict(self.status)
+
+            start = time.time()
+
+            try:
+                if self.data is None:
+                    self.open()
+
+                if check_pids:
+                    check_if_pid_running_and_if_not_finish(self.process_observatory)
+
+                self.process_observatory.update_all_status_with_process_control()
+
+                self.status.update(refreshed_at=time.time(), refresh_seconds=time.time() - start,
+                                   refreshes=self.status['refreshes'] + 1, last_error=None,
+                                   processes=self.get_process_table())
+
+                if check_pids:
+                    self.status['pids_checked_at'] = self.status['refreshed_at']
+
+            except Exception as e:
+                traceback.print_exc()
+                self.status.update(failed_refreshes=self.status['failed_refreshes'] + 1, last_error=repr(e))
+                self.close()
+
+            return dict(self.status)
+
+    def get_status(self) -> dict:
+
+        with self.lock:
+            return dict(self.status)
+
+
+state = MonitorState()
+
+
+class MonitorRequestHandler(BaseHTTPRequestHandler):
+
+    def send_json(self, status: dict):
+
+        body = json.dumps(status, default=str).encode()
+        healthy = status['last_error'] is None and status['refreshed_at'] is not None
+
+        self.send_response(200 if healthy else 503)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+
+        path = urlparse(self.path).path
+
+        if path == '/health':
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        elif path == '/status':
+            self.send_json(state.get_status())
+
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+
+        url = urlparse(self.path)
+
+        if url.path == '/refresh':
+            max_age = float(parse_qs(url.query).get('max_age', ['0'])[0])
+            self.send_json(state.refresh(max_age=max_age, check_pids=True))
+
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        print(f'{self.address_string()} {format % args}', flush=True)
+
+
+def refresh_periodically(stop_event: threading.Event):
+
+    while not stop_event.is_set():
+        status = state.refresh()
+        print(f'Refreshed process status in {status["refresh_seconds"]} seconds, last error {status["last_error"]}',
+              flush=True)
+        stop_event.wait(MONITOR_REFRESH_SECONDS)
+
+
+if __name__ == '__main__':
+
+    stop = threading.Event()
+    threading.Thread(target=refresh_periodically, args=(stop,), name='refresh', daemon=True).start()
+
+    server = ThreadingHTTPServer(('0.0.0.0', MONITOR_PORT), MonitorRequestHandler)
+    print(f'Monitor service listening on port {MONITOR_PORT}, refreshing every {MONITOR_REFRESH_SECONDS} seconds',
+          flush=True)
+
+    try:
+        server.serve_forever()
+
+    finally:
+        stop.set()
+        state.close()
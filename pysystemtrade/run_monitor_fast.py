@@ -0,0 +1,119 @@
+"""Lightweight run_monitor_once.py. Reads the process control collection with pymongo only, and checks whether the
+processes marked as running are still alive. Only if one is not, the pysystemtrade stack, with pandas and arctic, is
+imported and run_monitor_once.py's work done, which finishes the crashed processes and updates their status. So the
+common case, nothing crashed, costs a pymongo import and one query;
+
+python3 run_monitor_fast.py           fast check, full monitor if needed
+python3 run_monitor_fast.py --full    always the full monitor, like run_monitor_once.py
+"""
+
+import os
+import sys
+from pathlib import Path
+
+# as in pysystemtrade, private config overrides the defaults
+CONFIG_FILES = ['sysdata/config/defaults.yaml', 'private/private_config.yaml']
+MONGO_DEFAULTS = {'mongo_host': '127.0.0.1', 'mongo_db': 'production', 'mongo_port': 27017}
+
+PROCESS_CONTROL_COLLECTION = 'process_control'
+PROCESS_NAME_FIELD = 'process_name'
+PROCESS_ID_FIELD = 'process_id'
+NO_PROCESS_IDS = (None, '', 0, '0')
+
+
+def get_mongo_config(pysystemtrade_dir: Path = Path(__file__).resolve().parent) -> dict:
+    """mongo_host, mongo_db and mongo_port from the pysystemtrade config files"""
+
+    import yaml
+
+    mongo_config = dict(MONGO_DEFAULTS)
+
+    for config_file in CONFIG_FILES:
+        path = pysystemtrade_dir / config_file
+
+        if path.exists():
+            with path.open() as yaml_file:
+                file_config = yaml.safe_load(yaml_file) or {}
+
+            mongo_config.update({key: file_config[key] for key in MONGO_DEFAULTS if file_config.get(key) is not None})
+
+    return mongo_config
+
+
+def pid_running(process_id: int) -> bool:
+
+    try:
+        os.kill(process_id, 0)
+
+    except ProcessLookupError:
+        return False
+
+    except PermissionError:
+        return True
+
+    return True
+
+
+def get_crashed_processes(mongo_config: dict) -> list:
+    """Names of the processes in process control that have a process id, but no process with that id is alive.
+       Raises ValueError for a document without a process id field, as the format is then not the one expected
+    """
+
+    from pymongo import MongoClient
+
+    client = MongoClient(host=mongo_config['mongo_host'], port=int(mongo_config['mongo_port']),
+                         serverSelectionTimeoutMS=5000)
+
+    try:
+        documents = client[mongo_config['mongo_db']][PROCESS_CONTROL_COLLECTION].find(
+            {}, {PROCESS_NAME_FIELD: 1, PROCESS_ID_FIELD: 1, '_id': 0})
+        crashed = []
+
+        for document in documents:
+            if PROCESS_ID_FIELD not in document:
+                raise ValueError(f'No {PROCESS_ID_FIELD} in process control document {document}')
+
+            process_id = document[PROCESS_ID_FIELD]
+
+            if process_id not in NO_PROCESS_IDS and not pid_running(int(process_id)):
+                crashed.append(document.get(PROCESS_NAME_FIELD))
+
+        return crashed
+
+    finally:
+        client.close()
+
+
+def run_full_monitor():
+    """What run_monitor_once.py does"""
+
+    from sysdata.data_blob import dataBlob
+    from syscontrol.monitor import processMonitor, check_if_pid_running_and_if_not_finish
+
+    with dataBlob(log_name="system-monitor") as data:
+        process_observatory = processMonitor(data)
+        check_if_pid_running_and_if_not_finish(process_observatory)
+        process_observatory.update_all_status_with_process_control()
+
+
+def main(full: bool = False):
+
+    if not full:
+        try:
+            crashed = get_crashed_processes(get_mongo_config())
+
+        except Exception as e:
+            print(f'Fast process check failed with {e!r}, running the full monitor', flush=True)
+
+        else:
+            if len(crashed) == 0:
+                print('No crashed processes in process control', flush=True)
+                return
+
+            print(f'Processes not running anymore; {crashed}, running the full monitor', flush=True)
+
+    run_full_monitor()
+
+
+if __name__ == '__main__':
+    main(full='--full' in sys.argv[1:])
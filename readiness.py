@@ -0,0 +1,226 @@
+import socket
+import struct
+import time
+import itertools
+import threading
+from typing import Callable, Dict, Tuple
+
+from controller_logging import get_logger
+
+logger = get_logger(name=__name__)
+
+MONGO_PORT = 27017
+IB_GATEWAY_PORT = 4002
+
+# range of IB API versions the handshake offers, the gateway answers with the highest version it supports in range
+IB_API_MIN_VERSION = 100
+IB_API_MAX_VERSION = 176
+
+OP_MSG = 2013
+request_ids = itertools.count(1)
+
+
+def encode_bson(document: dict) -> bytes:
+    """Minimal BSON encoder for flat documents of int, float, bool and str values, enough for a command"""
+
+    elements = b''
+
+    for key, value in document.items():
+        name = key.encode() + b'\x00'
+
+        if isinstance(value, bool):
+            elements += b'\x08' + name + (b'\x01' if value else b'\x00')
+        elif isinstance(value, int):
+            elements += b'\x10' + name + struct.pack('<i', value)
+        elif isinstance(value, float):
+            elements += b'\x01' + name + struct.pack('<d', value)
+        elif isinstance(value, str):
+            encoded = value.encode() + b'\x00'
+            elements += b'\x02' + name + struct.pack('<i', len(encoded)) + encoded
+        else:
+            raise TypeError(f'Can not encode {type(value)} of {key} as BSON')
+
+    return struct.pack('<i', len(elements) + 5) + elements + b'\x00'
+
+
+def decode_bson(data: bytes) -> dict:
+    """Minimal BSON decoder for the top level scalar fields of a command reply. Stops at the first field of a type it
+       does not know, command replies have ok and errmsg before any nested documents
+    """
+
+    document = {}
+    length = struct.unpack_from('<i', data, 0)[0]
+    position = 4
+
+    while position < length - 1:
+        element_type = data[position]
+        name_end = data.index(b'\x00', position + 1)
+        name = data[position + 1:name_end].decode()
+        position = name_end + 1
+
+        if element_type == 0x01:
+            document[name] = struct.unpack_from('<d', data, position)[0]
+            position += 8
+        elif element_type == 0x02:
+            string_length = struct.unpack_from('<i', data, position)[0]
+            document[name] = data[position + 4:position + 4 + string_length - 1].decode()
+            position += 4 + string_length
+        elif element_type == 0x08:
+            document[name] = data[position] == 1
+            position += 1
+        elif element_type == 0x10:
+            document[name] = struct.unpack_from('<i', data, position)[0]
+            position += 4
+        elif element_type == 0x12:
+            document[name] = struct.unpack_from('<q', data, position)[0]
+            position += 8
+        else:
+            break
+
+    return document
+
+
+def receive_exactly(connection: socket.socket, number_of_bytes: int) -> bytes:
+
+    data = b''
+
+    while len(data) < number_of_bytes:
+        block = connection.recv(number_of_bytes - len(data))
+
+        if not block:
+            raise ConnectionError('Connection closed before the full reply was received')
+
+        data += block
+
+    return data
+
+
+def run_mongo_command(host: str, command: dict, port: int = MONGO_PORT, timeout: float = 2.0) -> dict:
+    """Sends a single command as an OP_MSG over a new connection and returns the reply document. No driver needed"""
+
+    body = struct.pack('<I', 0) + b'\x00' + encode_bson(command)
+    header = struct.pack('<iiii', 16 + len(body), next(request_ids), 0, OP_MSG)
+
+    with socket.create_connection((host, port), timeout=timeout) as connection:
+        connection.sendall(header + body)
+
+        reply_length, _, _, op_code = struct.unpack('<iiii', receive_exactly(connection, 16))
+        reply = receive_exactly(connection, reply_length - 16)
+
+    if op_code != OP_MSG:
+        raise ConnectionError(f'Unexpected reply op code {op_code} from mongo at {host}:{port}')
+
+    # flag bits, then a kind 0 section holding the reply document
+    return decode_bson(reply[5:])
+
+
+def mongo_ping(host: str, port: int = MONGO_PORT, timeout: float = 2.0) -> bool:
+    """True if mongod accepts connections and answers the ping command. An open port alone is not enough, mongod
+       listens before it has recovered its data files
+    """
+
+    return run_mongo_command(host=host, command={'ping': 1, '$db': 'admin'}, port=port, timeout=timeout).get('ok') == 1
+
+
+def port_open(host: str, port: int, timeout: float = 2.0) -> bool:
+    """True if a TCP connection to host:port can be made"""
+
+    with socket.create_connection((host, port), timeout=timeout):
+        return True
+
+
+def ib_api_handshake(host: str, port: int = IB_GATEWAY_PORT, timeout: float = 5.0) -> Tuple[int, str]:
+    """Does the opening handshake of the IB API, and returns the server version and connection time sent by the
+       gateway. The gateway only answers once it is logged in, so unlike an open port this means the API is usable.
+       The connection is closed before startApi, so no client id is taken
+    """
+
+    version_range = f'v{IB_API_MIN_VERSION}..{IB_API_MAX_VERSION}'.encode()
+
+    with socket.create_connection((host, port), timeout=timeout) as connection:
+        connection.sendall(b'API\x00' + struct.pack('>I', len(version_range)) + version_range)
+
+        length = struct.unpack('>I', receive_exactly(connection, 4))[0]
+
+        if not 0 < length < 1024:
+            raise ConnectionError(f'Unexpected handshake reply length {length} from ib_gateway at {host}:{port}')
+
+        fields = receive_exactly(connection, length).split(b'\x00')
+
+    return int(fields[0]), fields[1].decode() if len(fields) > 1 else ''
+
+
+class IbGatewayHealthProbe(object):
+    """Health check of the ib_gateway API by handshake. A successful handshake is cached for ttl seconds, so that
+       several callers can check the gateway without opening a connection each time. Failures are not cached
+    """
+
+    def __init__(self, host: str, port: int = IB_GATEWAY_PORT, ttl: float = 30, timeout: float = 5.0):
+        self.host = host
+        self.port = port
+        self.ttl = ttl
+        self.timeout = timeout
+        self.server_version = None
+        self.healthy_at = None
+        self.lock = threading.Lock()
+
+    def check(self) -> bool:
+        """True if the gateway completed a handshake within the last ttl seconds, or does so now. Raises the
+           connection error of the handshake if not healthy
+        """
+
+        with self.lock:
+            if self.healthy_at is not None and time.time() - self.healthy_at < self.ttl:
+                return True
+
+            self.healthy_at = None
+            self.server_version, connection_time = ib_api_handshake(host=self.host, port=self.port,
+                                                                    timeout=self.timeout)
+            self.healthy_at = time.time()
+
+        logger.debug('ib_gateway handshake ok, server version %s, connection time %s', self.server_version,
+                     connection_time)
+        return True
+
+
+def wait_until_ready(name: str, probe: Callable[[], bool], deadline: float = 180, initial_delay: float = 0.25,
+                     max_delay: float = 10, backoff: float = 2) -> float:
+    """Calls probe until it returns True, with exponentially growing delays between attempts. A probe raising an
+       exception counts as not ready. Returns the time to ready in seconds, raises TimeoutError after deadline seconds
+    """
+
+    start = time.time()
+    delay = initial_delay
+
+    for attempt in itertools.count(1):
+        try:
+            if probe():
+                time_to_ready = time.time() - start
+                logger.info(f'{name} ready after {time_to_ready:.2f} seconds and {attempt} probes')
+                return time_to_ready
+
+            last_error = 'probe returned False'
+
+        except Exception as e:
+            last_error = repr(e)
+
+        elapsed = time.time() - start
+
+        if elapsed >= deadline:
+            raise TimeoutError(f'{name} not ready after {elapsed:.1f} seconds and {attempt} probes. '
+                               f'Last probe: {last_error}')
+
+        logger.debug('%s not ready yet (%s), next probe in %.2f seconds', name, last_error, delay)
+        time.sleep(min(delay, deadline - elapsed))
+        delay = min(delay * backoff, max_delay)
+
+
+def get_ib_gateway_probe(ipv4_network_part: str) -> IbGatewayHealthProbe:
+    return IbGatewayHealthProbe(host=ipv4_network_part + '0.3')
+
+
+def get_dependency_probes(ipv4_network_part: str) -> Dict[str, Callable[[], bool]]:
+    """Readiness probes of the services the daily flow depends on, by container name"""
+
+    return {'mongo_db': lambda: mongo_ping(host=ipv4_network_part + '0.2'),
+            'ib_gateway': get_ib_gateway_probe(ipv4_network_part=ipv4_network_part).check}
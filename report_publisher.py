@@ -0,0 +1,719 @@
+import argparse
+import ctypes
+import ctypes.util
+import errno
+import os
+import re
+import select
+import struct
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import partial
+from pathlib import Path
+from typing import Dict, Iterable, List, Set, Tuple
+
+from dotenv import dotenv_values
+import git
+
+from controller_logging import get_logger
+from metrics import timed
+
+config = dotenv_values(".env")
+
+logger = get_logger(name=__name__)
+
+REPORTS_REPO = Path(config.get('REPORTS_REPO') or 'reports')
+# remote name, or url or path of a repo, like a local bare repo
+REPORT_PUBLISHER_REMOTE = config.get('REPORT_PUBLISHER_REMOTE') or 'origin'
+# changes are committed once the reports have been quiet for this long
+REPORT_PUBLISHER_BATCH_SECONDS = float(config.get('REPORT_PUBLISHER_BATCH_SECONDS') or 300)
+REPORT_PUSH_ATTEMPTS = int(config.get('REPORT_PUSH_ATTEMPTS') or 5)
+REPORT_PUSH_RETRY_SECONDS = float(config.get('REPORT_PUSH_RETRY_SECONDS') or 30)
+# weekly or monthly squashes the auto commits older than REPORT_COMPACTION_AFTER_DAYS into one per period
+REPORT_COMPACTION = config.get('REPORT_COMPACTION') or None
+REPORT_COMPACTION_AFTER_DAYS = float(config.get('REPORT_COMPACTION_AFTER_DAYS') or 30)
+
+# commits squashed by compaction. Snapshots of a shorter period are squashed again into a longer one
+COMPACTED_SUBJECT_PREFIXES = ('Auto commit ', 'Snapshot ')
+SNAPSHOT_SUBJECT_PATTERN = re.compile(r'Snapshot (\S+) of (\d+) commits$')
+COMPACTION_PERIODS = {'weekly': lambda commit_time: '%d-W%02d' % commit_time.isocalendar()[:2],
+                      'monthly': lambda commit_time: commit_time.strftime('%Y-%m')}
+COMPACTION_INTERVAL_SECONDS = 86400
+
+# remote head before a compaction not pushed yet, in the git config of the reports repo so that it survives a restart
+LEASE_CONFIG_KEY = 'reportpublisher.lease'
+
+PUSHED_BYTES_PATTERN = re.compile(r'Writing objects: +100% \(\d+/\d+\), ([\d.]+) (bytes|KiB|MiB|GiB)')
+BYTE_UNITS = {'bytes': 1, 'KiB': 1 << 10, 'MiB': 1 << 20, 'GiB': 1 << 30}
+
+# paths passed to a single git add or git rm
+GIT_PATHS_PER_CALL = 500
+
+# from linux/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class ChangeSet(object):
+    """Paths, relative to the work tree, changed since they were last taken. rescan is set when changes may have
+       been missed, the whole work tree is then staged on the next commit
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.paths = set()
+        self.rescan = False
+        self.last_change = 0.0
+
+    def add(self, paths: Iterable[str] = (), rescan: bool = False):
+
+        with self.lock:
+            self.paths.update(paths)
+            self.rescan = self.rescan or rescan
+            self.last_change = time.time()
+
+    def take(self) -> Tuple[Set[str], bool]:
+
+        with self.lock:
+            paths, rescan = self.paths, self.rescan
+            self.paths, self.rescan = set(), False
+
+        return paths, rescan
+
+    def is_empty(self) -> bool:
+
+        with self.lock:
+            return len(self.paths) == 0 and not self.rescan
+
+
+def walk_work_tree(path_to_repo: Path, relative_directory: str = ''):
+    """Directories below relative_directory of the work tree, .git left out, as (directory, file names). Paths are
+       relative to the work tree, '' is its root
+    """
+
+    for directory, directory_names, file_names in os.walk(str(path_to_repo / relative_directory)):
+        directory_names[:] = [name for name in directory_names if name != '.git']
+        directory = Path(directory).relative_to(path_to_repo).as_posix()
+        yield '' if directory == '.' else directory, file_names
+
+
+def join_relative(directory: str, name: str) -> str:
+    return name if directory == '' else f'{directory}/{name}'
+
+
+class InotifyWatcher(object):
+    """Watches every directory of the work tree with inotify, through ctypes, and adds the files written, moved or
+       deleted to a ChangeSet. Directories created later are watched as they appear. Raises OSError if inotify is not
+       available, or the watch limit is reached
+    """
+
+    def __init__(self, path_to_repo: Path, changes: ChangeSet):
+        self.path_to_repo = path_to_repo
+        self.changes = changes
+        self.lock = threading.Lock()
+        self.directories = {}
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        try:
+            self.watch_tree('')
+
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def watch_tree(self, relative_directory: str) -> List[str]:
+        """Watches relative_directory and the directories below it. Returns the files in them, which may have been
+           written before the watch was added
+        """
+
+        files = []
+
+        for directory, file_names in walk_work_tree(self.path_to_repo, relative_directory):
+            watch_descriptor = self.libc.inotify_add_watch(self.fd, str(self.path_to_repo / directory).encode(),
+                                                           WATCH_MASK)
+
+            if watch_descriptor < 0:
+                error_number = ctypes.get_errno()
+
+                # removed again before it was watched
+                if error_number == errno.ENOENT:
+                    continue
+
+                raise OSError(error_number, f'inotify_add_watch failed for {directory}')
+
+            self.directories[watch_descriptor] = directory
+            files += [join_relative(directory, name) for name in file_names]
+
+        return files
+
+    def collect(self):
+        """Reads the events queued so far, without waiting"""
+
+        with self.lock:
+            while True:
+                try:
+                    buffer = os.read(self.fd, 1 << 16)
+
+                except BlockingIOError:
+                    return
+
+                self.handle_events(buffer)
+
+    def handle_events(self, buffer: bytes):
+
+        changed = []
+        offset = 0
+
+        while offset < len(buffer):
+            watch_descriptor, mask, _, name_length = EVENT_HEADER.unpack_from(buffer, offset)
+            name = buffer[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + name_length].rstrip(b'\0')
+            offset += EVENT_HEADER.size + name_length
+
+            if mask & IN_Q_OVERFLOW:
+                logger.warning('inotify queue overflowed, reports work tree is rescanned on next commit')
+                self.changes.add(rescan=True)
+                continue
+
+            if mask & IN_IGNORED:
+                self.directories.pop(watch_descriptor, None)
+                continue
+
+            directory = self.directories.get(watch_descriptor)
+
+            if directory is None or mask & IN_DELETE_SELF:
+                continue
+
+            path = join_relative(directory, os.fsdecode(name))
+
+            if path == '.git' or path.startswith('.git/'):
+                continue
+
+            changed.append(path)
+
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    changed += self.watch_tree(path)
+
+                except OSError:
+                    logger.warning(f'Could not watch {path}, reports work tree is rescanned on next commit',
+                                   exc_info=True)
+                    self.changes.add(rescan=True)
+
+        if len(changed) != 0:
+            self.changes.add(changed)
+
+    def run(self, stop_event: threading.Event):
+
+        while not stop_event.is_set():
+            readable, _, _ = select.select([self.fd], [], [], 1)
+
+            if readable:
+                self.collect()
+
+        self.collect()
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """Fallback for InotifyWatcher. Compares the modification time and size of every file of the work tree with the
+       previous scan, every poll_interval seconds
+    """
+
+    def __init__(self, path_to_repo: Path, changes: ChangeSet, poll_interval: float = 30):
+        self.path_to_repo = path_to_repo
+        self.changes = changes
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.snapshot = self.scan()
+
+    def scan(self) -> Dict[str, Tuple[int, int]]:
+
+        snapshot = {}
+
+        for directory, file_names in walk_work_tree(self.path_to_repo):
+            for name in file_names:
+                path = join_relative(directory, name)
+
+                try:
+                    stat = os.stat(self.path_to_repo / path)
+
+                except FileNotFoundError:
+                    continue
+
+                snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+
+        return snapshot
+
+    def collect(self):
+
+        with self.lock:
+            snapshot = self.scan()
+            changed = [path for path, state in snapshot.items() if self.snapshot.get(path) != state]
+            changed += [path for path in self.snapshot if path not in snapshot]
+            self.snapshot = snapshot
+
+        if len(changed) != 0:
+            self.changes.add(changed)
+
+    def run(self, stop_event: threading.Event):
+
+        while not stop_event.wait(self.poll_interval):
+            self.collect()
+
+        self.collect()
+
+    def close(self):
+        pass
+
+
+class HistoryCommit(object):
+    """A commit on the first parent line of the reports branch, as listed by git log"""
+
+    LOG_FORMAT = '%x1f'.join(['%H', '%T', '%P', '%an', '%ae', '%ad', '%cn', '%ce', '%cd', '%s'])
+
+    def __init__(self, log_line: str):
+        (self.sha, self.tree, parents, self.author_name, self.author_email, self.author_date, self.committer_name,
+         self.committer_email, self.committer_date, self.subject) = log_line.split('\x1f')
+        self.parents = parents.split()
+        self.commit_time = datetime.fromtimestamp(int(self.committer_date.split()[0]))
+
+    def is_compactable(self, before: datetime) -> bool:
+        return self.subject.startswith(COMPACTED_SUBJECT_PREFIXES) and self.commit_time < before and \
+            len(self.parents) <= 1
+
+    def get_snapshot_period(self) -> str:
+        """Period of a snapshot commit made by compaction, None for other commits"""
+
+        match = SNAPSHOT_SUBJECT_PATTERN.match(self.subject)
+
+        return match.group(1) if match is not None else None
+
+    def get_number_of_commits(self) -> int:
+        """Auto commits squashed into this commit, 1 for a commit that is not a snapshot"""
+
+        match = SNAPSHOT_SUBJECT_PATTERN.match(self.subject)
+
+        return int(match.group(2)) if match is not None else 1
+
+    def get_environment(self) -> Dict[str, str]:
+        """Environment for git commit-tree giving a commit the author, committer and dates of this one"""
+
+        return dict(GIT_AUTHOR_NAME=self.author_name, GIT_AUTHOR_EMAIL=self.author_email,
+                    GIT_AUTHOR_DATE=self.author_date, GIT_COMMITTER_NAME=self.committer_name,
+                    GIT_COMMITTER_EMAIL=self.committer_email, GIT_COMMITTER_DATE=self.committer_date)
+
+
+def plan_compaction(commits: List[HistoryCommit], period: str,
+                    before: datetime) -> List[Tuple[str, List[HistoryCommit]]]:
+    """Groups the commits, oldest first, into runs of compactable commits of the same period, and single other
+       commits. Returns (period, commits) per group, period is None for commits that are kept as they are
+    """
+
+    get_period = COMPACTION_PERIODS[period]
+    groups = []
+
+    for commit in commits:
+        commit_period = get_period(commit.commit_time) if commit.is_compactable(before=before) else None
+
+        if commit_period is not None and len(groups) != 0 and groups[-1][0] == commit_period:
+            groups[-1][1].append(commit)
+
+        else:
+            groups.append((commit_period, [commit]))
+
+    return groups
+
+
+def parse_pushed_bytes(progress: str) -> int:
+    """Bytes written by a git push, from its --progress output. 0 if the remote was up to date"""
+
+    matches = PUSHED_BYTES_PATTERN.findall(progress)
+
+    if len(matches) == 0:
+        return 0
+
+    size, unit = matches[-1]
+
+    return int(float(size) * BYTE_UNITS[unit])
+
+
+def make_watcher(path_to_repo: Path, changes: ChangeSet):
+    """InotifyWatcher, or PollingWatcher where inotify is not available"""
+
+    try:
+        return InotifyWatcher(path_to_repo=path_to_repo, changes=changes)
+
+    except (OSError, AttributeError):
+        logger.warning(f'inotify not available for {path_to_repo}, polling for changes instead', exc_info=True)
+        return PollingWatcher(path_to_repo=path_to_repo, changes=changes)
+
+
+class ReportPublisher(object):
+    """Commits and pushes the reports repo in the background. A watcher thread records which files of the work
+       tree change, a commit thread stages only those files and commits them in one batch once the reports have been
+       quiet for batch_seconds, or when flush is called, and a push thread pushes after each commit, retrying with
+       backoff. A push that keeps failing is tried again after the next commit. Changes made while the publisher was
+       not running are picked up by a status scan of the whole work tree on start.
+       compaction: 'weekly' or 'monthly' squashes, once a day, the auto commits older than compact_after_days into
+                   one snapshot commit per period, so that the history, and what a clone fetches, stops growing with
+                   every daily commit. None keeps every commit
+    """
+
+    def __init__(self, path_to_repo: Path = REPORTS_REPO, remote: str = REPORT_PUBLISHER_REMOTE,
+                 batch_seconds: float = REPORT_PUBLISHER_BATCH_SECONDS, push_attempts: int = REPORT_PUSH_ATTEMPTS,
+                 push_retry_seconds: float = REPORT_PUSH_RETRY_SECONDS, compaction: str = REPORT_COMPACTION,
+                 compact_after_days: float = REPORT_COMPACTION_AFTER_DAYS):
+
+        if compaction is not None and compaction not in COMPACTION_PERIODS:
+            raise ValueError(f'Unknown compaction {compaction}, must be one of {list(COMPACTION_PERIODS)}')
+
+        self.path_to_repo = Path(path_to_repo)
+        self.repo = git.Repo(str(self.path_to_repo))
+        self.remote = remote
+        self.batch_seconds = batch_seconds
+        self.push_attempts = push_attempts
+        self.push_retry_seconds = push_retry_seconds
+        self.compaction = compaction
+        self.compact_after_days = compact_after_days
+        self.last_compaction = 0.0
+
+        self.changes = ChangeSet()
+        self.watcher = None
+        self.commit_lock = threading.Lock()
+        self.push_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.commit_wanted = threading.Event()
+        self.push_wanted = threading.Event()
+        self.threads = []
+
+    def start(self):
+
+        self.watcher = make_watcher(path_to_repo=self.path_to_repo, changes=self.changes)
+        self.changes.add(rescan=True)
+
+        for name, target in [('watch', partial(self.watcher.run, stop_event=self.stop_event)),
+                             ('commit', self.commit_batches), ('push', self.push_commits)]:
+            thread = threading.Thread(target=target, name=f'report_publisher_{name}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+        self.commit_wanted.set()
+
+    def stop(self, timeout: float = 60):
+        """Commits what is pending and makes a last attempt to push, waiting up to timeout seconds for it"""
+
+        self.stop_event.set()
+
+        for thread in self.threads:
+            thread.join(timeout=timeout)
+
+        self.threads = []
+
+        try:
+            if self.commit_pending():
+                self.push()
+
+        finally:
+            if self.watcher is not None:
+                self.watcher.close()
+
+    def flush(self):
+        """Commits the changes recorded so far now, and has them pushed in the background. Returns without waiting
+           for the push
+        """
+
+        if self.watcher is not None:
+            self.watcher.collect()
+
+        if self.commit_pending():
+            self.push_wanted.set()
+
+    def commit_batches(self):
+
+        while not self.stop_event.is_set():
+            if self.changes.is_empty() and not self.commit_wanted.is_set():
+                self.stop_event.wait(1)
+                continue
+
+            # wait for the reports to be quiet, so that a run of reports is committed as one
+            quiet_for = time.time() - self.changes.last_change
+
+            if not self.commit_wanted.is_set() and quiet_for < self.batch_seconds:
+                self.stop_event.wait(min(self.batch_seconds - quiet_for, 1))
+                continue
+
+            self.commit_wanted.clear()
+
+            try:
+                if self.commit_pending():
+                    self.push_wanted.set()
+
+            except Exception:
+                logger.warning('Committing reports failed, retrying with the next batch', exc_info=True)
+                self.changes.add(rescan=True)
+
+            if self.compaction is not None and time.time() - self.last_compaction > COMPACTION_INTERVAL_SECONDS:
+                self.last_compaction = time.time()
+
+                try:
+                    if self.compact() > 0:
+                        self.push_wanted.set()
+
+                except Exception:
+                    logger.warning('Compacting the reports history failed', exc_info=True)
+
+    def commit_pending(self) -> bool:
+        """Stages the changed files and commits them. True if a commit was made"""
+
+        with self.commit_lock:
+            paths, rescan = self.changes.take()
+
+            if not rescan and len(paths) == 0:
+                return False
+
+            try:
+                with timed('report_commit', rescan=rescan) as measurement:
+                    if rescan:
+                        self.repo.git.add(all=True)
+
+                    else:
+                        self.stage(paths)
+
+                    if not self.repo.is_dirty(index=True, working_tree=False, untracked_files=False):
+                        logger.debug('No changes to the reports to commit')
+                        return False
+
+                    self.repo.git.commit('-q', '-m', f'Auto commit {datetime.now().strftime("%d%m%Y %H:%M:%S")}')
+                    measurement.bytes_processed = sum(os.path.getsize(self.path_to_repo / path) for path in paths
+                                                      if (self.path_to_repo / path).is_file())
+
+            except Exception:
+                self.changes.add(paths=paths, rescan=rescan)
+                raise
+
+        logger.info(f'Committed {"all changes" if rescan else f"{len(paths)} changed paths"} of the reports')
+
+        return True
+
+    def stage(self, paths: Set[str]):
+        """git add of the existing paths, and removal from the index of the deleted ones. Ignored files are left"""
+
+        existing = sorted(path for path in paths if (self.path_to_repo / path).exists())
+        deleted = sorted(path for path in paths if not (self.path_to_repo / path).exists())
+
+        for start in range(0, len(existing), GIT_PATHS_PER_CALL):
+            batch = existing[start:start + GIT_PATHS_PER_CALL]
+            ignored = set(self.repo.git.check_ignore('--', *batch, with_exceptions=False).splitlines())
+            batch = [path for path in batch if path not in ignored]
+
+            if len(batch) != 0:
+                self.repo.git.add('-A', '--', *batch)
+
+        for start in range(0, len(deleted), GIT_PATHS_PER_CALL):
+            self.repo.git.rm('-r', '-q', '--cached', '--ignore-unmatch', '--',
+                             *deleted[start:start + GIT_PATHS_PER_CALL])
+
+    def push_commits(self):
+
+        while not self.stop_event.is_set():
+            if not self.push_wanted.wait(timeout=1):
+                continue
+
+            self.push_wanted.clear()
+
+            for attempt in range(self.push_attempts):
+                if self.push():
+                    break
+
+                if attempt + 1 < self.push_attempts and self.stop_event.wait(self.push_retry_seconds * 2 ** attempt):
+                    break
+
+            else:
+                logger.warning(f'Pushing reports failed {self.push_attempts} times, trying again after next commit')
+
+    def push(self) -> bool:
+        """Pushes the current branch to remote. True if it succeeded. After a compaction the rewritten branch is
+           force pushed, but only if the remote still has the head it had when the history was compacted. The
+           bytes pushed are recorded with the push timing in the metrics store
+        """
+
+        arguments = ['--progress', self.remote, 'HEAD']
+
+        with self.push_lock:
+            lease = self.repo.git.config('--get', LEASE_CONFIG_KEY, with_exceptions=False)
+
+            if lease != '':
+                arguments.insert(0, f'--force-with-lease={self.repo.active_branch.name}:{lease}')
+
+            try:
+                with timed('report_push', remote=self.remote, forced=lease != '') as measurement:
+                    _, _, progress = self.repo.git.push(*arguments, with_extended_output=True)
+                    measurement.bytes_processed = parse_pushed_bytes(progress)
+
+            except git.GitCommandError:
+                logger.warning(f'Pushing reports to {self.remote} failed', exc_info=True)
+                return False
+
+            if lease != '':
+                self.repo.git.config('--unset', LEASE_CONFIG_KEY)
+
+        logger.info(f'Pushed {measurement.bytes_processed} bytes of reports to {self.remote}',
+                    extra={'bytes': measurement.bytes_processed})
+
+        return True
+
+    def get_remote_head(self, branch: str):
+        """Commit of branch on the remote, None if the remote does not have the branch"""
+
+        remote_heads = self.repo.git.ls_remote(self.remote, f'refs/heads/{branch}').split()
+
+        return remote_heads[0] if len(remote_heads) != 0 else None
+
+    def has_commit(self, commit: str, head: str) -> bool:
+        """True if commit is head or one of its ancestors. False also if this repo does not have commit at all"""
+
+        try:
+            return self.repo.is_ancestor(commit, head)
+
+        except git.GitCommandError:
+            return False
+
+    def compact(self, before: datetime = None) -> int:
+        """Squashes runs of auto commits older than before, by default compact_after_days ago, into one snapshot
+           commit per period, with the tree of the last commit of the run. The commits after the first squashed run
+           are recreated on top, with their own trees, messages and dates, so the work tree and index are unchanged.
+           Not done if the remote has commits this repo does not, or a merge commit would have to be recreated.
+           The repo is only repacked when a snapshot of a new period was made, not when newly old auto commits were
+           squashed into the snapshot of a period that already had one. Returns the number of commits removed from
+           the branch
+        """
+
+        before = before if before is not None else datetime.now() - timedelta(days=self.compact_after_days)
+
+        with self.commit_lock, self.push_lock:
+            branch = self.repo.active_branch.name
+            old_head = self.repo.head.commit.hexsha
+            remote_head = self.get_remote_head(branch)
+
+            if remote_head is not None and not self.has_commit(remote_head, head=old_head):
+                logger.warning(f'{self.remote} has commits on {branch} that are not in the reports repo, history is '
+                               f'not compacted')
+                return 0
+
+            commits = [HistoryCommit(log_line) for log_line in
+                       self.repo.git.log('--first-parent', '--reverse', '--date=raw',
+                                         f'--format={HistoryCommit.LOG_FORMAT}').splitlines()]
+            groups = plan_compaction(commits=commits, period=self.compaction, before=before)
+            squashed_runs = [index for index, (_, group) in enumerate(groups) if len(group) > 1]
+
+            if len(squashed_runs) == 0:
+                logger.debug('No reports history to compact')
+                return 0
+
+            recreated = groups[squashed_runs[0]:]
+
+            if any(len(commit.parents) > 1 for _, group in recreated for commit in group):
+                logger.warning('Merge commit in the reports history to compact, history is not compacted')
+                return 0
+
+            first_commit = recreated[0][1][0]
+            new_head = first_commit.parents[0] if len(first_commit.parents) != 0 else None
+            new_periods = [period for period, group in recreated if len(group) > 1 and
+                           all(commit.get_snapshot_period() != period for commit in group)]
+
+            with timed('report_compaction', period=self.compaction):
+                for period, group in recreated:
+                    if len(group) > 1:
+                        number_of_commits = sum(commit.get_number_of_commits() for commit in group)
+                        message = f'Snapshot {period} of {number_of_commits} commits'
+
+                    else:
+                        message = self.repo.git.log('-1', '--format=%B', group[0].sha)
+
+                    with self.repo.git.custom_environment(**group[-1].get_environment()):
+                        new_head = self.repo.git.commit_tree(group[-1].tree, '-m', message,
+                                                             *(['-p', new_head] if new_head is not None else []))
+
+                self.repo.git.update_ref(f'refs/heads/{branch}', new_head, old_head)
+
+            # the remote head to lease against is the one before the first compaction not pushed yet
+            if remote_head is not None and self.repo.git.config('--get', LEASE_CONFIG_KEY,
+                                                                 with_exceptions=False) == '':
+                self.repo.git.config(LEASE_CONFIG_KEY, remote_head)
+
+        removed = len(commits) - len(groups)
+        logger.info(f'Compacted {removed + len(squashed_runs)} commits of the reports history into '
+                    f'{len(squashed_runs)} {self.compaction} snapshots, {len(new_periods)} of them new')
+
+        if len(new_periods) != 0:
+            self.repack()
+
+        return removed
+
+    def repack(self):
+        """Drops the commits squashed by compaction, and repacks with a wide delta window, as daily reports differ
+           little. Rewrites every pack, so it is only done once per new snapshot period
+        """
+
+        with timed('report_repack'):
+            self.repo.git.reflog('expire', '--expire-unreachable=now', '--all')
+            self.repo.git.gc('--aggressive', '--prune=now', '--quiet')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Commits and pushes the reports repo, once or while watching it')
+    parser.add_argument('--repo', default=str(REPORTS_REPO))
+    parser.add_argument('--remote', default=REPORT_PUBLISHER_REMOTE, help='remote name, or url or path of a repo')
+    parser.add_argument('--batch-seconds', type=float, default=REPORT_PUBLISHER_BATCH_SECONDS)
+    parser.add_argument('--watch', action='store_true', help='keep watching until interrupted')
+    parser.add_argument('--compact', choices=list(COMPACTION_PERIODS), default=REPORT_COMPACTION,
+                        help='squash old auto commits into one snapshot per period, then push')
+    parser.add_argument('--compact-after-days', type=float, default=REPORT_COMPACTION_AFTER_DAYS)
+    arguments = parser.parse_args()
+
+    publisher = ReportPublisher(path_to_repo=Path(arguments.repo), remote=arguments.remote,
+                                batch_seconds=arguments.batch_seconds, compaction=arguments.compact,
+                                compact_after_days=arguments.compact_after_days)
+
+    if arguments.watch:
+        publisher.start()
+
+        try:
+            while True:
+                time.sleep(60)
+
+        except KeyboardInterrupt:
+            pass
+
+        publisher.stop()
+
+    else:
+        publisher.changes.add(rescan=True)
+        publisher.commit_pending()
+
+        if publisher.compaction is not None:
+            publisher.compact()
+
+        publisher.push()
@@ -0,0 +1,297 @@
+import argparse
+import gzip
+import hashlib
+import queue
+import shutil
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, Tuple
+
+import docker
+from dotenv import dotenv_values
+
+from move_backups import SmbClient, get_db_backup_file_suffix
+from controller_logging import get_logger
+
+config = dotenv_values(".env")
+
+logger = get_logger(name=__name__)
+
+CHUNK_SIZE = 1 << 20
+
+
+class ThroughputCounter(object):
+    """Counts bytes passing through a chunk iterator, for throughput reporting"""
+
+    def __init__(self):
+        self.bytes = 0
+        self.start = time.time()
+
+    def count(self, chunks: Iterator[bytes]) -> Iterator[bytes]:
+        for chunk in chunks:
+            self.bytes += len(chunk)
+            yield chunk
+
+    def report(self, what: str) -> str:
+        seconds = max(time.time() - self.start, 1e-9)
+        return f'{what}; {self.bytes / 1e6:.1f} MB in {seconds:.1f} s, {self.bytes / seconds / 1e6:.1f} MB/s'
+
+
+def fetch_backup_from_share(smb: SmbClient, path_remote_backup_folder: Path, file_name: str,
+                            path_local_folder: Path) -> Tuple[Path, str]:
+    """Downloads backup file, and its .sha256 sidecar if there is one, to local folder. The file is hashed while it is
+       downloaded. Returns local path, and the sha256 of the file to pass on to verify_checksum
+    """
+
+    path_local_folder.mkdir(parents=True, exist_ok=True)
+    local_file_path = path_local_folder / file_name
+
+    counter = ThroughputCounter()
+    sha256 = hashlib.sha256()
+
+    if not smb.download(remote_path_str=str(path_remote_backup_folder / file_name), local_file_path=local_file_path,
+                        sha256=sha256):
+        raise FileNotFoundError(f'Could not download {file_name} from samba share')
+
+    counter.bytes = local_file_path.stat().st_size
+    logger.info(counter.report(f'Downloaded {file_name}'))
+
+    smb.download(remote_path_str=str(path_remote_backup_folder / (file_name + '.sha256')),
+                 local_file_path=path_local_folder / (file_name + '.sha256'))
+
+    return local_file_path, sha256.hexdigest()
+
+
+def get_latest_backup_name_on_share(smb: SmbClient, path_remote_backup_folder: Path) -> str:
+
+    file_names = [file.filename for file in smb.get_cached_list_of_files(subfolder=str(path_remote_backup_folder))
+                  if get_db_backup_file_suffix(Path(file.filename)) is not None]
+
+    if len(file_names) == 0:
+        raise FileNotFoundError(f'No db backups found on samba share in {path_remote_backup_folder}')
+
+    # names carry a sortable timestamp
+    return sorted(file_names)[-1]
+
+
+def verify_checksum(file_path: Path, require_checksum: bool = False, hexdigest: str = None) -> bool:
+    """Checks file against the sha256 in file_path.sha256. Returns True if it matches. If there is no sidecar, returns
+       True with a warning, unless require_checksum. Raises ValueError on mismatch.
+       hexdigest: the sha256 if it was already computed while the file was downloaded, else the file is read
+    """
+
+    sidecar_path = file_path.with_name(file_path.name + '.sha256')
+
+    if not sidecar_path.exists():
+        if require_checksum:
+            raise FileNotFoundError(f'No stored checksum {sidecar_path} for {file_path}')
+
+        logger.warning(f'No stored checksum for {file_path}, integrity can not be verified')
+        return True
+
+    expected = sidecar_path.read_text().split()[0]
+
+    if hexdigest is None:
+        counter = ThroughputCounter()
+        sha256 = hashlib.sha256()
+
+        with open(str(file_path), 'rb') as file_obj:
+            for block in counter.count(iter(lambda: file_obj.read(CHUNK_SIZE), b'')):
+                sha256.update(block)
+
+        logger.info(counter.report(f'Hashed {file_path.name}'))
+        hexdigest = sha256.hexdigest()
+
+    logger.info(f'Verified checksum of {file_path.name}')
+
+    if hexdigest != expected:
+        raise ValueError(f'Checksum of {file_path} does not match stored checksum. Backup is corrupt')
+
+    return True
+
+
+def iterate_decompressed(file_path: Path, max_buffered_chunks: int = 16) -> Iterator[bytes]:
+    """Yields the decompressed content of a .gz or .zst file in chunks. Uses pigz, or zstd, with its own threads when
+       installed. Otherwise the file is decompressed with zlib in a separate thread, so that reading and decompressing
+       overlaps with the consumer of the chunks
+    """
+
+    if file_path.name.endswith('.zst') or shutil.which('pigz') is not None:
+        command = ['zstd', '-dc', '-T0'] if file_path.name.endswith('.zst') else ['pigz', '-dc']
+        logger.info(f'Decompressing {file_path.name} with {command[0]}')
+
+        process = subprocess.Popen(command + [str(file_path)], stdout=subprocess.PIPE)
+
+        try:
+            for chunk in iter(lambda: process.stdout.read(CHUNK_SIZE), b''):
+                yield chunk
+
+        finally:
+            process.stdout.close()
+
+        if process.wait() != 0:
+            raise RuntimeError(f'{command[0]} failed to decompress {file_path}')
+
+        return
+
+    logger.info(f'Decompressing {file_path.name} with zlib in a separate thread')
+
+    chunks = queue.Queue(maxsize=max_buffered_chunks)
+    end_of_stream = object()
+    errors = []
+
+    def decompress():
+        try:
+            with gzip.open(str(file_path), 'rb') as gzip_file:
+                for chunk in iter(lambda: gzip_file.read(CHUNK_SIZE), b''):
+                    chunks.put(chunk)
+
+        except Exception as e:
+            errors.append(e)
+
+        finally:
+            chunks.put(end_of_stream)
+
+    decompressor = threading.Thread(target=decompress, name='decompress', daemon=True)
+    decompressor.start()
+
+    while True:
+        chunk = chunks.get()
+
+        if chunk is end_of_stream:
+            break
+
+        yield chunk
+
+    decompressor.join()
+
+    if len(errors) != 0:
+        raise errors[0]
+
+
+def restore_volume_tar(docker_client: docker.client, name_suffix: str, file_path: Path):
+    """Extracts a cold db backup, a tar of /data from db_backup, straight into the mongo volumes. The decompressed
+       tar stream is sent to docker, which extracts it in a helper container with the volumes mounted.
+       mongo_db must be stopped
+    """
+
+    mongo_db = docker_client.containers.get(container_id='mongo_db' + name_suffix)
+
+    if mongo_db.status == 'running':
+        raise RuntimeError('mongo_db is running. Stop it before restoring a cold backup into its volumes')
+
+    helper = docker_client.containers.create(image='alpine',
+                                             command='true',
+                                             volumes={f'mongo_db_volume{name_suffix}': {'bind': '/data/db',
+                                                                                        'mode': 'rw'},
+                                                      f'mongo_conf_volume{name_suffix}': {'bind': '/data/configdb',
+                                                                                          'mode': 'rw'}})
+
+    counter = ThroughputCounter()
+
+    try:
+        # members are data/db/... and data/configdb/..., as db_backup tars /data/
+        helper.put_archive(path='/', data=counter.count(iterate_decompressed(file_path=file_path)))
+
+    finally:
+        helper.remove(force=True)
+
+    logger.info(counter.report(f'Extracted {file_path.name} into mongo volumes'))
+
+
+def restore_mongodump_archive(docker_client: docker.client, name_suffix: str, file_path: Path, workers: int = 4):
+    """Restores a hot db backup, a gzip mongodump archive, into the running mongo_db with parallel collections and
+       insertion workers. file_path must be in the local db_backup folder, which is mounted into the helper container.
+       With a replica set, the dump was taken with --oplog, and the oplog is replayed to make it consistent
+    """
+
+    oplog_replay = ['--oplogReplay'] if config.get('MONGO_REPLSET_ARGS') else []
+
+    counter = ThroughputCounter()
+    counter.bytes = file_path.stat().st_size
+
+    docker_client.containers.run(image='mongo',
+                                 command=['mongorestore',
+                                          f'--host={config["IPV4_NETWORK_PART"]}0.2',
+                                          '--gzip', '--drop', f'--archive=/backup/{file_path.name}',
+                                          f'--numParallelCollections={workers}',
+                                          f'--numInsertionWorkersPerCollection={workers}'] + oplog_replay,
+                                 volumes={str(file_path.parent.resolve()): {'bind': '/backup', 'mode': 'ro'}},
+                                 network=f'channel{name_suffix}',
+                                 remove=True)
+
+    logger.info(counter.report(f'Restored {file_path.name} into mongo_db, compressed size'))
+
+
+def restore_db_backup(docker_client: docker.client, name_suffix: str, file_path: Path,
+                      require_checksum: bool = False, workers: int = 4, hexdigest: str = None):
+    """Verifies the backup against its stored checksum, and restores it the way its type requires.
+       hexdigest: see verify_checksum
+    """
+
+    start = time.time()
+    verify_checksum(file_path=file_path, require_checksum=require_checksum, hexdigest=hexdigest)
+
+    if get_db_backup_file_suffix(file_path) == '.archive.gz':
+        restore_mongodump_archive(docker_client=docker_client, name_suffix=name_suffix, file_path=file_path,
+                                  workers=workers)
+
+    else:
+        restore_volume_tar(docker_client=docker_client, name_suffix=name_suffix, file_path=file_path)
+
+    logger.info(f'Restore of {file_path.name} finished after {time.time() - start:.1f} seconds')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Restores a db backup made by db_backup or db_backup_hot')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--local', type=Path, help='path of a local backup file')
+    source.add_argument('--from-share', metavar='FILE_NAME',
+                        help='name of backup file in the db_backup folder of the samba share, or "latest"')
+    parser.add_argument('--download-folder', type=Path, default=Path('db_backup'),
+                        help='where a backup from the share is stored. Must be db_backup for hot backups')
+    parser.add_argument('--require-checksum', action='store_true',
+                        help='fail if there is no stored checksum to verify the backup against')
+    parser.add_argument('--workers', type=int, default=4, help='parallel collections/insertion workers')
+    parser.add_argument('--download-only', action='store_true',
+                        help='only fetch the backup from the share and verify it, for a restore with docker compose')
+    arguments = parser.parse_args()
+    hexdigest = None
+
+    if arguments.from_share:
+        smb = SmbClient(ip=config['SAMBA_SERVER_IP'],
+                        username=config['SAMBA_USER'],
+                        password=config['SAMBA_PASSWORD'],
+                        remote_name=config['SAMBA_REMOTE_NAME'],
+                        sharename=config['SAMBA_SHARE'])
+
+        if not smb.connect():
+            raise ConnectionError('Could not connect to samba share')
+
+        file_name = arguments.from_share
+
+        if file_name == 'latest':
+            file_name = get_latest_backup_name_on_share(smb=smb, path_remote_backup_folder=Path('db_backup'))
+
+        path_to_backup, hexdigest = fetch_backup_from_share(smb=smb, path_remote_backup_folder=Path('db_backup'),
+                                                            file_name=file_name,
+                                                            path_local_folder=arguments.download_folder)
+        smb.close()
+
+    else:
+        path_to_backup = arguments.local
+
+    if arguments.download_only:
+        verify_checksum(file_path=path_to_backup, require_checksum=arguments.require_checksum, hexdigest=hexdigest)
+        print(path_to_backup)
+
+    else:
+        restore_db_backup(docker_client=docker.DockerClient(base_url='unix://var/run/docker.sock'),
+                          name_suffix=config['NAME_SUFFIX'],
+                          file_path=path_to_backup,
+                          require_checksum=arguments.require_checksum,
+                          workers=arguments.workers,
+                          hexdigest=hexdigest)
@@ -0,0 +1,184 @@
+import argparse
+import re
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+from dotenv import dotenv_values
+
+from controller_logging import get_logger, lazy
+from smb_listing_cache import SMB_LISTING_CACHE_MAX_AGE
+
+config = dotenv_values(".env")
+
+logger = get_logger(name=__name__)
+
+# timestamp in backup file names, as made by generate_tar_gz_filename_with_timestamp_suffix
+BACKUP_TIMESTAMP_PATTERN = re.compile(r'(\d{4})_(\d{2})_(\d{2})_(\d{2})_(\d{2})_(\d{2})')
+
+# files belonging to a backup, deleted together with it
+SIDECAR_SUFFIXES = ('.sha256',)
+
+TIERS = ('daily', 'weekly', 'monthly')
+
+
+class RetentionPolicy(object):
+    """Grandfather-father-son retention. Keeps the newest backup of each of the last daily days, weekly iso weeks
+       and monthly months that have backups. A backup kept by any tier is kept
+    """
+
+    def __init__(self, daily: int = 7, weekly: int = 4, monthly: int = 6):
+
+        if daily + weekly + monthly <= 0:
+            raise ValueError('Retention policy would delete every backup, at least one tier must keep a backup')
+
+        self.daily = daily
+        self.weekly = weekly
+        self.monthly = monthly
+
+    @classmethod
+    def from_string(cls, policy: str):
+        """Parses a policy like 'daily:7,weekly:4,monthly:6'. Tiers left out keep nothing. Empty string gives None,
+           meaning no retention
+        """
+
+        if policy is None or policy.strip() == '':
+            return None
+
+        counts = {}
+
+        for tier_count in policy.split(','):
+            tier, _, count = tier_count.strip().partition(':')
+
+            if tier not in TIERS:
+                raise ValueError(f'Unknown retention tier {tier} in {policy}, must be one of {TIERS}')
+
+            counts[tier] = int(count)
+
+        return cls(**{tier: counts.get(tier, 0) for tier in TIERS})
+
+    def __repr__(self):
+        return f'RetentionPolicy(daily={self.daily}, weekly={self.weekly}, monthly={self.monthly})'
+
+
+def get_backup_time(file_name: str, create_time: float) -> datetime:
+    """Time of the backup from the timestamp in its name, or the create time on the share if it has none"""
+
+    match = BACKUP_TIMESTAMP_PATTERN.search(file_name)
+
+    if match is not None:
+        return datetime(*[int(part) for part in match.groups()])
+
+    return datetime.fromtimestamp(create_time)
+
+
+def get_backup_name(file_name: str) -> str:
+    """Name of the backup a file belongs to, the name without a sidecar suffix"""
+
+    for suffix in SIDECAR_SUFFIXES:
+        if file_name.endswith(suffix):
+            return file_name[:-len(suffix)]
+
+    return file_name
+
+
+def select_backups_to_delete(backups: Dict[str, datetime], policy: RetentionPolicy) -> List[str]:
+    """Names of the backups the policy does not keep, oldest first. One sort, then one pass over the backups"""
+
+    tiers = [(policy.daily, lambda backup_time: backup_time.date()),
+             (policy.weekly, lambda backup_time: backup_time.isocalendar()[:2]),
+             (policy.monthly, lambda backup_time: (backup_time.year, backup_time.month))]
+
+    periods_kept = [set() for _ in tiers]
+    to_delete = []
+
+    for name, backup_time in sorted(backups.items(), key=lambda item: (item[1], item[0]), reverse=True):
+        keep = False
+
+        for (number_to_keep, get_period), kept in zip(tiers, periods_kept):
+            period = get_period(backup_time)
+
+            # the first backup met of a period is its newest
+            if period not in kept and len(kept) < number_to_keep:
+                kept.add(period)
+                keep = True
+
+        if not keep:
+            to_delete.append(name)
+
+    return list(reversed(to_delete))
+
+
+def plan_retention(files: Dict[str, float], policy: RetentionPolicy,
+                   is_backup: Callable[[str], bool]) -> Tuple[List[str], List[str]]:
+    """Returns the backups to delete, oldest first, and all their files, sidecars included. Only backups that
+       is_backup accepts are considered
+    """
+
+    backups = {name: get_backup_time(file_name=name, create_time=create_time)
+               for name, create_time in files.items() if is_backup(name)}
+
+    backups_to_delete = select_backups_to_delete(backups=backups, policy=policy)
+    backups_to_delete_set = set(backups_to_delete)
+
+    files_to_delete = sorted(name for name in files if get_backup_name(name) in backups_to_delete_set)
+
+    return backups_to_delete, files_to_delete
+
+
+def apply_retention(smb, folder: str, policy: RetentionPolicy, is_backup: Callable[[str], bool],
+                    dry_run: bool = False, refresh: bool = False) -> List[str]:
+    """Deletes the backups in folder on the share that the policy does not keep, with their sidecars. smb is a
+       connected SmbClient. The folder is only listed if its cached listing is out of date, or with refresh. With
+       dry_run nothing is deleted, the plan is only logged. Returns the files deleted, or to delete
+    """
+
+    files = {cached_file.filename: cached_file.create_time
+             for cached_file in smb.get_cached_list_of_files(subfolder=folder, max_age=0 if refresh else
+                                                             SMB_LISTING_CACHE_MAX_AGE)}
+    backups_to_delete, files_to_delete = plan_retention(files=files, policy=policy, is_backup=is_backup)
+
+    logger.info(f'{policy} keeps {len([name for name in files if is_backup(name)]) - len(backups_to_delete)} '
+                f'backups in {folder}, {len(backups_to_delete)} to delete')
+    logger.debug('Files to delete from %s; %s', folder, lazy(lambda: files_to_delete))
+
+    if dry_run or len(files_to_delete) == 0:
+        return files_to_delete
+
+    deleted_paths = smb.delete_many([f'/{folder}/{name}' for name in files_to_delete])
+
+    return [Path(path).name for path in deleted_paths]
+
+
+if __name__ == '__main__':
+
+    from move_backups import SmbClient
+
+    parser = argparse.ArgumentParser(description='Applies a grandfather-father-son retention policy to a backup '
+                                                 'folder on the samba share')
+    parser.add_argument('folder', help='folder on the share, like csv_backup or db_backup')
+    parser.add_argument('--policy', default='daily:7,weekly:4,monthly:6', help='like daily:7,weekly:4,monthly:6')
+    parser.add_argument('--prefix', default='', help='only files whose name starts with this are backups')
+    parser.add_argument('--delete', action='store_true', help='actually delete, default is a dry run')
+    parser.add_argument('--refresh', action='store_true', help='list the folder, instead of using the cached listing')
+    arguments = parser.parse_args()
+
+    smb_client = SmbClient(ip=config['SAMBA_SERVER_IP'],
+                           username=config['SAMBA_USER'],
+                           password=config['SAMBA_PASSWORD'],
+                           remote_name=config['SAMBA_REMOTE_NAME'],
+                           sharename=config['SAMBA_SHARE'])
+
+    if not smb_client.connect():
+        raise ConnectionError('Could not connect to samba share')
+
+    handled = apply_retention(smb=smb_client, folder=arguments.folder,
+                              policy=RetentionPolicy.from_string(arguments.policy),
+                              is_backup=lambda name: name.startswith(arguments.prefix) and
+                              get_backup_name(name) == name,
+                              dry_run=not arguments.delete,
+                              refresh=arguments.refresh)
+    smb_client.close()
+
+    for file_name in handled:
+        print(('deleted ' if arguments.delete else 'would delete ') + file_name)
@@ -0,0 +1,157 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path, PurePosixPath
+from typing import Iterator, List, Tuple
+
+from dotenv import dotenv_values
+
+from controller_logging import get_logger
+
+config = dotenv_values(".env")
+
+logger = get_logger(name=__name__)
+
+SMB_LISTING_CACHE = Path(config.get('SMB_LISTING_CACHE') or 'smb_listing_cache.sqlite3')
+SMB_LISTING_CACHE_MAX_AGE = float(config.get('SMB_LISTING_CACHE_MAX_AGE_SECONDS') or 7 * 86400)
+
+
+class CachedFile(object):
+    """A file on the samba share as remembered by the SmbListingCache. Has the attributes of pysmb's SharedFile that
+       the backup code uses, so it can be used in place of one
+    """
+
+    isDirectory = False
+
+    def __init__(self, filename: str, file_size: int, create_time: float, checksum: str = None):
+        self.filename = filename
+        self.file_size = file_size
+        self.create_time = create_time
+        self.checksum = checksum
+
+    def __repr__(self):
+        return f'CachedFile({self.filename}, {self.file_size} bytes)'
+
+
+def split_remote_path(remote_path_str: str) -> Tuple[str, str]:
+    """Folder and file name of a path relative to the share root, like /csv_backup/a.tar.gz or csv_backup/a.tar.gz"""
+
+    path = PurePosixPath(str(remote_path_str).replace('\\', '/'))
+
+    return str(path.parent).strip('/.'), path.name
+
+
+def to_glob_pattern(pattern: str) -> str:
+    """A share wildcard pattern, like csv_full_*, as a pattern for SQLite GLOB on lower cased names. Names on the share
+       match case insensitively, as with listPath. [ is literal on the share, but starts a character class in GLOB
+    """
+
+    return pattern.lower().replace('[', '[[]')
+
+
+class SmbListingCache(object):
+    """Names, sizes, create times and sha256 checksums of the files in folders of the samba share, in a local SQLite
+       database. Listings of a folder, or of the names in it matching a pattern, replace what is cached for them.
+       Uploads and deletes done by SmbClient are written through, so between listings the cache stays up to date
+       with what the controller itself does. Checksums are learned from the .sha256 sidecars uploaded with backups
+    """
+
+    def __init__(self, path_to_database: Path = SMB_LISTING_CACHE):
+        self.path_to_database = path_to_database
+        self.lock = threading.Lock()
+
+        with self.lock, self.connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS files (folder TEXT, name TEXT, size INTEGER, '
+                               'create_time REAL, checksum TEXT, PRIMARY KEY (folder, name))')
+            connection.execute('CREATE TABLE IF NOT EXISTS listings (folder TEXT, pattern TEXT, listed_at REAL, '
+                               'PRIMARY KEY (folder, pattern))')
+
+    @contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        """Connection for one transaction, committed unless the with block raises, and closed after it"""
+
+        connection = sqlite3.connect(str(self.path_to_database), timeout=30)
+
+        try:
+            with connection:
+                yield connection
+
+        finally:
+            connection.close()
+
+    def get_listed_at(self, folder: str, pattern: str = '*'):
+        """When the names of folder matching pattern were last listed, as a unix timestamp. A listing of the whole
+           folder counts for every pattern. None if never listed
+        """
+
+        with self.lock, self.connect() as connection:
+            row = connection.execute('SELECT max(listed_at) FROM listings WHERE folder = ? AND pattern IN (?, ?)',
+                                     (folder, pattern, '*')).fetchone()
+
+        return row[0]
+
+    def store_listing(self, folder: str, files: List[Tuple[str, int, float]], pattern: str = '*'):
+        """Replaces the cached files of folder matching pattern, a share wildcard pattern, with files, a list of
+           (name, size, create time). Checksums of files whose size did not change are kept
+        """
+
+        with self.lock, self.connect() as connection:
+            connection.execute('CREATE TEMPORARY TABLE IF NOT EXISTS listed (name TEXT PRIMARY KEY)')
+            connection.execute('DELETE FROM listed')
+            connection.executemany('INSERT OR IGNORE INTO listed VALUES (?)', [(name,) for name, _, _ in files])
+            connection.execute('DELETE FROM files WHERE folder = ? AND lower(name) GLOB ? AND name NOT IN '
+                               '(SELECT name FROM listed)', (folder, to_glob_pattern(pattern)))
+            connection.executemany('INSERT INTO files (folder, name, size, create_time) VALUES (?, ?, ?, ?) '
+                                   'ON CONFLICT (folder, name) DO UPDATE SET checksum = CASE WHEN size = '
+                                   'excluded.size THEN checksum END, size = excluded.size, '
+                                   'create_time = excluded.create_time',
+                                   [(folder, name, size, create_time) for name, size, create_time in files])
+            connection.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?)', (folder, pattern, time.time()))
+
+    def get_files(self, folder: str, pattern: str = '*') -> List[CachedFile]:
+        """Cached files of folder with names matching pattern, case insensitively as on the share, by name"""
+
+        with self.lock, self.connect() as connection:
+            rows = connection.execute('SELECT name, size, create_time, checksum FROM files WHERE folder = ? AND '
+                                      'lower(name) GLOB ? ORDER BY name', (folder, to_glob_pattern(pattern))).fetchall()
+
+        return [CachedFile(filename=row[0], file_size=row[1], create_time=row[2], checksum=row[3]) for row in rows]
+
+    def record_upload(self, remote_path_str: str, size: int, checksum: str = None):
+
+        folder, name = split_remote_path(remote_path_str)
+
+        with self.lock, self.connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                               (folder, name, size, time.time(), checksum))
+
+    def set_checksum(self, remote_path_str: str, checksum: str):
+
+        folder, name = split_remote_path(remote_path_str)
+
+        with self.lock, self.connect() as connection:
+            connection.execute('UPDATE files SET checksum = ? WHERE folder = ? AND name = ?', (checksum, folder, name))
+
+    def record_delete(self, remote_path_str: str):
+
+        folder, name = split_remote_path(remote_path_str)
+
+        with self.lock, self.connect() as connection:
+            connection.execute('DELETE FROM files WHERE folder = ? AND name = ?', (folder, name))
+
+
+smb_listing_cache = None
+smb_listing_cache_lock = threading.Lock()
+
+
+def get_smb_listing_cache() -> SmbListingCache:
+    """The SmbListingCache at SMB_LISTING_CACHE, shared by all SmbClients of the process. Created on first use"""
+
+    global smb_listing_cache
+
+    with smb_listing_cache_lock:
+        if smb_listing_cache is None:
+            smb_listing_cache = SmbListingCache()
+
+        return smb_listing_cache
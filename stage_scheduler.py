@@ -0,0 +1,195 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Dict, List
+
+from controller_logging import get_logger
+
+logger = get_logger(name=__name__)
+
+
+class Stage(object):
+    """A single step in a stage graph.
+       name: unique name of the stage, used when other stages refer to it in depends_on.
+       action: callable taking no arguments, doing the actual work.
+       depends_on: names of the stages that must have finished before this stage can start.
+       critical: if a critical stage fails, no new stages are started and the exception is re-raised. A non-critical
+                 stage failing is logged, and stages depending on it are run regardless, as the sequential flow did.
+    """
+
+    def __init__(self, name: str, action: Callable, depends_on: List[str] = None, critical: bool = True):
+        self.name = name
+        self.action = action
+        self.depends_on = list(depends_on) if depends_on is not None else []
+        self.critical = critical
+
+    def __repr__(self):
+        return f'Stage({self.name}, depends_on={self.depends_on})'
+
+
+class StageResult(object):
+    """Outcome and timing of a stage that was run by run_stage_graph"""
+
+    def __init__(self, name: str, start: float, end: float, exception: BaseException = None):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.exception = exception
+
+    @property
+    def wall_time(self) -> float:
+        return self.end - self.start
+
+    @property
+    def succeeded(self) -> bool:
+        return self.exception is None
+
+
+def validate_stage_graph(stages: List[Stage]):
+    """Raises ValueError if stage names are not unique, if a dependency is unknown or if the graph has a cycle"""
+
+    stages_by_name = {}
+
+    for stage in stages:
+        if stage.name in stages_by_name:
+            raise ValueError(f'Stage name {stage.name} is used more than once')
+        stages_by_name[stage.name] = stage
+
+    for stage in stages:
+        for dependency in stage.depends_on:
+            if dependency not in stages_by_name:
+                raise ValueError(f'Stage {stage.name} depends on unknown stage {dependency}')
+
+    # Kahn's algorithm, graph is acyclic if every stage can be ordered
+    number_of_unfinished_dependencies = {stage.name: len(stage.depends_on) for stage in stages}
+    ready = [name for name, count in number_of_unfinished_dependencies.items() if count == 0]
+    ordered = []
+
+    while ready:
+        name = ready.pop()
+        ordered.append(name)
+
+        for stage in stages:
+            if name in stage.depends_on:
+                number_of_unfinished_dependencies[stage.name] -= 1
+                if number_of_unfinished_dependencies[stage.name] == 0:
+                    ready.append(stage.name)
+
+    if len(ordered) != len(stages):
+        cyclic = [name for name, count in number_of_unfinished_dependencies.items() if count > 0]
+        raise ValueError(f'Stage graph has a cycle involving {cyclic}')
+
+
+def get_critical_path(stages: List[Stage], results: Dict[str, StageResult]) -> List[str]:
+    """Walks back from the stage finishing last, each time following the dependency that finished last.
+       The returned list of stage names, in run order, is the chain that decided the total wall time
+    """
+
+    stages_by_name = {stage.name: stage for stage in stages}
+
+    if len(results) == 0:
+        return []
+
+    current = max(results.values(), key=lambda result: result.end).name
+    critical_path = [current]
+
+    while True:
+        finished_dependencies = [results[name] for name in stages_by_name[current].depends_on if name in results]
+
+        if len(finished_dependencies) == 0:
+            break
+
+        current = max(finished_dependencies, key=lambda result: result.end).name
+        critical_path.append(current)
+
+    return list(reversed(critical_path))
+
+
+def run_stage(stage: Stage) -> StageResult:
+
+    start = time.time()
+    logger.info(f'Stage {stage.name} started', extra={'stage': stage.name})
+
+    try:
+        stage.action()
+
+    except BaseException as e:
+        # SystemExit from exit() in a worker thread must also end up with the scheduler
+        result = StageResult(name=stage.name, start=start, end=time.time(), exception=e)
+
+    else:
+        result = StageResult(name=stage.name, start=start, end=time.time())
+
+    logger.info(f'Stage {stage.name} finished after {result.wall_time:.1f} seconds. Succeeded: {result.succeeded}',
+                extra={'stage': stage.name, 'duration': result.wall_time})
+
+    return result
+
+
+def run_stage_graph(stages: List[Stage], max_workers: int = 4,
+                    result_callback: Callable[[StageResult], None] = None) -> Dict[str, StageResult]:
+    """Runs every stage as soon as all its dependencies have finished, with up to max_workers stages at the same
+       time. Returns a dict of StageResult by stage name, and logs the critical path of the run.
+       If a critical stage fails, running stages are allowed to finish, no new ones are started, and the exception
+       of the failed stage is re-raised.
+       result_callback: called with the StageResult of every stage as it finishes, like metrics.record_stage_result
+    """
+
+    validate_stage_graph(stages)
+
+    results = {}
+    not_started = list(stages)
+    failed_critical_result = None
+    graph_start = time.time()
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='stage') as executor:
+
+        running = {}
+
+        while True:
+
+            if failed_critical_result is None:
+                ready = [stage for stage in not_started if all(name in results for name in stage.depends_on)]
+
+                for stage in ready:
+                    not_started.remove(stage)
+                    running[executor.submit(run_stage, stage)] = stage
+
+            if len(running) == 0:
+                break
+
+            done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+
+            for future in done:
+                stage = running.pop(future)
+                result = future.result()
+                results[stage.name] = result
+
+                if result_callback is not None:
+                    try:
+                        result_callback(result)
+
+                    except Exception:
+                        logger.warning(f'Result callback failed for stage {stage.name}', exc_info=True)
+
+                if result.succeeded:
+                    continue
+
+                if stage.critical:
+                    logger.critical(f'Critical stage {stage.name} failed, no further stages will be started',
+                                    exc_info=result.exception)
+                    if failed_critical_result is None:
+                        failed_critical_result = result
+
+                else:
+                    logger.warning(f'Stage {stage.name} failed. Continuing with the remaining stages',
+                                   exc_info=result.exception)
+
+    critical_path = get_critical_path(stages=stages, results=results)
+    critical_path_description = ' -> '.join([f'{name} ({results[name].wall_time:.1f}s)' for name in critical_path])
+    logger.info(f'Stage graph finished after {time.time() - graph_start:.1f} seconds. '
+                f'Critical path: {critical_path_description}')
+
+    if failed_critical_result is not None:
+        raise failed_critical_result.exception
+
+    return results
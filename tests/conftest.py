@@ -0,0 +1,22 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# the controller modules are top level modules, and read .env from the working directory when imported
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+os.chdir(REPO_ROOT)
+
+import metrics  # noqa: E402, imported once the repo root is on the path
+
+
+@pytest.fixture(autouse=True)
+def metrics_store(monkeypatch, tmp_path):
+    """Measurements of the code under test go to a database of the test, not to METRICS_DATABASE"""
+
+    store = metrics.MetricsStore(path_to_database=tmp_path / 'metrics.sqlite3')
+    monkeypatch.setattr(metrics, 'metrics_store', store)
+
+    return store
@@ -0,0 +1,105 @@
+import io
+import os
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from smb.smb_structs import OperationFailure
+
+from dedup_store import DedupStore, MIN_CHUNK_SIZE
+from retention import RetentionPolicy
+
+
+class FakeCachedFile(object):
+
+    def __init__(self, filename: str, file_size: int):
+        self.filename = filename
+        self.file_size = file_size
+
+
+class FakeSmbClient(object):
+    """The part of SmbClient used by the store, keeping the share in the files dict of path to content. Uploads
+       fail once failing_after chunks have been uploaded
+    """
+
+    def __init__(self, failing_after: int = None):
+        self.files = {}
+        self.failing_after = failing_after
+
+    def read_remote_file(self, remote_path_str: str) -> bytes:
+
+        if remote_path_str not in self.files:
+            raise OperationFailure(f'Failed to retrieve {remote_path_str}', [SimpleNamespace(status=0xC0000034)])
+
+        return self.files[remote_path_str]
+
+    def create_directory(self, directory_name: str, relative_path: Path):
+        pass
+
+    def upload_file_object(self, file_obj, remote_path_str: str):
+
+        if '/chunks/' in remote_path_str and self.failing_after is not None:
+            if self.failing_after == 0:
+                return None
+
+            self.failing_after -= 1
+
+        self.files[remote_path_str] = file_obj.read()
+
+        return len(self.files[remote_path_str])
+
+    def get_cached_list_of_files(self, subfolder: str):
+        return [FakeCachedFile(Path(path).name, len(data)) for path, data in self.files.items()
+                if str(Path(path).parent) == subfolder]
+
+    def delete_many(self, file_paths: list) -> list:
+
+        for file_path in file_paths:
+            del self.files[file_path.lstrip('/')]
+
+        return file_paths
+
+
+def list_chunks(smb: FakeSmbClient) -> list:
+    return sorted(Path(path).name for path in smb.files if '/chunks/' in path)
+
+
+@pytest.fixture
+def smb():
+    return FakeSmbClient(failing_after=2)
+
+
+def test_failed_backup_saves_index_of_uploaded_chunks(tmp_path, smb):
+
+    store = DedupStore(smb=smb, local_manifest_cache=tmp_path / 'manifests')
+
+    with pytest.raises(IOError):
+        store.backup_stream(name='db_backup_1', file_obj=io.BytesIO(os.urandom(12 * MIN_CHUNK_SIZE)))
+
+    assert len(list_chunks(smb)) == 2
+    assert sorted(DedupStore(smb=smb).load_index()) == list_chunks(smb)
+    assert store.list_backups() == []
+
+
+def test_garbage_collection_deletes_chunks_missing_from_index(tmp_path, smb):
+
+    store = DedupStore(smb=smb, local_manifest_cache=tmp_path / 'manifests')
+
+    with pytest.raises(IOError):
+        store.backup_stream(name='db_backup_1', file_obj=io.BytesIO(os.urandom(12 * MIN_CHUNK_SIZE)))
+
+    # as if the index could not be saved either
+    del smb.files['dedup_store/index.json.gz']
+    store.chunks = None
+    smb.failing_after = None
+
+    data = os.urandom(2 * MIN_CHUNK_SIZE)
+    assert store.backup_stream(name='db_backup_2', file_obj=io.BytesIO(data)) is not None
+    kept_chunks = sorted(store.load_index())
+
+    result = store.collect_garbage(policy=RetentionPolicy(), prefix='db_backup_')
+
+    assert result['chunks'] == 2
+    assert list_chunks(smb) == kept_chunks
+    assert store.restore(name='db_backup_2', target=tmp_path / 'restored').read_bytes() == data
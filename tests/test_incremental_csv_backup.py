@@ -0,0 +1,131 @@
+import hashlib
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+from incremental_csv_backup import (download_archive_chain, get_archive_chain, list_partial_archives,
+                                    make_incremental_csv_tarfile, restore_csv_backup, write_local_manifest)
+
+FULL = 'csv_full_2026_10_01_20_00_00.tar.gz'
+DELTA = 'csv_delta_2026_10_02_20_00_00.tar.gz'
+PARTIAL_DELTA = 'csv_delta_2026_10_03_20_00_00.tar.gz'
+LEGACY_FULL = 'csv_full_2026_09_01_20_00_00.tar.gz'
+
+
+class FakeCachedFile(object):
+
+    def __init__(self, filename: str):
+        self.filename = filename
+
+
+class FakeSmbClient(object):
+    """The part of SmbClient used to download archives, serving the files dict of name to content. Files in
+       unreadable are listed, but can not be downloaded
+    """
+
+    def __init__(self, files: dict, unreadable: tuple = ()):
+        self.files = files
+        self.unreadable = unreadable
+        self.downloads = []
+
+    def get_cached_list_of_files(self, subfolder: str):
+        return [FakeCachedFile(name) for name in list(self.files) + list(self.unreadable)]
+
+    def read_remote_file(self, remote_path_str: str) -> bytes:
+        return self.files[Path(remote_path_str).name]
+
+    def download(self, remote_path_str: str, local_file_path: Path, sha256=None) -> bool:
+
+        name = Path(remote_path_str).name
+        self.downloads.append(name)
+
+        if name not in self.files:
+            return False
+
+        local_file_path.write_bytes(self.files[name])
+        sha256.update(self.files[name])
+
+        return True
+
+
+def with_sidecar(name: str, content: bytes) -> dict:
+    return {name: content, name + '.sha256': f'{hashlib.sha256(content).hexdigest()}  {name}\n'.encode()}
+
+
+def test_chain_leaves_out_archives_without_sidecar():
+
+    file_names = [FULL, FULL + '.sha256', DELTA, DELTA + '.sha256', PARTIAL_DELTA]
+
+    assert get_archive_chain(file_names=file_names) == [FULL, DELTA]
+    assert get_archive_chain(file_names=file_names, until=datetime(2026, 10, 1, 23)) == [FULL]
+
+    with pytest.raises(FileNotFoundError):
+        get_archive_chain(file_names=[FULL, DELTA, DELTA + '.sha256'])
+
+
+def test_partial_archives_are_those_after_oldest_complete_archive():
+
+    file_names = [LEGACY_FULL, FULL, FULL + '.sha256', DELTA, DELTA + '.sha256', PARTIAL_DELTA]
+
+    assert list_partial_archives(file_names=file_names) == [PARTIAL_DELTA]
+    assert list_partial_archives(file_names=[LEGACY_FULL, PARTIAL_DELTA]) == []
+
+
+def test_download_verifies_archives_against_sidecars(tmp_path):
+
+    smb = FakeSmbClient({**with_sidecar(FULL, b'full'), **with_sidecar(DELTA, b'delta'), PARTIAL_DELTA: b'part'})
+    archive_folder = tmp_path / 'archives'
+
+    download_archive_chain(smb=smb, path_remote_backup_folder=Path('csv_backup'), path_archive_folder=archive_folder)
+
+    assert smb.downloads == [FULL, DELTA]
+    assert sorted(path.name for path in archive_folder.iterdir()) == \
+        [DELTA, DELTA + '.sha256', FULL, FULL + '.sha256']
+
+    # downloaded before, only read again to verify
+    download_archive_chain(smb=smb, path_remote_backup_folder=Path('csv_backup'), path_archive_folder=archive_folder)
+    assert smb.downloads == [FULL, DELTA]
+
+
+def test_download_fails_on_mismatch_or_failed_download(tmp_path):
+
+    files = {**with_sidecar(FULL, b'full'), **with_sidecar(DELTA, b'delta')}
+    files[DELTA] = b'truncated'
+
+    with pytest.raises(ValueError):
+        download_archive_chain(smb=FakeSmbClient(files), path_remote_backup_folder=Path('csv_backup'),
+                               path_archive_folder=tmp_path)
+
+    assert not (tmp_path / DELTA).exists()
+
+    del files[DELTA]
+
+    with pytest.raises(FileNotFoundError):
+        download_archive_chain(smb=FakeSmbClient(files, unreadable=(DELTA,)),
+                               path_remote_backup_folder=Path('csv_backup'), path_archive_folder=tmp_path)
+
+
+def test_restore_applies_full_and_delta(tmp_path):
+
+    backup_folder = tmp_path / 'csv_backup'
+    backup_folder.mkdir()
+    (backup_folder / 'prices.csv').write_text('1\n')
+    (backup_folder / 'positions.csv').write_text('2\n')
+
+    full_path, manifest = make_incremental_csv_tarfile(path_to_local_backup_dir=backup_folder,
+                                                       now=datetime(2026, 10, 1, 20))
+    write_local_manifest(path_to_local_backup_dir=backup_folder, manifest=manifest)
+
+    (backup_folder / 'prices.csv').write_text('3\n')
+    (backup_folder / 'positions.csv').unlink()
+    delta_path, _ = make_incremental_csv_tarfile(path_to_local_backup_dir=backup_folder,
+                                                 now=datetime(2026, 10, 2, 20))
+
+    assert (full_path.name, delta_path.name) == (FULL, DELTA)
+
+    manifest = restore_csv_backup(path_archive_folder=backup_folder, path_restore_folder=tmp_path / 'restored')
+
+    assert manifest['archive'] == DELTA
+    assert [path.name for path in (tmp_path / 'restored').iterdir()] == ['prices.csv']
+    assert (tmp_path / 'restored' / 'prices.csv').read_text() == '3\n'
@@ -0,0 +1,102 @@
+import gzip
+import hashlib
+from contextlib import contextmanager
+from pathlib import Path
+
+import pytest
+
+from incremental_db_backup import (dump_to_file, move_incremental_db_backup_files, read_catalogue,
+                                   restore_chain_into_container, write_catalogue)
+
+BASE = 'db_full_2026_10_01_20_00_00.archive.gz'
+DELTA = 'db_delta_2026_10_02_20_00_00.bson.gz'
+
+
+class FakeSmbClient(object):
+    """The part of SmbClient used to move backup sets. Uploads of files named in failing_uploads fail"""
+
+    def __init__(self, failing_uploads: tuple = ()):
+        self.failing_uploads = failing_uploads
+        self.uploaded = []
+
+    def upload_chunked(self, local_file_path: Path, remote_folder_path: Path):
+
+        if local_file_path.name in self.failing_uploads:
+            return None
+
+        self.uploaded.append(local_file_path.name)
+
+        return local_file_path.stat().st_size
+
+    def upload(self, local_file_path: Path, remote_folder_path: Path):
+        self.uploaded.append(local_file_path.name)
+
+    def get_cached_list_of_files(self, subfolder: str):
+        return []
+
+
+class FakeSmbPool(object):
+
+    def __init__(self, smb: FakeSmbClient):
+        self.smb = smb
+
+    @contextmanager
+    def connection(self):
+        yield self.smb
+
+
+def make_backup_folder(tmp_path) -> Path:
+    """A backup folder with a base and a delta, dumped and catalogued but not uploaded"""
+
+    backup_folder = tmp_path / 'db_backup'
+    backup_folder.mkdir()
+    catalogue = []
+
+    for file_name, chunks, compress in [(BASE, [b'archive'], False), (DELTA, [b'oplog ', b'entries'], True)]:
+        _, sha256 = dump_to_file(chunks=iter(chunks), path_to_file=backup_folder / file_name, compress=compress)
+        catalogue.append({'type': 'full' if file_name == BASE else 'delta', 'file': file_name, 'sha256': sha256,
+                          'created_time': '2026_10_01_20_00_00', 'uploaded': False})
+
+    write_catalogue(path_local_backup_folder=backup_folder, catalogue=catalogue)
+
+    return backup_folder
+
+
+def test_dump_writes_sidecar_of_file_as_written(tmp_path):
+
+    backup_folder = make_backup_folder(tmp_path)
+
+    for file_name in (BASE, DELTA):
+        file_bytes = (backup_folder / file_name).read_bytes()
+        assert (backup_folder / (file_name + '.sha256')).read_text() == \
+            f'{hashlib.sha256(file_bytes).hexdigest()}  {file_name}\n'
+
+    assert gzip.decompress((backup_folder / DELTA).read_bytes()) == b'oplog entries'
+    assert not list(backup_folder.glob('*.partial'))
+
+
+def test_set_counts_as_uploaded_once_sidecar_is_on_share(tmp_path):
+
+    backup_folder = make_backup_folder(tmp_path)
+    smb = FakeSmbClient(failing_uploads=(DELTA + '.sha256',))
+
+    move_incremental_db_backup_files(samba_user='', samba_password='', samba_share='', samba_server_ip='',
+                                     samba_remote_name='', path_local_backup_folder=backup_folder,
+                                     smb_pool=FakeSmbPool(smb))
+
+    assert [backup_set['uploaded'] for backup_set in read_catalogue(backup_folder)] == [True, False]
+    assert smb.uploaded == [BASE, BASE + '.sha256', DELTA, 'backup_catalogue.json']
+    assert sorted(path.name for path in backup_folder.iterdir()) == \
+        ['backup_catalogue.json', DELTA, DELTA + '.sha256']
+
+
+def test_truncated_delta_is_not_restored(tmp_path):
+
+    backup_folder = make_backup_folder(tmp_path)
+    delta_path = backup_folder / DELTA
+    delta_path.write_bytes(delta_path.read_bytes()[:-4])
+
+    # raises before the container is touched
+    with pytest.raises(ValueError):
+        restore_chain_into_container(docker_client=None, container_name='db_restore_test',
+                                     path_backup_files_folder=backup_folder, chain=read_catalogue(backup_folder))
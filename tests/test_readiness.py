@@ -0,0 +1,120 @@
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+from readiness import IbGatewayHealthProbe, ib_api_handshake, receive_exactly, wait_until_ready
+
+SERVER_VERSION = 176
+CONNECTION_TIME = '20261017 21:00:00 GMT'
+
+
+class FakeIbGateway(object):
+    """TCP stand-in for the ib_gateway API port. Once logged_in, it answers the opening handshake with a server
+       version and connection time, like the gateway. Before that it closes connections without answering
+    """
+
+    def __init__(self, logged_in: bool = True):
+        self.logged_in = logged_in
+        self.connections = 0
+        self.handshakes = []
+        self.server = socket.create_server(('127.0.0.1', 0))
+        self.port = self.server.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+
+        while True:
+            try:
+                connection, _ = self.server.accept()
+
+            except OSError:
+                return
+
+            with connection:
+                self.connections += 1
+                prefix = receive_exactly(connection, 4)
+                length = struct.unpack('>I', receive_exactly(connection, 4))[0]
+                self.handshakes.append((prefix, receive_exactly(connection, length)))
+
+                if self.logged_in:
+                    reply = f'{SERVER_VERSION}\0{CONNECTION_TIME}\0'.encode()
+                    connection.sendall(struct.pack('>I', len(reply)) + reply)
+
+    def close(self):
+        self.server.close()
+
+
+@pytest.fixture
+def gateway():
+
+    fake_gateway = FakeIbGateway()
+    yield fake_gateway
+    fake_gateway.close()
+
+
+def test_handshake_returns_server_version_and_connection_time(gateway):
+
+    assert ib_api_handshake(host='127.0.0.1', port=gateway.port, timeout=2) == (SERVER_VERSION, CONNECTION_TIME)
+    assert gateway.handshakes == [(b'API\0', b'v100..176')]
+
+
+def test_handshake_fails_before_login(gateway):
+
+    gateway.logged_in = False
+
+    with pytest.raises(ConnectionError):
+        ib_api_handshake(host='127.0.0.1', port=gateway.port, timeout=2)
+
+
+def test_probe_caches_successful_handshake_for_ttl(gateway):
+
+    probe = IbGatewayHealthProbe(host='127.0.0.1', port=gateway.port, ttl=0.3, timeout=2)
+
+    assert probe.check() and probe.check()
+    assert gateway.connections == 1
+    assert probe.server_version == SERVER_VERSION
+
+    time.sleep(0.4)
+
+    assert probe.check()
+    assert gateway.connections == 2
+
+
+def test_probe_does_not_cache_failures(gateway):
+
+    gateway.logged_in = False
+    probe = IbGatewayHealthProbe(host='127.0.0.1', port=gateway.port, ttl=30, timeout=2)
+
+    with pytest.raises(ConnectionError):
+        probe.check()
+
+    gateway.logged_in = True
+
+    assert probe.check()
+    assert gateway.connections == 2
+
+
+def test_wait_until_ready_returns_once_gateway_is_logged_in(gateway):
+
+    gateway.logged_in = False
+    probe = IbGatewayHealthProbe(host='127.0.0.1', port=gateway.port, ttl=30, timeout=2)
+    threading.Timer(0.3, setattr, args=(gateway, 'logged_in', True)).start()
+
+    time_to_ready = wait_until_ready(name='ib_gateway', probe=probe.check, deadline=5, initial_delay=0.05,
+                                     max_delay=0.1)
+
+    assert 0.3 <= time_to_ready < 5
+    assert gateway.connections > 1
+
+
+def test_wait_until_ready_times_out(gateway):
+
+    gateway.logged_in = False
+    probe = IbGatewayHealthProbe(host='127.0.0.1', port=gateway.port, ttl=30, timeout=2)
+
+    with pytest.raises(TimeoutError):
+        wait_until_ready(name='ib_gateway', probe=probe.check, deadline=0.3, initial_delay=0.05, max_delay=0.1)
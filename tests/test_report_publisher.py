@@ -0,0 +1,224 @@
+import threading
+import time
+from datetime import datetime
+
+import git
+import pytest
+
+from report_publisher import ReportPublisher
+
+TIMEOUT = 10
+
+
+def make_reports_repo(tmp_path):
+    """A reports repo with one commit, pushed to the local bare repo remote.git next to it"""
+
+    git.Repo.init(str(tmp_path / 'remote.git'), bare=True)
+    repo = git.Repo.init(str(tmp_path / 'reports'))
+    repo.git.config('user.name', 'reports')
+    repo.git.config('user.email', 'reports@localhost')
+
+    (tmp_path / 'reports' / 'README').write_text('reports\n')
+    repo.git.add('README')
+    repo.git.commit('-q', '-m', 'Initial commit')
+    repo.git.push('-q', str(tmp_path / 'remote.git'), 'HEAD')
+
+    return repo
+
+
+def get_remote_head(tmp_path, repo: git.Repo) -> str:
+
+    remote_heads = repo.git.ls_remote(str(tmp_path / 'remote.git'), f'refs/heads/{repo.active_branch.name}',
+                                      with_exceptions=False).split()
+
+    return remote_heads[0] if len(remote_heads) != 0 else None
+
+
+def wait_for_remote_head(tmp_path, repo: git.Repo, head: str):
+
+    deadline = time.time() + TIMEOUT
+
+    while get_remote_head(tmp_path, repo) != head:
+        assert time.time() < deadline, 'reports were not pushed'
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def repo(tmp_path):
+    return make_reports_repo(tmp_path)
+
+
+def make_publisher(tmp_path, **kwargs) -> ReportPublisher:
+
+    arguments = dict(path_to_repo=tmp_path / 'reports', remote=str(tmp_path / 'remote.git'), batch_seconds=0.1,
+                     push_attempts=3, push_retry_seconds=0.05, compaction=None)
+    arguments.update(kwargs)
+
+    return ReportPublisher(**arguments)
+
+
+def test_commit_pending_stages_only_changed_paths(tmp_path, repo):
+
+    (tmp_path / 'reports' / 'daily.txt').write_text('pnl\n')
+    (tmp_path / 'reports' / 'other.txt').write_text('not reported as changed\n')
+    (tmp_path / 'reports' / 'README').unlink()
+    publisher = make_publisher(tmp_path)
+    publisher.changes.add(['daily.txt', 'README'])
+
+    assert publisher.commit_pending()
+    assert repo.head.commit.message.startswith('Auto commit ')
+    assert sorted(item.path for item in repo.head.commit.tree.traverse()) == ['daily.txt']
+    assert repo.untracked_files == ['other.txt']
+
+    assert not publisher.commit_pending()
+
+
+def test_rescan_commits_whole_work_tree(tmp_path, repo):
+
+    (tmp_path / 'reports' / 'daily.txt').write_text('pnl\n')
+    (tmp_path / 'reports' / 'weekly.txt').write_text('risk\n')
+    publisher = make_publisher(tmp_path)
+    publisher.changes.add(rescan=True)
+
+    assert publisher.commit_pending()
+    assert sorted(item.path for item in repo.head.commit.tree.traverse()) == ['README', 'daily.txt', 'weekly.txt']
+
+
+def test_push_to_bare_repo(tmp_path, repo):
+
+    (tmp_path / 'reports' / 'daily.txt').write_text('pnl\n')
+    publisher = make_publisher(tmp_path)
+    publisher.changes.add(['daily.txt'])
+    publisher.commit_pending()
+
+    assert publisher.push()
+    assert get_remote_head(tmp_path, repo) == repo.head.commit.hexsha
+
+
+def test_push_fails_while_remote_is_unreachable(tmp_path, repo):
+
+    publisher = make_publisher(tmp_path, remote=str(tmp_path / 'missing.git'))
+
+    assert not publisher.push()
+
+
+def test_publisher_batches_commits_and_pushes_in_background(tmp_path, repo):
+
+    publisher = make_publisher(tmp_path)
+    publisher.start()
+
+    try:
+        for name in ('daily.txt', 'weekly.txt', 'monthly.txt'):
+            (tmp_path / 'reports' / name).write_text(f'{name}\n')
+
+        publisher.flush()
+        wait_for_remote_head(tmp_path, repo, head=repo.head.commit.hexsha)
+
+    finally:
+        publisher.stop(timeout=TIMEOUT)
+
+    assert repo.head.commit.parents[0].message == 'Initial commit\n'
+    assert sorted(item.path for item in repo.head.commit.tree.traverse()) == \
+        ['README', 'daily.txt', 'monthly.txt', 'weekly.txt']
+
+
+def test_push_is_retried_until_remote_is_reachable(tmp_path, repo):
+
+    (tmp_path / 'remote.git').rename(tmp_path / 'unreachable.git')
+    publisher = make_publisher(tmp_path, push_retry_seconds=0.2)
+    publisher.start()
+
+    try:
+        (tmp_path / 'reports' / 'daily.txt').write_text('pnl\n')
+        publisher.flush()
+        threading.Timer(0.3, (tmp_path / 'unreachable.git').rename, args=(tmp_path / 'remote.git',)).start()
+
+        wait_for_remote_head(tmp_path, repo, head=repo.head.commit.hexsha)
+
+    finally:
+        publisher.stop(timeout=TIMEOUT)
+
+    assert 'daily.txt' in [item.path for item in repo.head.commit.tree.traverse()]
+
+
+def test_stop_commits_and_pushes_pending_changes(tmp_path, repo):
+
+    publisher = make_publisher(tmp_path, batch_seconds=3600)
+    publisher.start()
+    (tmp_path / 'reports' / 'daily.txt').write_text('pnl\n')
+    publisher.stop(timeout=TIMEOUT)
+
+    assert 'daily.txt' in [item.path for item in repo.head.commit.tree.traverse()]
+    assert get_remote_head(tmp_path, repo) == repo.head.commit.hexsha
+
+
+def commit_at(tmp_path, repo: git.Repo, date: str):
+    """An auto commit of a report, dated date"""
+
+    (tmp_path / 'reports' / 'daily.txt').write_text(f'{date}\n')
+    repo.git.add('daily.txt')
+
+    with repo.git.custom_environment(GIT_AUTHOR_DATE=date, GIT_COMMITTER_DATE=date):
+        repo.git.commit('-q', '-m', f'Auto commit {date}')
+
+
+def get_subjects(repo: git.Repo) -> list:
+    return repo.git.log('--reverse', '--format=%s').splitlines()
+
+
+def test_compaction_squashes_old_auto_commits_per_period(tmp_path, repo, monkeypatch):
+
+    publisher = make_publisher(tmp_path, compaction='weekly')
+    repacks = []
+    monkeypatch.setattr(publisher, 'repack', lambda: repacks.append(True))
+
+    for date in ('2026-01-05T12:00:00', '2026-01-06T12:00:00', '2026-01-07T12:00:00', '2026-01-12T12:00:00'):
+        commit_at(tmp_path, repo, date=date)
+
+    tree = repo.head.commit.tree.hexsha
+
+    assert publisher.compact(before=datetime(2026, 1, 10)) == 2
+    assert get_subjects(repo) == ['Initial commit', 'Snapshot 2026-W02 of 3 commits',
+                                  'Auto commit 2026-01-12T12:00:00']
+    assert repo.head.commit.tree.hexsha == tree
+    assert len(repacks) == 1
+
+
+def test_compaction_counts_commits_squashed_before(tmp_path, repo, monkeypatch):
+
+    publisher = make_publisher(tmp_path, compaction='weekly')
+    repacks = []
+    monkeypatch.setattr(publisher, 'repack', lambda: repacks.append(True))
+
+    for date in ('2026-01-05T12:00:00', '2026-01-06T12:00:00', '2026-01-07T12:00:00'):
+        commit_at(tmp_path, repo, date=date)
+
+    publisher.compact(before=datetime(2026, 1, 7))
+
+    for date in ('2026-01-08T12:00:00', '2026-01-09T12:00:00'):
+        commit_at(tmp_path, repo, date=date)
+
+    # the snapshot of the week is squashed again with the commits that have become old since
+    assert publisher.compact(before=datetime(2026, 2, 1)) == 3
+    assert get_subjects(repo) == ['Initial commit', 'Snapshot 2026-W02 of 5 commits']
+    assert len(repacks) == 1
+
+    publisher.compaction = 'monthly'
+
+    assert publisher.compact(before=datetime(2026, 2, 1)) == 0
+    assert len(repacks) == 1
+
+
+def test_compacted_history_is_force_pushed_with_lease(tmp_path, repo):
+
+    for date in ('2026-01-05T12:00:00', '2026-01-06T12:00:00'):
+        commit_at(tmp_path, repo, date=date)
+
+    publisher = make_publisher(tmp_path, compaction='weekly')
+    assert publisher.push()
+
+    publisher.compact(before=datetime(2026, 2, 1))
+
+    assert publisher.push()
+    assert get_remote_head(tmp_path, repo) == repo.head.commit.hexsha
+    assert repo.git.config('--get', 'reportpublisher.lease', with_exceptions=False) == ''
@@ -0,0 +1,248 @@
+import hashlib
+import threading
+from pathlib import Path
+
+import pytest
+from smb.base import NotConnectedError
+from smb.smb_structs import OperationFailure
+
+import move_backups
+from move_backups import SmbClient, SmbConnectionPool, UploadJournal
+from smb_listing_cache import SmbListingCache
+
+CHUNK_SIZE = 1024
+
+
+class FakeAttributes(object):
+
+    def __init__(self, file_size: int):
+        self.file_size = file_size
+
+
+class FakeSMBConnection(object):
+    """Stands in for pysmb's SMBConnection, storing files in the share dict of the class. drops_after_chunks drops the
+       connection, like a network failure, when that many more chunks have been stored. While refuse_connections is
+       set, connecting fails
+    """
+
+    share = {}
+    connections = []
+    connect_attempts = 0
+    drops_after_chunks = None
+    refuse_connections = False
+    lock = threading.Lock()
+
+    def __init__(self, **kwargs):
+        self.connected = False
+        self.closed = False
+        self.healthy = True
+        self.chunks_stored = 0
+
+    def connect(self, ip: str, port: int) -> bool:
+
+        with FakeSMBConnection.lock:
+            FakeSMBConnection.connect_attempts += 1
+
+            if FakeSMBConnection.refuse_connections:
+                return False
+
+            FakeSMBConnection.connections.append(self)
+
+        self.connected = True
+
+        return True
+
+    def close(self):
+        self.connected = False
+        self.closed = True
+
+    def echo(self, data: bytes, timeout: int = 10):
+
+        if not self.healthy:
+            raise NotConnectedError('not connected')
+
+        return data
+
+    def getAttributes(self, service_name: str, path: str) -> FakeAttributes:
+
+        if path not in FakeSMBConnection.share:
+            raise OperationFailure('no such file', [])
+
+        return FakeAttributes(len(FakeSMBConnection.share[path]))
+
+    def storeFileFromOffset(self, service_name: str, path: str, file_obj, offset: int = 0, truncate: bool = False):
+
+        with FakeSMBConnection.lock:
+            if FakeSMBConnection.drops_after_chunks is not None:
+                if FakeSMBConnection.drops_after_chunks == 0:
+                    FakeSMBConnection.drops_after_chunks = None
+                    self.connected = False
+
+                else:
+                    FakeSMBConnection.drops_after_chunks -= 1
+
+            if not self.connected:
+                raise NotConnectedError('connection dropped')
+
+            data = file_obj.read()
+            stored = b'' if truncate else FakeSMBConnection.share.get(path, b'')
+            FakeSMBConnection.share[path] = stored[:offset].ljust(offset, b'\0') + data
+            self.chunks_stored += 1
+
+        return len(data)
+
+
+@pytest.fixture(autouse=True)
+def fake_smb(monkeypatch, tmp_path):
+
+    FakeSMBConnection.share = {}
+    FakeSMBConnection.connections = []
+    FakeSMBConnection.connect_attempts = 0
+    FakeSMBConnection.drops_after_chunks = None
+    FakeSMBConnection.refuse_connections = False
+
+    listing_cache = SmbListingCache(path_to_database=tmp_path / 'smb_listing_cache.sqlite3')
+    monkeypatch.setattr(move_backups, 'SMBConnection', FakeSMBConnection)
+    monkeypatch.setattr(move_backups, 'get_smb_listing_cache', lambda: listing_cache)
+
+
+def make_client() -> SmbClient:
+
+    smb = SmbClient(ip='127.0.0.1', username='user', password='password', remote_name='nas', sharename='backups')
+    assert smb.connect()
+
+    return smb
+
+
+def make_file(path, size: int):
+
+    path.write_bytes(bytes(index % 251 for index in range(size)))
+
+    return path
+
+
+def test_upload_chunked_reconnects_and_resumes(tmp_path):
+
+    local_file_path = make_file(tmp_path / 'backup.tar.gz', 5 * CHUNK_SIZE + 100)
+    journal = UploadJournal(path_to_journal=tmp_path / 'journal.json')
+    sha256 = hashlib.sha256()
+    FakeSMBConnection.drops_after_chunks = 3
+
+    bytes_on_share = make_client().upload_chunked(local_file_path=local_file_path, remote_folder_path=Path('db'),
+                                                  journal=journal, chunk_size=CHUNK_SIZE, sha256=sha256)
+
+    assert bytes_on_share == local_file_path.stat().st_size
+    assert FakeSMBConnection.share['db/backup.tar.gz'] == local_file_path.read_bytes()
+    assert sha256.hexdigest() == hashlib.sha256(local_file_path.read_bytes()).hexdigest()
+    assert len(FakeSMBConnection.connections) == 2
+    assert FakeSMBConnection.connections[0].closed
+    assert journal.read_entries() == {}
+
+
+def test_upload_chunked_counts_failed_reconnects(tmp_path):
+
+    local_file_path = make_file(tmp_path / 'backup.tar.gz', 5 * CHUNK_SIZE)
+    journal = UploadJournal(path_to_journal=tmp_path / 'journal.json')
+    smb = make_client()
+    FakeSMBConnection.drops_after_chunks = 1
+    FakeSMBConnection.refuse_connections = True
+
+    assert smb.upload_chunked(local_file_path=local_file_path, remote_folder_path=Path('db'), journal=journal,
+                              chunk_size=CHUNK_SIZE, max_reconnects=2) is None
+    assert FakeSMBConnection.connect_attempts == 3
+    assert journal.get_confirmed_offset('db/backup.tar.gz', local_file_path) == CHUNK_SIZE
+
+
+def test_upload_resumes_from_journal_in_later_run(tmp_path):
+
+    local_file_path = make_file(tmp_path / 'backup.tar.gz', 5 * CHUNK_SIZE)
+    journal = UploadJournal(path_to_journal=tmp_path / 'journal.json')
+    FakeSMBConnection.drops_after_chunks = 2
+
+    assert make_client().upload_chunked(local_file_path=local_file_path, remote_folder_path=Path('db'),
+                                        journal=journal, chunk_size=CHUNK_SIZE, max_reconnects=0) is None
+    assert journal.get_confirmed_offset('db/backup.tar.gz', local_file_path) == 2 * CHUNK_SIZE
+
+    smb = make_client()
+    assert smb.upload_chunked(local_file_path=local_file_path, remote_folder_path=Path('db'),
+                              journal=journal, chunk_size=CHUNK_SIZE) == local_file_path.stat().st_size
+    assert smb.server.chunks_stored == 3
+    assert FakeSMBConnection.share['db/backup.tar.gz'] == local_file_path.read_bytes()
+
+
+def test_upload_many_borrows_connections_from_pool(tmp_path):
+
+    local_file_paths = [make_file(tmp_path / f'backup_{index}.tar.gz', 3 * CHUNK_SIZE) for index in range(6)]
+    pool = SmbConnectionPool(ip='127.0.0.1', username='user', password='password', remote_name='nas',
+                             sharename='backups', max_connections=3)
+
+    with pool.connection() as smb:
+        results = smb.upload_many(local_file_paths=local_file_paths, remote_folder_path=Path('db'),
+                                  workers=3, journal=UploadJournal(path_to_journal=tmp_path / 'journal.json'),
+                                  smb_pool=pool)
+
+    assert results == {path: 3 * CHUNK_SIZE for path in local_file_paths}
+    assert all(FakeSMBConnection.share[f'db/{path.name}'] == path.read_bytes() for path in local_file_paths)
+    assert len(FakeSMBConnection.connections) == 3
+    assert len(pool.idle_connections) == 3
+
+
+def test_pool_reuses_healthy_and_replaces_broken_connections():
+
+    pool = SmbConnectionPool(ip='127.0.0.1', username='user', password='password', remote_name='nas',
+                             sharename='backups', max_connections=1)
+
+    with pool.connection() as smb:
+        first_connection = smb
+
+    with pool.connection() as smb:
+        assert smb is first_connection
+
+    first_connection.server.healthy = False
+
+    with pool.connection() as smb:
+        assert smb is not first_connection
+
+    with pytest.raises(NotConnectedError):
+        with pool.connection():
+            raise NotConnectedError('dropped')
+
+    assert len(pool.idle_connections) == 0
+    assert pool.acquire(block=False) is not None
+    assert pool.acquire(block=False) is None
+    assert len(FakeSMBConnection.connections) == 3
+
+
+def test_upload_many_uses_the_connections_it_could_open(tmp_path):
+
+    local_file_paths = [make_file(tmp_path / f'backup_{index}.tar.gz', 2 * CHUNK_SIZE) for index in range(3)]
+    pool = SmbConnectionPool(ip='127.0.0.1', username='user', password='password', remote_name='nas',
+                             sharename='backups', max_connections=3)
+
+    with pool.connection() as smb:
+        FakeSMBConnection.refuse_connections = True
+        results = smb.upload_many(local_file_paths=local_file_paths, remote_folder_path=Path('db'), workers=3,
+                                  journal=UploadJournal(path_to_journal=tmp_path / 'journal.json'), smb_pool=pool)
+
+    assert results == {path: 2 * CHUNK_SIZE for path in local_file_paths}
+    assert len(FakeSMBConnection.connections) == 1
+
+
+def test_upload_many_releases_connections_when_an_upload_raises(tmp_path, monkeypatch):
+
+    local_file_paths = [make_file(tmp_path / f'backup_{index}.tar.gz', CHUNK_SIZE) for index in range(3)]
+    pool = SmbConnectionPool(ip='127.0.0.1', username='user', password='password', remote_name='nas',
+                             sharename='backups', max_connections=3)
+
+    def upload_chunked(self, **kwargs):
+        raise RuntimeError('unexpected')
+
+    monkeypatch.setattr(SmbClient, 'upload_chunked', upload_chunked)
+
+    with pytest.raises(RuntimeError):
+        with pool.connection() as smb:
+            smb.upload_many(local_file_paths=local_file_paths, remote_folder_path=Path('db'), workers=3,
+                            journal=UploadJournal(path_to_journal=tmp_path / 'journal.json'), smb_pool=pool)
+
+    assert all(connection.closed for connection in FakeSMBConnection.connections[1:])
+    assert [pool.acquire(block=False) is not None for _ in range(3)] == [True, True, True]
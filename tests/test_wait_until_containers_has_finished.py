@@ -0,0 +1,237 @@
+import queue
+import threading
+import time
+
+import pytest
+from docker.errors import APIError
+
+import container_registry
+from container_registry import ContainerRegistry
+from docker_controller import wait_until_containers_has_finished
+
+TIMEOUT = 5
+
+
+class FakeContainer(object):
+
+    def __init__(self, client, name: str, status: str):
+        self.client = client
+        self.name = name
+        self.id = f'id-{name}'
+        self.status = status
+        self.attrs = {'Names': [f'/{name}']}
+
+
+class FakeEventStream(object):
+    """Yields the events put on its queue until closed. An exception put on the queue is raised instead"""
+
+    def __init__(self, events: list):
+        self.queue = queue.Queue()
+
+        for event in events:
+            self.queue.put(event)
+
+    def __iter__(self):
+
+        while True:
+            item = self.queue.get()
+
+            if item is None:
+                return
+
+            if isinstance(item, Exception):
+                raise item
+
+            yield item
+
+    def close(self):
+        self.queue.put(None)
+
+
+class FakeContainers(object):
+
+    def __init__(self, client):
+        self.client = client
+        self.list_calls = 0
+        self.list_errors = []
+
+    def list(self, all: bool = False, sparse: bool = False, filters: dict = None):
+
+        self.list_calls += 1
+
+        if self.list_errors:
+            raise self.list_errors.pop(0)
+
+        names = (filters or {}).get('name')
+        names = [names] if isinstance(names, str) else names
+
+        return [container for container in self.client.containers_by_name.values()
+                if (all or container.status == 'running') and
+                (names is None or any(name in container.name for name in names))]
+
+    def get(self, container_id: str):
+        return self.client.containers_by_name[container_id]
+
+
+class FakeDockerClient(object):
+    """Containers whose status is changed with emit, which also sends the event to the open event streams. Streams
+       opened with since replay the events from then on, as the docker daemon does
+    """
+
+    def __init__(self, statuses: dict):
+        self.lock = threading.Lock()
+        self.containers_by_name = {name: FakeContainer(self, name, status) for name, status in statuses.items()}
+        self.containers = FakeContainers(self)
+        self.history = []
+        self.streams = []
+        self.events_errors = []
+
+    def events(self, since: int = None, filters: dict = None, decode: bool = False):
+
+        with self.lock:
+            if self.events_errors:
+                raise self.events_errors.pop(0)
+
+            stream = FakeEventStream([event for event in self.history if since is None or event['time'] >= since])
+            self.streams.append(stream)
+
+        return stream
+
+    def emit(self, name: str, action: str):
+
+        container = self.containers_by_name[name]
+        container.status = container_registry.STATUS_BY_ACTION[action]
+        now = time.time_ns()
+        event = {'Type': 'container', 'Action': action, 'time': now // 1_000_000_000, 'timeNano': now,
+                 'Actor': {'ID': container.id, 'Attributes': {'name': name}}}
+
+        with self.lock:
+            self.history.append(event)
+
+            for stream in self.streams:
+                stream.queue.put(event)
+
+    def fail_streams(self, error: Exception):
+
+        with self.lock:
+            for stream in self.streams:
+                stream.queue.put(error)
+
+            self.streams = []
+
+
+@pytest.fixture(autouse=True)
+def clean_registries():
+
+    yield
+
+    for registry in container_registry.container_registries.values():
+        registry.stop()
+
+    container_registry.container_registries.clear()
+
+
+def start_waiting(docker_client: FakeDockerClient, container_names: list, **kwargs) -> threading.Thread:
+
+    thread = threading.Thread(target=wait_until_containers_has_finished, daemon=True,
+                              kwargs=dict(list_of_containers_to_finish=container_names, docker_client=docker_client,
+                                          name_suffix='', **kwargs))
+    thread.start()
+
+    return thread
+
+
+def wait_for_stream(docker_client: FakeDockerClient):
+
+    deadline = time.time() + TIMEOUT
+
+    while len(docker_client.streams) == 0:
+        assert time.time() < deadline, 'events stream was not opened'
+        time.sleep(0.01)
+
+
+def test_returns_when_container_dies():
+
+    docker_client = FakeDockerClient({'capital_update': 'running'})
+    thread = start_waiting(docker_client, ['capital_update'])
+    wait_for_stream(docker_client)
+
+    thread.join(0.2)
+    assert thread.is_alive()
+
+    docker_client.emit('capital_update', 'die')
+    thread.join(TIMEOUT)
+    assert not thread.is_alive()
+
+
+def test_waits_for_restarted_container_until_all_have_stopped():
+
+    docker_client = FakeDockerClient({'daily_prices': 'running', 'daily_backup': 'running'})
+    thread = start_waiting(docker_client, ['daily_prices', 'daily_backup'])
+    wait_for_stream(docker_client)
+
+    docker_client.emit('daily_prices', 'die')
+    docker_client.emit('daily_prices', 'start')
+    docker_client.emit('daily_backup', 'stop')
+    thread.join(0.2)
+    assert thread.is_alive()
+
+    docker_client.emit('daily_prices', 'die')
+    thread.join(TIMEOUT)
+    assert not thread.is_alive()
+
+
+def test_returns_at_once_if_not_running():
+
+    docker_client = FakeDockerClient({'cleaner': 'exited'})
+    thread = start_waiting(docker_client, ['cleaner'])
+
+    thread.join(TIMEOUT)
+    assert not thread.is_alive()
+
+
+def test_lists_again_when_resync_interval_expires():
+
+    docker_client = FakeDockerClient({'cleaner': 'running'})
+    registry = ContainerRegistry(docker_client=docker_client, name_suffix='')
+    registry.start()
+    wait_for_stream(docker_client)
+
+    # stopped without an event reaching the stream
+    docker_client.containers_by_name['cleaner'].status = 'exited'
+    start = time.time()
+    registry.wait_until_stopped(['cleaner'], resync_interval=0.2)
+    registry.stop()
+
+    assert time.time() - start < TIMEOUT
+    assert docker_client.containers.list_calls == 2
+
+
+def test_lists_again_when_events_stream_fails(monkeypatch):
+
+    monkeypatch.setattr(container_registry, 'RECONNECT_DELAY', 0.05)
+    docker_client = FakeDockerClient({'cleaner': 'running'})
+    thread = start_waiting(docker_client, ['cleaner'])
+    wait_for_stream(docker_client)
+
+    docker_client.containers_by_name['cleaner'].status = 'exited'
+    docker_client.fail_streams(APIError('stream broken'))
+
+    thread.join(TIMEOUT)
+    assert not thread.is_alive()
+    assert docker_client.containers.list_calls == 2
+
+
+def test_falls_back_on_polling_when_registry_fails():
+
+    docker_client = FakeDockerClient({'cleaner': 'running'})
+    docker_client.containers.list_errors.append(APIError('docker unavailable'))
+    thread = start_waiting(docker_client, ['cleaner'], poll_interval=0.05)
+
+    thread.join(0.2)
+    assert thread.is_alive()
+    assert len(docker_client.streams) == 0
+
+    docker_client.containers_by_name['cleaner'].status = 'exited'
+    thread.join(TIMEOUT)
+    assert not thread.is_alive()